@@ -0,0 +1,79 @@
+# analysis_cache.py - persistent cache of /analyze/ results
+import hashlib, os, sqlite3, threading, time
+
+def document_digest(text: str, document_name: str = "") -> str:
+    """Hash of what an analysis prompt takes from the document (its name is in the prompt too)."""
+    h = hashlib.sha256(document_name.encode("utf-8", "surrogatepass"))
+    h.update(b"\0")
+    h.update(text.encode("utf-8", "surrogatepass"))
+    return h.hexdigest()
+
+class AnalysisCache:
+    """SQLite-backed analysis results keyed by (document hash, analysis type, model version).
+
+    Keeps at most ``max_entries`` results, dropping the least recently used.
+    """
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max(1, max_entries)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS analyses (
+                document TEXT NOT NULL,
+                analysis_type TEXT NOT NULL,
+                model TEXT NOT NULL,
+                analysis TEXT NOT NULL,
+                sections INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (document, analysis_type, model)
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS analyses_lru ON analyses (last_access)")
+
+    def get_many(self, document: str, analysis_types: list[str], model: str) -> dict[str, dict]:
+        """Cached results among ``analysis_types``, keyed by type; counts hits and misses."""
+        if not analysis_types:
+            return {}
+        marks = ", ".join("?" for _ in analysis_types)
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT analysis_type, analysis, sections FROM analyses "
+                f"WHERE document = ? AND model = ? AND analysis_type IN ({marks})",
+                (document, model, *analysis_types)).fetchall()
+            self._db.executemany(
+                "UPDATE analyses SET last_access = ? WHERE document = ? AND analysis_type = ? AND model = ?",
+                [(time.time(), document, row[0], model) for row in rows])
+            self.hits += len(rows)
+            self.misses += len(analysis_types) - len(rows)
+        return {kind: {"analysis": analysis, "sections": sections} for kind, analysis, sections in rows}
+
+    def put(self, document: str, analysis_type: str, model: str, analysis: str, sections: int):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO analyses (document, analysis_type, model, analysis, sections, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (document, analysis_type, model, analysis, sections, time.time()))
+            excess = self._db.execute("SELECT COUNT(*) FROM analyses").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self._db.execute(
+                    "DELETE FROM analyses WHERE rowid IN "
+                    "(SELECT rowid FROM analyses ORDER BY last_access LIMIT ?)", (excess,))
+                self.evictions += excess
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM analyses").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": entries,
+            "max_entries": self.max_entries,
+        }
@@ -0,0 +1,376 @@
+# benchmark.py - throughput, per-stage latency and peak memory of the OCR service
+#
+#   python benchmark.py sample.pdf \
+#       --config "" \
+#       --config "quantize=int8" \
+#       --config "quantize=int8,max_pixels=602112,threads=8"
+#
+# Without the 7B weights or a GPU, run a generated corpus against the timing
+# stub (or the tiny random stand-in model) instead:
+#
+#   python benchmark.py --synthetic standard --mode stream \
+#       --config "loader=standin_model:load_timing_stub" --json before.json
+#   ... (change something) ...
+#   python benchmark.py --synthetic standard --mode stream \
+#       --config "loader=standin_model:load_timing_stub" --json after.json --compare before.json
+#
+# --mode picks the entry point measured: run (run_ocr_bytes), stream
+# (stream_ocr_bytes), http (POST /upload/) or ws (the /ws/upload/ chunked
+# protocol; needs the websockets package). http and ws start the server
+# in-process on a free port. Each configuration runs in a fresh process, so
+# model load time and peak memory are its own. The page cache and text-layer
+# routing are switched off so every page goes through the model. Previews are
+# on, as they are for the service's clients, unless --no-previews is given.
+import argparse, asyncio, datetime, hashlib, json, math, multiprocessing, os, queue, resource
+import socket, subprocess, sys, tempfile, threading, time, uuid
+
+from synthetic_corpus import CORPORA, DocumentSpec, build_corpus
+
+# Configuration keys accepted by --config and the variables they set
+CONFIG_KEYS = {
+    "loader": "OCR_MODEL_LOADER",
+    "model_path": "OCR_MODEL_PATH",
+    "device": "OCR_DEVICE",
+    "dtype": "OCR_MODEL_DTYPE",
+    "quantize": "OCR_QUANTIZE",
+    "threads": "OCR_TORCH_THREADS",
+    "interop_threads": "OCR_TORCH_INTEROP_THREADS",
+    "min_pixels": "OCR_MIN_PIXELS",
+    "max_pixels": "OCR_MAX_PIXELS",
+    "batch_size": "OCR_BATCH_SIZE",
+    "model_workers": "OCR_MODEL_WORKERS",
+    "render_processes": "OCR_RENDER_PROCESSES",
+    "stub_prefill_ms_per_1k": "OCR_STUB_PREFILL_MS_PER_1K",
+    "stub_decode_ms": "OCR_STUB_DECODE_MS",
+    "stub_tokens": "OCR_STUB_TOKENS",
+}
+
+MODES = ("run", "stream", "http", "ws")
+
+# Per-page stages reported: a page result's "<stage>_ms" timings, plus
+# tokenize and generate from its generation stats. ocr is the wall time of
+# the page's batch (tokenize + generate + waiting in the scheduler).
+STAGES = ("route", "render", "preprocess", "preview", "queue_wait", "tokenize", "generate",
+          "ocr", "postprocess")
+
+def parse_config(spec: str) -> dict[str, str]:
+    """``"quantize=int8,threads=4"`` -> the environment for that configuration."""
+    env = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        key, sep, value = item.partition("=")
+        if not sep or key not in CONFIG_KEYS:
+            raise ValueError(f"Bad config item '{item}'. Keys: {', '.join(CONFIG_KEYS)}")
+        env[CONFIG_KEYS[key]] = value
+    return env
+
+def percentiles(values: list[float]) -> dict | None:
+    """p50/p90/p99 (nearest rank), mean and max of the values; None if there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def rank(p):
+        return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+    return {"p50": round(rank(50), 2), "p90": round(rank(90), 2), "p99": round(rank(99), 2),
+            "mean": round(sum(ordered) / len(ordered), 2), "max": round(ordered[-1], 2),
+            "count": len(ordered)}
+
+def page_stages(page: dict) -> dict[str, float]:
+    """A page result's stage times in ms (only the stages it went through)."""
+    timings = page.get("timings") or {}
+    stages = {stage: timings[f"{stage}_ms"] for stage in STAGES if f"{stage}_ms" in timings}
+    generation = page.get("generation")
+    if generation:
+        stages["generate"] = 1000 * generation["seconds"]
+        if "tokenize_seconds" in generation:
+            stages["tokenize"] = 1000 * generation["tokenize_seconds"]
+    return stages
+
+# Clients for each mode: (path, profile, port, previews) -> (pages, first page ms or None)
+def _run_client(path: str, profile: str | None, port: int | None, previews: bool):
+    import ocr_olm
+    with open(path, "rb") as fh:
+        result = ocr_olm.run_ocr_bytes(fh.read(), profile, previews=previews)
+    return result["pages"], None
+
+def _stream_client(path: str, profile: str | None, port: int | None, previews: bool):
+    import ocr_olm
+
+    async def consume():
+        with open(path, "rb") as fh:
+            buf = fh.read()
+        pages, first, started = [], None, time.perf_counter()
+        async for event in ocr_olm.stream_ocr_bytes(buf, profile, previews=previews):
+            if event.get("type") == "page_complete":
+                first = first or 1000 * (time.perf_counter() - started)
+                pages.append(event)
+            elif "pages" in event:  # single images come back whole
+                pages.extend(event["pages"])
+            elif event.get("type") == "error":
+                raise RuntimeError(event["error"])
+        return pages, first
+
+    return asyncio.run(consume())
+
+def _http_client(path: str, profile: str | None, port: int | None, previews: bool):
+    import urllib.request
+    boundary = uuid.uuid4().hex
+    with open(path, "rb") as fh:
+        data = fh.read()
+    fields = {"lang": "eng", "profile": profile or "", "previews": str(previews).lower()}
+    body = b"".join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        for name, value in fields.items()
+    ) + (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; '
+         f'filename="{os.path.basename(path)}"\r\nContent-Type: application/octet-stream\r\n\r\n').encode() \
+      + data + f"\r\n--{boundary}--\r\n".encode()
+    request = urllib.request.Request(f"http://127.0.0.1:{port}/upload/", data=body, method="POST",
+                                     headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+    with urllib.request.urlopen(request, timeout=3600) as response:
+        result = json.loads(response.read())
+    if not result.get("success"):
+        raise RuntimeError(result.get("error"))
+    return result["pages"], None
+
+def _ws_client(path: str, profile: str | None, port: int | None, previews: bool):
+    from websockets.sync.client import connect
+    with open(path, "rb") as fh:
+        data = fh.read()
+    pages, first, started = [], None, time.perf_counter()
+    with connect(f"ws://127.0.0.1:{port}/ws/upload/", max_size=None) as ws:
+        ws.send(json.dumps({"filename": os.path.basename(path), "lang": "eng", "profile": profile,
+                            "previews": previews, "size": len(data),
+                            "sha256": hashlib.sha256(data).hexdigest()}))
+        while True:
+            event = json.loads(ws.recv())
+            kind = event.get("type")
+            if kind == "upload_ready":
+                for start in range(0, len(data), event["chunk_size"]):
+                    ws.send(data[start:start + event["chunk_size"]])
+            elif kind == "page_complete":
+                first = first or 1000 * (time.perf_counter() - started)
+                pages.append(event)
+            elif "pages" in event:
+                pages.extend(event["pages"])
+                break
+            elif kind == "processing_complete":
+                break
+            elif kind == "error":
+                raise RuntimeError(event["error"])
+    return pages, first
+
+CLIENTS = {"run": _run_client, "stream": _stream_client, "http": _http_client, "ws": _ws_client}
+
+def _start_server() -> int:
+    """Serve the app from a background thread; returns its port once it accepts connections."""
+    import uvicorn
+    import server
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    app_server = uvicorn.Server(uvicorn.Config(server.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=app_server.run, name="benchmark-server", daemon=True).start()
+    while not app_server.started:
+        time.sleep(0.05)
+    return port
+
+def _run_config(env: dict, documents: list[dict], mode: str, profile: str | None, repeat: int,
+                previews: bool, results):
+    workdir = tempfile.mkdtemp(prefix="ocr_benchmark_")
+    os.environ.update(env)
+    os.environ.update(OCR_CACHE="0", OCR_TEXT_LAYER="0", ANALYSIS_CACHE="0", OCR_WARMUP="0")
+    os.environ.setdefault("OCR_MODEL_WORKERS", "0")
+    # Keep the server's job queue and previews out of the working tree
+    os.environ.update(OCR_JOBS_PATH=os.path.join(workdir, "jobs.sqlite3"),
+                      OCR_JOBS_DIR=os.path.join(workdir, "jobs"),
+                      OCR_PREVIEW_DIR=os.path.join(workdir, "previews"))
+    try:
+        import torch
+        import executors, ocr_olm
+
+        started = time.monotonic()
+        if isinstance(ocr_olm.SCHEDULER, ocr_olm.ModelWorkerPool):
+            ocr_olm.SCHEDULER.start()
+            while not ocr_olm.SCHEDULER.ready:
+                if time.monotonic() - started > ocr_olm.SCHEDULER.startup_timeout:
+                    raise RuntimeError("No model worker became ready")
+                time.sleep(0.1)
+        else:
+            ocr_olm.MODEL_REGISTRY.load()
+        load_seconds = time.monotonic() - started
+        port = _start_server() if mode in ("http", "ws") else None
+        client = CLIENTS[mode]
+
+        latencies, first_pages, stages = [], [], {stage: [] for stage in STAGES}
+        pages = errors = tokens = 0
+        per_document = []
+        started = time.monotonic()
+        for document in documents:
+            doc_latencies = []
+            for _ in range(repeat):
+                doc_started = time.perf_counter()
+                doc_pages, first = client(document["path"], profile, port, previews)
+                doc_latencies.append(1000 * (time.perf_counter() - doc_started))
+                if first is not None:
+                    first_pages.append(first)
+                pages += len(doc_pages)
+                errors += sum(1 for page in doc_pages if page.get("error"))
+                for page in doc_pages:
+                    tokens += (page.get("generation") or {}).get("tokens", 0)
+                    for stage, ms in page_stages(page).items():
+                        stages[stage].append(ms)
+            latencies.extend(doc_latencies)
+            per_document.append({"document": document["name"], "latency_ms": percentiles(doc_latencies)})
+        seconds = time.monotonic() - started
+
+        # Render workers only count towards RUSAGE_CHILDREN once they have exited
+        executors.RENDER_PROCESS_POOL.shutdown(wait=True)
+        ocr_olm.SCHEDULER.stop()
+        results.put({
+            "mode": mode,
+            "previews": previews,
+            "documents": len(documents) * repeat,
+            "pages": pages,
+            "errors": errors,
+            "load_seconds": round(load_seconds, 2),
+            "seconds": round(seconds, 2),
+            "pages_per_second": round(pages / seconds, 3) if seconds else None,
+            "seconds_per_page": round(seconds / pages, 2) if pages else None,
+            "tokens": tokens,
+            "tokens_per_second": round(tokens / seconds, 1) if seconds else None,
+            "latency_ms": percentiles(latencies),
+            "first_page_ms": percentiles(first_pages),
+            "stages_ms": {stage: percentiles(values) for stage, values in stages.items() if values},
+            "per_document": per_document,
+            # ru_maxrss is in KiB on Linux
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "peak_children_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+            "peak_cuda_mb": round(torch.cuda.max_memory_allocated() / 2**20, 1)
+            if torch.cuda.is_available() else None,
+            "model": ocr_olm.MODEL_CONFIG.describe(),
+        })
+    except Exception as e:
+        results.put({"error": f"{type(e).__name__}: {e}"})
+
+def run_benchmark(documents: list[dict], configs: list[str], mode: str = "run",
+                  profile: str | None = None, repeat: int = 1, previews: bool = True) -> list[dict]:
+    """Run every document through ``mode`` once per configuration, each in its own process."""
+    ctx = multiprocessing.get_context("spawn")
+    reports = []
+    for spec in configs:
+        env = parse_config(spec)
+        results = ctx.Queue()
+        proc = ctx.Process(target=_run_config, args=(env, documents, mode, profile, repeat, previews, results))
+        proc.start()
+        while True:
+            try:
+                report = results.get(timeout=1.0)
+                break
+            except queue.Empty:
+                if not proc.is_alive():  # e.g. killed for running out of memory
+                    report = {"error": f"exited with code {proc.exitcode}"}
+                    break
+        proc.join()
+        reports.append({"config": spec or "(defaults)", **report})
+    return reports
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(reports: list[dict], baseline: dict | list) -> list[str]:
+    """Lines comparing each configuration's throughput and stage p50s with a saved run."""
+    base_reports = baseline["reports"] if isinstance(baseline, dict) else baseline
+    base = {report["config"]: report for report in base_reports if "error" not in report}
+
+    def change(new, old):
+        if new is None or not old:
+            return "n/a"
+        return f"{100 * (new - old) / old:+.1f}%"
+
+    lines = []
+    for report in reports:
+        old = base.get(report["config"])
+        if old is None or "error" in report:
+            continue
+        lines.append(f"{report['config']}:")
+        lines.append(f"  pages/s {old.get('pages_per_second')} -> {report['pages_per_second']} "
+                     f"({change(report['pages_per_second'], old.get('pages_per_second'))})")
+        for key in ("latency_ms", "first_page_ms"):
+            if report.get(key) and old.get(key):
+                lines.append(f"  {key} p50 {old[key]['p50']} -> {report[key]['p50']} "
+                             f"({change(report[key]['p50'], old[key]['p50'])})")
+        for stage, values in report["stages_ms"].items():
+            previous = (old.get("stages_ms") or {}).get(stage)
+            if previous:
+                lines.append(f"  {stage:<12} p50 {previous['p50']} -> {values['p50']} "
+                             f"({change(values['p50'], previous['p50'])})")
+        lines.append(f"  peak RSS MB {old.get('peak_rss_mb')} -> {report['peak_rss_mb']}")
+    return lines
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="OCR documents once per model configuration.")
+    parser.add_argument("paths", nargs="*", help="PDFs or images to OCR")
+    parser.add_argument("--synthetic", choices=sorted(CORPORA), default=None,
+                        help="add a generated corpus")
+    parser.add_argument("--doc", action="append", default=[],
+                        help="add a generated document, e.g. 'pages=4,size=a4,dpi=300,density=dense'. Repeatable.")
+    parser.add_argument("--corpus-dir", default=None,
+                        help="where generated documents are written and reused (default: a temp dir)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated documents")
+    parser.add_argument("--mode", choices=MODES, default="run", help="entry point to measure")
+    parser.add_argument("--config", action="append", default=None,
+                        help=f"comma-separated key=value; keys: {', '.join(CONFIG_KEYS)}. Repeatable.")
+    parser.add_argument("--profile", default=None, help="generation profile")
+    parser.add_argument("--repeat", type=int, default=1, help="times each document is processed")
+    parser.add_argument("--no-previews", dest="previews", action="store_false",
+                        help="don't make page previews (the preview stage is then not measured)")
+    parser.add_argument("--json", default=None, help="also write the reports to this file")
+    parser.add_argument("--compare", default=None, help="a --json file from an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    specs = list(CORPORA[args.synthetic]) if args.synthetic else []
+    specs += [DocumentSpec.parse(doc) for doc in args.doc]
+    documents = [{"name": os.path.basename(path), "path": path} for path in args.paths]
+    if specs:
+        corpus_dir = args.corpus_dir or tempfile.mkdtemp(prefix="ocr_corpus_")
+        documents += [{"name": spec.name, "path": path, "spec": spec.describe()}
+                      for spec, path in build_corpus(specs, corpus_dir, args.seed)]
+    if not documents:
+        parser.error("give documents to OCR, --synthetic or --doc")
+
+    reports = run_benchmark(documents, args.config or [""], args.mode, args.profile, max(1, args.repeat),
+                            args.previews)
+    print(f"\n{'config':<48} {'load s':>7} {'pages/s':>8} {'p50 ms':>9} {'p90 ms':>9} {'tok/s':>7} {'peak MB':>8}")
+    for report in reports:
+        if "error" in report:
+            print(f"{report['config']:<48} failed: {report['error']}")
+            continue
+        latency = report["latency_ms"] or {}
+        print(f"{report['config']:<48} {report['load_seconds']:>7} {report['pages_per_second']!s:>8} "
+              f"{latency.get('p50')!s:>9} {latency.get('p90')!s:>9} "
+              f"{report['tokens_per_second']!s:>7} {report['peak_rss_mb']:>8}")
+        for stage, values in report["stages_ms"].items():
+            print(f"    {stage:<12} p50 {values['p50']:>9} p90 {values['p90']:>9} p99 {values['p99']:>9} ms")
+    if args.compare:
+        with open(args.compare) as fh:
+            print("\n" + "\n".join(compare(reports, json.load(fh))))
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump({
+                "commit": _git_commit(),
+                "created": datetime.datetime.now().isoformat(timespec="seconds"),
+                "mode": args.mode,
+                "repeat": args.repeat,
+                "previews": args.previews,
+                "documents": [{key: value for key, value in doc.items() if key != "path"} for doc in documents],
+                "reports": reports,
+            }, fh, indent=2)
+    return 0 if all("error" not in r for r in reports) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+# chat_sessions.py - server-side chat sessions over one document
+#
+# The stateless /chat/ endpoint receives the whole document and history with
+# every message and prefills all of it again. A session keeps both on the
+# server: the document is sent once, each turn appends to the history, and
+# the prompt's KV cache is carried over (see prefix_cache.ConversationCache),
+# so a turn only prefills the new message and the last reply.
+import asyncio, threading, time, uuid
+from collections import OrderedDict
+
+from prefix_cache import ConversationCache
+from retrieval import BM25Index, Chunk, chunk_document, format_chunks
+
+class ChatSession:
+    """One conversation about one document.
+
+    ``context`` is the part of the document placed at the start of every
+    prompt: all of it when it fits in ``context_chars``, otherwise its opening
+    chunks. ``index`` finds excerpts from the rest for each question. Turns
+    run one at a time (``lock``) since each builds on the previous one.
+    """
+
+    def __init__(self, document_name: str, text: str, context_chars: int, chunk_chars: int = 1000):
+        self.id = uuid.uuid4().hex
+        self.document_name = document_name
+        self.text = text
+        self.index = BM25Index(chunk_document(text, chunk_chars))
+        if len(text) <= context_chars:
+            self.context_chunks: list[Chunk] = list(self.index.chunks)
+            self.context = text
+        else:
+            self.context_chunks, used = [], 0
+            for chunk in self.index.chunks:
+                if used + len(chunk.text) > context_chars:
+                    break
+                self.context_chunks.append(chunk)
+                used += len(chunk.text)
+            self.context = format_chunks(self.context_chunks)
+        self.history: list[dict] = []  # {"role": "user" | "assistant", "content": str}
+        self.cache = ConversationCache()
+        self.lock = asyncio.Lock()
+        self.created = time.time()
+        self.last_used = self.created
+
+    @property
+    def complete(self) -> bool:
+        """Whether the whole document is in the prompt context."""
+        return len(self.context_chunks) == len(self.index.chunks)
+
+    def describe(self) -> dict:
+        return {
+            "session_id": self.id,
+            "document_name": self.document_name,
+            "document_chars": len(self.text),
+            "chunks": len(self.index.chunks),
+            "context_chunks": len(self.context_chunks),
+            "turns": sum(1 for message in self.history if message["role"] == "user"),
+            "history": self.history,
+            "cached_tokens": len(self.cache.ids),
+            "cache_bytes": self.cache.nbytes,
+            "created": self.created,
+            "last_used": self.last_used,
+        }
+
+class ChatSessionStore:
+    """Live chat sessions, evicted least recently used first.
+
+    Sessions idle for ``ttl`` seconds are removed, and beyond ``max_sessions``
+    the least recently used ones go. When the sessions' KV caches together
+    exceed ``max_cache_bytes``, the caches of the least recently used sessions
+    are dropped first; those sessions stay usable and prefill in full on
+    their next turn.
+    """
+
+    def __init__(self, max_sessions: int = 64, ttl: float = 3600.0, max_cache_bytes: int = 2 * 2**30):
+        self.max_sessions = max(1, max_sessions)
+        self.ttl = ttl
+        self.max_cache_bytes = max_cache_bytes
+        self.evicted = 0
+        self.caches_dropped = 0
+        self._lock = threading.Lock()
+        self._sessions: OrderedDict[str, ChatSession] = OrderedDict()
+
+    def add(self, session: ChatSession) -> ChatSession:
+        with self._lock:
+            self._sessions[session.id] = session
+        self.evict()
+        return session
+
+    def get(self, session_id: str) -> ChatSession | None:
+        """The session, marked as just used; None if it is unknown or expired."""
+        self.evict()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.last_used = time.time()
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def remove(self, session_id: str) -> bool:
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._drop_cache(session)
+        return session is not None
+
+    def evict(self):
+        """Apply the TTL, session count and cache memory limits."""
+        now = time.time()
+        removed = []
+        with self._lock:
+            for session_id, session in list(self._sessions.items()):
+                if now - session.last_used > self.ttl or len(self._sessions) > self.max_sessions:
+                    removed.append(self._sessions.pop(session_id))
+            sessions = list(self._sessions.values())  # least recently used first
+        for session in removed:
+            self._drop_cache(session)
+        self.evicted += len(removed)
+
+        total = sum(session.cache.nbytes for session in sessions)
+        for session in sessions[:-1]:  # the most recent session keeps its cache
+            if total <= self.max_cache_bytes:
+                break
+            # A cache in use by a running turn is skipped rather than waited for
+            if session.cache.nbytes and session.cache.lock.acquire(blocking=False):
+                try:
+                    total -= session.cache.drop()
+                    self.caches_dropped += 1
+                finally:
+                    session.cache.lock.release()
+
+    def _drop_cache(self, session: ChatSession):
+        # An evicted session's running turn keeps its cache until it finishes
+        if session.cache.lock.acquire(blocking=False):
+            try:
+                session.cache.drop()
+            finally:
+                session.cache.lock.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return {
+            "sessions": len(sessions),
+            "max_sessions": self.max_sessions,
+            "cache_bytes": sum(session.cache.nbytes for session in sessions),
+            "max_cache_bytes": self.max_cache_bytes,
+            "evicted": self.evicted,
+            "caches_dropped": self.caches_dropped,
+        }
@@ -0,0 +1,53 @@
+# executors.py - pools that keep blocking work off the asyncio event loop
+import asyncio, contextvars, os, multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+# Rasterizing and image work. pdftoppm runs as a subprocess and PIL releases the
+# GIL for resize/encode, so a thread pool gives real parallelism here.
+RENDER_WORKERS = max(1, int(os.environ.get("OCR_RENDER_WORKERS", str(min(4, os.cpu_count() or 1)))))
+RENDER_POOL = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="ocr-render")
+
+# Pipelined page rendering for streaming PDFs (render + preprocess per page).
+# Spawned, not forked, so workers never inherit the model or CUDA state.
+# OCR_RENDER_PROCESSES=0 renders in RENDER_POOL threads instead.
+RENDER_PROCESSES = max(0, int(os.environ.get("OCR_RENDER_PROCESSES", "2")))
+RENDER_PROCESS_POOL = (
+    ProcessPoolExecutor(max_workers=RENDER_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+    if RENDER_PROCESSES else RENDER_POOL
+)
+
+# Short blocking steps of request handlers: file and socket I/O, cache and
+# database lookups, index builds. Nothing long-running goes here, so these
+# stay quick however many documents are being OCRed.
+REQUEST_WORKERS = max(1, int(os.environ.get("OCR_REQUEST_WORKERS", "4")))
+REQUEST_POOL = ThreadPoolExecutor(max_workers=REQUEST_WORKERS, thread_name_prefix="ocr-request")
+
+# Whole-document OCR run synchronously (the non-streaming /upload/ path and
+# single images), which holds a thread for as long as the document takes.
+# These threads mostly wait on render work and the scheduler's inference worker.
+DOCUMENT_WORKERS = max(1, int(os.environ.get("OCR_DOCUMENT_WORKERS", "4")))
+DOCUMENT_POOL = ThreadPoolExecutor(max_workers=DOCUMENT_WORKERS, thread_name_prefix="ocr-document")
+
+# Both run the function in a copy of the caller's context (as asyncio.to_thread
+# does), so context variables such as the request's trace carry over
+async def run_in_render_pool(fn, *args, **kwargs):
+    """Run a CPU/IO-bound render step without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(RENDER_POOL, partial(contextvars.copy_context().run, fn, *args, **kwargs))
+
+async def run_in_request_pool(fn, *args, **kwargs):
+    """Run a short blocking step of a request handler without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(REQUEST_POOL, partial(contextvars.copy_context().run, fn, *args, **kwargs))
+
+async def run_in_document_pool(fn, *args, **kwargs):
+    """Run a whole document's OCR without blocking the event loop or the request pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DOCUMENT_POOL, partial(contextvars.copy_context().run, fn, *args, **kwargs))
+
+def shutdown_executors():
+    RENDER_POOL.shutdown(wait=False, cancel_futures=True)
+    RENDER_PROCESS_POOL.shutdown(wait=False, cancel_futures=True)
+    REQUEST_POOL.shutdown(wait=False, cancel_futures=True)
+    DOCUMENT_POOL.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,255 @@
+# jobs.py - persistent OCR job queue behind the asynchronous /jobs API
+import asyncio, json, logging, os, sqlite3, threading, time, uuid
+
+from executors import run_in_request_pool
+
+log = logging.getLogger("ocr.jobs")
+
+class JobStore:
+    """SQLite-backed job queue and per-page result store.
+
+    A job is a document on disk plus its OCR options. Page results are written
+    as they complete, so a client can read partial results while the job runs
+    and a job interrupted by a restart resumes after its last stored page.
+    """
+
+    def __init__(self, path: str, files_dir: str):
+        self.path = path
+        self.files_dir = files_dir
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        os.makedirs(files_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                filename TEXT,
+                file_path TEXT NOT NULL,
+                options TEXT NOT NULL,
+                status TEXT NOT NULL,
+                total_pages INTEGER,
+                error TEXT,
+                summary TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, created)")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS job_pages (
+                job_id TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                result TEXT NOT NULL,
+                PRIMARY KEY (job_id, page)
+            )""")
+
+    def new_file_path(self, filename: str | None) -> tuple[str, str]:
+        """A fresh job id and the path its uploaded document should be written to."""
+        job_id = uuid.uuid4().hex
+        suffix = os.path.splitext(filename or "")[1]
+        return job_id, os.path.join(self.files_dir, f"{job_id}{suffix}")
+
+    def create(self, job_id: str, filename: str | None, file_path: str, options: dict):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO jobs (id, filename, file_path, options, status, created, updated) "
+                "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                (job_id, filename, file_path, json.dumps(options), now, now))
+
+    def requeue_running(self) -> int:
+        """Put jobs left running by a previous process back in the queue."""
+        with self._lock:
+            return self._db.execute(
+                "UPDATE jobs SET status = 'queued', updated = ? WHERE status = 'running'", (time.time(),)
+            ).rowcount
+
+    def claim(self) -> dict | None:
+        """Mark the oldest queued job as running and return it."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE jobs SET status = 'running', updated = ? WHERE id = ?",
+                             (time.time(), row[0]))
+        return self.get(row[0])
+
+    def get(self, job_id: str) -> dict | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, filename, file_path, options, status, total_pages, error, summary, created, updated "
+                "FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            completed = self._db.execute(
+                "SELECT COUNT(*) FROM job_pages WHERE job_id = ?", (job_id,)).fetchone()[0]
+        return {
+            "id": row[0], "filename": row[1], "file_path": row[2], "options": json.loads(row[3]),
+            "status": row[4], "total_pages": row[5], "completed_pages": completed, "error": row[6],
+            "summary": json.loads(row[7]) if row[7] else None, "created": row[8], "updated": row[9],
+        }
+
+    def done_pages(self, job_id: str) -> set[int]:
+        with self._lock:
+            rows = self._db.execute("SELECT page FROM job_pages WHERE job_id = ?", (job_id,)).fetchall()
+        return {row[0] for row in rows}
+
+    def set_total_pages(self, job_id: str, total_pages: int):
+        with self._lock:
+            self._db.execute("UPDATE jobs SET total_pages = ?, updated = ? WHERE id = ?",
+                             (total_pages, time.time(), job_id))
+
+    def add_page(self, job_id: str, result: dict):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO job_pages (job_id, page, result) VALUES (?, ?, ?)",
+                             (job_id, result["page"], json.dumps(result)))
+            self._db.execute("UPDATE jobs SET updated = ? WHERE id = ?", (time.time(), job_id))
+
+    def pages(self, job_id: str, from_page: int = 1, limit: int = 100) -> list[dict]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT result FROM job_pages WHERE job_id = ? AND page >= ? ORDER BY page LIMIT ?",
+                (job_id, from_page, limit)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def finish(self, job_id: str, status: str, error: str | None = None, summary: dict | None = None):
+        """Record a job's final state and drop its input file."""
+        with self._lock:
+            row = self._db.execute("SELECT file_path FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            self._db.execute(
+                "UPDATE jobs SET status = ?, error = ?, summary = ?, updated = ? WHERE id = ?",
+                (status, error, json.dumps(summary) if summary else None, time.time(), job_id))
+        if row:
+            try:
+                os.remove(row[0])
+            except OSError:
+                pass
+
+    def prune(self, max_age: float) -> list[str]:
+        """Delete finished jobs (and their pages) last updated more than ``max_age``
+        seconds ago; returns their ids."""
+        cutoff = time.time() - max_age
+        with self._lock:
+            ids = [row[0] for row in self._db.execute(
+                "SELECT id FROM jobs WHERE status IN ('done', 'failed') AND updated < ?", (cutoff,))]
+            self._db.executemany("DELETE FROM job_pages WHERE job_id = ?", [(i,) for i in ids])
+            self._db.executemany("DELETE FROM jobs WHERE id = ?", [(i,) for i in ids])
+        return ids
+
+class JobRunner:
+    """Works through queued jobs with ``workers`` concurrent asyncio tasks.
+
+    ``stream`` is called as ``stream(job_id, path, options, skip_pages)`` and
+    must yield the same events as ``stream_ocr_file``; pages already stored for
+    the job are passed as ``skip_pages`` so a resumed job continues where it
+    stopped. The store is called in the request pool, off the event loop.
+
+    Finished jobs are deleted ``retention`` seconds after they were last
+    updated, checked every ``prune_interval`` seconds. A job's page previews
+    are stored under its id and kept in ``previews`` (a PreviewStore) for as
+    long as the job, rather than for the preview store's TTL.
+    """
+
+    def __init__(self, store: JobStore, stream, workers: int = 1, poll_interval: float = 1.0,
+                 retention: float = 7 * 24 * 3600, previews=None, prune_interval: float = 3600):
+        self.store = store
+        self.stream = stream
+        self.workers = max(1, workers)
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.previews = previews
+        self.prune_interval = prune_interval
+        self._last_prune: float | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._tasks: list[asyncio.Task] = []
+
+    async def start(self):
+        requeued = await run_in_request_pool(self.store.requeue_running)
+        if requeued:
+            log.info("Resuming %d interrupted jobs", requeued)
+        self._last_prune = None
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    def notify(self):
+        """Wake an idle worker after a job was queued."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _prune(self):
+        now = time.monotonic()
+        if self._last_prune is not None and now - self._last_prune < self.prune_interval:
+            return
+        self._last_prune = now
+        pruned = await run_in_request_pool(self.store.prune, self.retention)
+        if self.previews is not None:
+            for job_id in pruned:
+                await run_in_request_pool(self.previews.remove, job_id)
+        if pruned:
+            log.info("Deleted %d expired jobs", len(pruned))
+
+    async def _work(self):
+        while True:
+            await self._prune()
+            job = await run_in_request_pool(self.store.claim)
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job)
+
+    async def _run(self, job: dict):
+        job_id = job["id"]
+        store = self.store
+        skip = await run_in_request_pool(store.done_pages, job_id)
+        log.info("Running job %s (%d pages already done)", job_id, len(skip))
+        try:
+            if self.previews is not None and job["options"].get("previews", True):
+                await run_in_request_pool(self.previews.keep, job_id)
+            async for event in self.stream(job_id, job["file_path"], job["options"], skip):
+                kind = event.get("type")
+                if kind == "page_start" and job["total_pages"] is None:
+                    job["total_pages"] = event["total_pages"]
+                    await run_in_request_pool(store.set_total_pages, job_id, event["total_pages"])
+                elif kind == "page_complete":
+                    await run_in_request_pool(store.add_page, job_id, _page_record(event))
+                elif kind == "processing_complete":
+                    if job["total_pages"] is None:
+                        await run_in_request_pool(store.set_total_pages, job_id, event["total_pages"])
+                    summary = {k: v for k, v in event.items() if k not in ("type", "status")}
+                    await run_in_request_pool(store.finish, job_id, "done", summary=summary)
+                    return
+                elif kind == "error":
+                    await run_in_request_pool(store.finish, job_id, "failed", error=event.get("error"))
+                    return
+                elif "pages" in event:
+                    # Single images come back as one whole result
+                    await run_in_request_pool(store.set_total_pages, job_id, event["total_pages"])
+                    for page in event["pages"]:
+                        await run_in_request_pool(store.add_page, job_id, page)
+                    await run_in_request_pool(store.finish, job_id, "done" if event["success"] else "failed",
+                                              error=event["error"])
+                    return
+            await run_in_request_pool(store.finish, job_id, "failed", error="OCR stream ended without completing")
+        except asyncio.CancelledError:
+            # Shutting down: leave the job 'running' so the next start resumes it
+            raise
+        except Exception as e:
+            log.warning("Job %s failed: %s", job_id, e)
+            await run_in_request_pool(store.finish, job_id, "failed", error=str(e))
+
+def _page_record(event: dict) -> dict:
+    """The stored form of a page_complete event."""
+    return {k: v for k, v in event.items() if k not in ("type", "total_pages", "status")}
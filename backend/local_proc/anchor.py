@@ -1,4 +1,11 @@
+import logging
+import re
+import unicodedata
+
 from PyPDF2 import PdfReader
+from PyPDF2.generic import ContentStream
+
+log = logging.getLogger("ocr.anchor")
 
 def get_anchor_text(pdf_stream, page_number=1, mode="pdfreport", max_length=4000):
     try:
@@ -13,5 +20,92 @@ def get_anchor_text(pdf_stream, page_number=1, mode="pdfreport", max_length=4000
         return ' '.join(text.split())[:max_length]
         
     except Exception as e:
-        print(f"Anchor text error: {str(e)}")
+        log.warning("Anchor text error: %s", e)
         return ""
+
+def _multiply(m, n):
+    """Compose two PDF transformation matrices [a b c d e f] (m applied first)."""
+    a, b, c, d, e, f = m
+    a2, b2, c2, d2, e2, f2 = n
+    return [a * a2 + b * c2, a * b2 + b * d2,
+            c * a2 + d * c2, c * b2 + d * d2,
+            e * a2 + f * c2 + e2, e * b2 + f * d2 + f2]
+
+def get_image_area(reader, page_number=1):
+    """Fraction of the page covered by drawn images, from the page content stream.
+
+    Tracks the current transformation matrix through q/Q/cm and measures every
+    image XObject painted with Do (an image fills the unit square of the CTM).
+    Images inside form XObjects are not counted.
+    """
+    page = reader.pages[page_number - 1]
+    resources = page.get("/Resources")
+    xobjects = resources.get_object().get("/XObject") if resources else None
+    if not xobjects:
+        return 0.0
+    xobjects = xobjects.get_object()
+
+    box = page.mediabox
+    page_area = max(float(box.width) * float(box.height), 1.0)
+    contents = page.get_contents()
+    if contents is None:
+        return 0.0
+
+    ctm, stack, area = [1, 0, 0, 1, 0, 0], [], 0.0
+    for operands, operator in ContentStream(contents, reader).operations:
+        if operator == b"q":
+            stack.append(ctm)
+        elif operator == b"Q" and stack:
+            ctm = stack.pop()
+        elif operator == b"cm":
+            ctm = _multiply([float(x) for x in operands], ctm)
+        elif operator == b"Do":
+            xobj = xobjects.get(operands[0])
+            if xobj is not None and xobj.get_object().get("/Subtype") == "/Image":
+                a, b, c, d = ctm[:4]
+                area += abs(a * d - b * c)
+    return min(area / page_area, 1.0)
+
+def score_text_layer(text, width_pt, height_pt, image_fraction):
+    """Judge whether a page's embedded text layer can stand in for vision OCR.
+
+    Returns a dict with the individual signals and a ``trusted`` verdict:
+    enough characters for the page area (coverage), text that decodes to real
+    characters rather than (cid:..) codes, replacement or private-use glyphs
+    (sanity), plausible word lengths, and little of the page covered by images
+    that could hold text the layer does not contain.
+    """
+    chars = [ch for ch in text if not ch.isspace()]
+    area_sq_in = max(width_pt * height_pt, 1.0) / (72 * 72)
+    coverage = len(chars) / area_sq_in
+
+    # Unmapped glyphs come out as "(cid:123)"; count every character of them as bad
+    bad = sum(len(m) for m in re.findall(r"\(cid:\d+\)", text)) + sum(
+        1 for ch in chars
+        if ch == "\ufffd" or unicodedata.category(ch) in ("Co", "Cn", "Cc")
+    )
+    sanity = 1.0 - bad / len(chars) if chars else 0.0
+
+    words = text.split()
+    avg_word = sum(len(w) for w in words) / len(words) if words else 0.0
+
+    trusted = (
+        len(chars) >= 200
+        and coverage >= 4.0
+        and sanity >= 0.98
+        and 2.0 <= avg_word <= 15.0
+        and image_fraction <= 0.25
+    )
+    return {
+        "chars": len(chars),
+        "coverage": round(coverage, 2),
+        "sanity": round(sanity, 4),
+        "avg_word_length": round(avg_word, 2),
+        "image_fraction": round(image_fraction, 3),
+        "trusted": trusted,
+    }
+
+def clean_text_layer(text):
+    """Keep the text layer's line structure, dropping blank lines and edge whitespace."""
+    lines = (line.strip() for line in text.replace("\r\n", "\n").replace("\r", "\n").split("\n"))
+    return "\n".join(line for line in lines if line)
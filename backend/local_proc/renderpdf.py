@@ -1,33 +1,239 @@
 import base64
 import io
-from pdf2image import convert_from_bytes
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from PIL import Image
+from PyPDF2 import PdfReader
 
-def render_pdf_to_base64png(pdf_stream, page_number=1, resolution=1024):
-    try:
-        # Reset stream position
-        pdf_stream.seek(0)
-        
-        # Convert specific page
-        images = convert_from_bytes(
-            pdf_stream.read(),
-            dpi=resolution,
-            first_page=page_number,
-            last_page=page_number
+from local_proc.anchor import get_image_area
+
+log = logging.getLogger("ocr.renderpdf")
+
+# Preferred backend: pdfium keeps the parsed document open and renders any
+# page by index. pdf2image/pdftoppm is the fallback; it still starts one process
+# per page, but always reads the same file on disk.
+try:
+    import pypdfium2 as pdfium
+    import pypdfium2.raw as pdfium_c
+    PDFIUM = True
+except ImportError:
+    PDFIUM = False
+
+try:
+    from pdf2image import convert_from_path, pdfinfo_from_path
+    PDF2IMAGE = True
+except ImportError:
+    PDF2IMAGE = False
+
+RENDER_BACKEND = "pypdfium2" if PDFIUM else "pdf2image" if PDF2IMAGE else None
+
+# PDFium is not thread-safe at all, not even across documents, so every call
+# into it in this process goes through one lock. Render workers are separate
+# processes and render in parallel; threads in one process take turns.
+_PDFIUM_LOCK = threading.RLock()
+
+class PdfDocument:
+    """A PDF parsed once and rendered page by page on demand.
+
+    Accepts a file path or the raw PDF bytes. Pages are 1-based, as everywhere
+    else in the OCR code.
+    """
+
+    def __init__(self, source):
+        if RENDER_BACKEND is None:
+            raise RuntimeError("No PDF renderer available (install pypdfium2 or pdf2image)")
+
+        self._temp_path = None
+        self._users = 0  # open_pdf callers still using the document
+        self._evicted = False
+        if isinstance(source, (bytes, bytearray, memoryview)) and not PDFIUM:
+            fd, self._temp_path = tempfile.mkstemp(suffix=".pdf", prefix="ocr_render_")
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(source)
+            source = self._temp_path
+        self.source = source
+        self._reader = None  # PyPDF2 reader, only opened for text layers without pdfium
+
+        if PDFIUM:
+            with _PDFIUM_LOCK:
+                self._pdf = pdfium.PdfDocument(source)
+                self.page_count = len(self._pdf)
+        else:
+            self._pdf = None
+            self.page_count = int(pdfinfo_from_path(source)["Pages"])
+
+    def page_size(self, page_number: int) -> tuple[float, float]:
+        """Page width and height in PDF points (1/72 inch)."""
+        if self._pdf is not None:
+            with _PDFIUM_LOCK:
+                page = self._pdf[page_number - 1]
+                try:
+                    return page.get_size()
+                finally:
+                    page.close()
+        info = pdfinfo_from_path(self.source, first_page=page_number, last_page=page_number)
+        # pdfinfo reports ranged pages as "Page    N size: 612 x 792 pts (letter)"
+        size = next(v for k, v in info.items() if k.startswith("Page") and k.endswith("size"))
+        width, height = size.split(" pts")[0].split(" x ")
+        return float(width), float(height)
+
+    def text_layer(self, page_number: int) -> tuple[str, float]:
+        """Embedded text of a page and the fraction of the page area covered by images."""
+        if self._pdf is not None:
+            with _PDFIUM_LOCK:
+                page = self._pdf[page_number - 1]
+                try:
+                    textpage = page.get_textpage()
+                    try:
+                        text = textpage.get_text_range()
+                    finally:
+                        textpage.close()
+                    width, height = page.get_size()
+                    image_area = 0.0
+                    for obj in page.get_objects(filter=(pdfium_c.FPDF_PAGEOBJ_IMAGE,)):
+                        left, bottom, right, top = obj.get_pos()
+                        image_area += max(right - left, 0) * max(top - bottom, 0)
+                    return text, min(image_area / max(width * height, 1.0), 1.0)
+                finally:
+                    page.close()
+
+        if self._reader is None:
+            self._reader = PdfReader(self.source)
+        text = self._reader.pages[page_number - 1].extract_text() or ""
+        return text, get_image_area(self._reader, page_number)
+
+    def render(self, page_number: int, dpi: float | None = 300,
+               max_pixels: int | None = None) -> Image.Image:
+        """Render a page straight to a PIL image.
+
+        With ``max_pixels`` the DPI is chosen so the page comes out at roughly
+        that many pixels (never more than ``dpi`` if both are given), which
+        avoids rendering large and resizing afterwards.
+        """
+        if not 1 <= page_number <= self.page_count:
+            raise ValueError(f"Page {page_number} out of range (1-{self.page_count})")
+        if not dpi and not max_pixels:
+            dpi = 300
+        if max_pixels:
+            budget_dpi = dpi_for_pixels(*self.page_size(page_number), max_pixels)
+            dpi = min(dpi, budget_dpi) if dpi else budget_dpi
+
+        if self._pdf is not None:
+            with _PDFIUM_LOCK:
+                page = self._pdf[page_number - 1]
+                try:
+                    # rev_byteorder gives RGB directly instead of pdfium's native BGR
+                    return page.render(scale=dpi / 72, rev_byteorder=True).to_pil()
+                finally:
+                    page.close()
+
+        images = convert_from_path(
+            self.source, dpi=dpi, first_page=page_number, last_page=page_number
         )
-        
         if not images:
-            raise ValueError("No pages found in PDF")
-            
-        img = images[0]
-        buf = io.BytesIO()
-        img.save(buf, format="PNG")
-        return base64.b64encode(buf.getvalue()).decode('utf-8')
-        
+            raise ValueError(f"No image rendered for page {page_number}")
+        return images[0]
+
+    def close(self):
+        if self._pdf is not None:
+            with _PDFIUM_LOCK:
+                self._pdf.close()
+            self._pdf = None
+        if self._temp_path:
+            try:
+                os.remove(self._temp_path)
+            except OSError:
+                pass
+            self._temp_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def dpi_for_pixels(width_pt: float, height_pt: float, max_pixels: int) -> float:
+    """DPI at which a page of the given size (in points) renders to ``max_pixels`` pixels."""
+    area_sq_in = max(width_pt * height_pt, 1.0) / (72 * 72)
+    return (max_pixels / area_sq_in) ** 0.5
+
+# Documents kept open per process, so render workers parse each file once.
+# A document leaving the cache is closed once its last user is done with it.
+_OPEN_DOCUMENTS: "OrderedDict[str, PdfDocument]" = OrderedDict()
+_OPEN_LOCK = threading.Lock()
+_MAX_OPEN_DOCUMENTS = 4
+
+def _evict(doc: PdfDocument) -> bool:
+    """Mark a document removed from the cache (under _OPEN_LOCK); True if it can be closed now."""
+    doc._evicted = True
+    return doc._users == 0
+
+@contextmanager
+def open_pdf(path: str):
+    """Use the cached PdfDocument for ``path``, opening it on first use.
+
+    The document stays open for the duration of the ``with`` block even if
+    another thread pushes it out of the cache meanwhile. Documents whose file
+    has been deleted are dropped from the cache here too.
+    """
+    idle = []
+    with _OPEN_LOCK:
+        doc = _OPEN_DOCUMENTS.pop(path, None)
+        if doc is None:
+            doc = PdfDocument(path)
+        doc._users += 1
+        _OPEN_DOCUMENTS[path] = doc
+        for cached_path, cached in list(_OPEN_DOCUMENTS.items()):
+            if cached is not doc and not os.path.exists(cached_path):
+                del _OPEN_DOCUMENTS[cached_path]
+                if _evict(cached):
+                    idle.append(cached)
+        while len(_OPEN_DOCUMENTS) > _MAX_OPEN_DOCUMENTS:
+            _, old = _OPEN_DOCUMENTS.popitem(last=False)
+            if _evict(old):
+                idle.append(old)
+    for old in idle:
+        old.close()
+    try:
+        yield doc
+    finally:
+        with _OPEN_LOCK:
+            doc._users -= 1
+            done = doc._evicted and doc._users == 0
+        if done:
+            doc.close()
+
+def close_pdf(path: str):
+    """Drop ``path`` from this process's open-document cache, closing it once no one is using it."""
+    with _OPEN_LOCK:
+        doc = _OPEN_DOCUMENTS.pop(path, None)
+        idle = doc is not None and _evict(doc)
+    if idle:
+        doc.close()
+
+def render_pdf_to_image(pdf_stream, page_number=1, resolution=None, max_pixels=None):
+    """Render one page of a PDF stream to a PIL image, without any PNG/base64 step."""
+    pdf_stream.seek(0)
+    with PdfDocument(pdf_stream.read()) as doc:
+        return doc.render(page_number, dpi=resolution, max_pixels=max_pixels)
+
+def image_to_base64png(img: Image.Image) -> str:
+    """Encode an image for API responses; only call this at the boundary."""
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return base64.b64encode(buf.getvalue()).decode('utf-8')
+
+def render_pdf_to_base64png(pdf_stream, page_number=1, resolution=1024, max_pixels=None):
+    try:
+        return image_to_base64png(render_pdf_to_image(
+            pdf_stream, page_number=page_number, resolution=resolution, max_pixels=max_pixels
+        ))
+
     except Exception as e:
-        print(f"PDF render error: {str(e)}")
+        log.warning("PDF render error: %s", e)
         # Create an error image
-        img = Image.new('RGB', (800, 200), color=(255, 200, 200))
-        buf = io.BytesIO()
-        img.save(buf, format="PNG")
-        return base64.b64encode(buf.getvalue()).decode('utf-8')
+        return image_to_base64png(Image.new('RGB', (800, 200), color=(255, 200, 200)))
@@ -0,0 +1,200 @@
+# metrics.py - service metrics in the Prometheus text format, served by GET /metrics
+#
+# A small registry of counters, histograms and gauges; enough for what this
+# service exports without adding a client library. Metrics are recorded in
+# the server process: the model worker processes report their jobs' outputs
+# back, and those are counted here (see observe_generation).
+import math, threading
+
+# Seconds, from sub-millisecond steps up to multi-minute documents
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 1536, 2048, 3072, 4096, 6144, 8192)
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """A monotonically increasing count, per combination of label values."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labels, key)} {_number(value)}" for key, value in values]
+
+class Histogram:
+    """Observations counted into cumulative ``buckets`` (upper bounds), per label values."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._lock = threading.Lock()
+        self._values: dict[tuple, list] = {}  # key -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = sorted((key, list(state)) for key, state in self._values.items())
+        lines = []
+        for key, state in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {_number(state[-2])}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {state[-1]}")
+        return lines
+
+class Gauge:
+    """A value read when the metrics are scraped: ``read()`` returns a number,
+    or a dict of label value tuples to numbers for a labelled gauge."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, read, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.read = read
+
+    def samples(self) -> list[str]:
+        try:
+            value = self.read()
+        except Exception:
+            return []  # e.g. a component that is not up yet
+        if not self.labels:
+            return [f"{self.name} {_number(value)}"]
+        return [f"{self.name}{_labels(self.labels, key)} {_number(v)}" for key, v in sorted(value.items())]
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: dict[str, Counter | Histogram | Gauge] = {}
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric  # re-registering replaces, e.g. a gauge's reader
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple[str, ...] = (), buckets=TIME_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, read, labels: tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, help, read, labels))
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Pages
+PAGE_STAGE_SECONDS = REGISTRY.histogram(
+    "ocr_page_stage_seconds",
+    "Time a page spent in each pipeline stage (route, render, preprocess, preview, queue_wait, ocr, postprocess)",
+    ("stage",))
+VISION_TOKENS = REGISTRY.histogram(
+    "ocr_page_vision_tokens", "Vision tokens of each page sent to the model", buckets=TOKEN_BUCKETS)
+PAGES = REGISTRY.counter(
+    "ocr_pages_total", "Pages answered, by route (vision, text_layer or cache)", ("route",))
+ERRORS = REGISTRY.counter(
+    "ocr_errors_total",
+    "Failures by where they happened (page, render, generation, websocket, chat, analysis)",
+    ("stage",))
+
+# Generation (every generate call: OCR pages, chat and analysis)
+GENERATED_TOKENS = REGISTRY.histogram(
+    "generation_tokens", "Tokens generated per job", buckets=TOKEN_BUCKETS)
+GENERATE_SECONDS = REGISTRY.histogram(
+    "generation_seconds", "Time in the generate call that ran each job (shared by a batch)")
+TOKENIZE_SECONDS = REGISTRY.histogram(
+    "generation_tokenize_seconds", "Chat template, tokenizer and image processor time per batch a job ran in")
+QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    "generation_queue_wait_seconds", "Time a job waited in the scheduler queue before its batch started")
+PREFIX_TOKENS = REGISTRY.counter(
+    "generation_prefix_tokens_total", "Prompt tokens served from a prefix or session KV cache")
+STOP_REASONS = REGISTRY.counter(
+    "generation_stops_total", "Finished jobs by stop reason (eos, budget or repetition)", ("reason",))
+
+# Delivery
+WEBSOCKET_SEND_SECONDS = REGISTRY.histogram(
+    "websocket_send_seconds", "Time to write one event to a WebSocket client", ("type",))
+
+def observe_generation(output):
+    """Record a finished job's GenerationOutput."""
+    GENERATED_TOKENS.observe(output.tokens)
+    GENERATE_SECONDS.observe(output.seconds)
+    TOKENIZE_SECONDS.observe(output.tokenize_seconds)
+    QUEUE_WAIT_SECONDS.observe(output.queue_seconds)
+    STOP_REASONS.inc(reason=output.stop_reason)
+    if output.prefix_tokens:
+        PREFIX_TOKENS.inc(output.prefix_tokens)
+
+def observe_page(route: str | None, timings: dict, resolution: dict | None = None,
+                 failed: str | None = None):
+    """Record a finished page: its route, its ``*_ms`` stage timings and its vision tokens.
+
+    ``failed`` names the stage a failed page failed in ("render" or "page").
+    """
+    if failed:
+        ERRORS.inc(stage=failed)
+        return
+    if route:
+        PAGES.inc(route=route)
+    for stage, ms in timings.items():
+        if stage.endswith("_ms") and stage != "first_text_ms":
+            PAGE_STAGE_SECONDS.observe(ms / 1000, stage=stage[:-3])
+    if resolution and route == "vision":
+        VISION_TOKENS.observe(resolution["tokens"])
@@ -0,0 +1,269 @@
+# model_loader.py - model configuration and lazy loading
+#
+# Kept apart from ocr_olm.py so model worker processes can load a model
+# without importing the rest of the OCR service, and so importing the service
+# does not load the model at all: it is loaded on first use or by warm_up().
+import importlib, logging, os, threading, time
+
+import torch
+from transformers import AutoProcessor, Qwen2VLForConditionalGeneration
+
+log = logging.getLogger("ocr.model_loader")
+
+# Loaders are named "module:function" and called as loader(with_model=True),
+# returning (model or None, processor, device). The front end of a
+# multi-worker setup only needs the processor and passes with_model=False.
+DEFAULT_LOADER = "model_loader:load_olmocr"
+
+_QUANTIZE = ("none", "int8")
+
+_DTYPES = {
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16,
+    "float32": torch.float32,
+    "auto": "auto",
+}
+
+class ModelConfig:
+    """Where the model comes from and how it is placed, read from the environment.
+
+    OCR_MODEL_PATH / OCR_PROCESSOR_PATH   local model and processor directories
+    OCR_MODEL_DTYPE                       bfloat16, float16, float32 or auto (the
+                                          checkpoint's own dtype); by default bfloat16
+                                          on CUDA and float32 on CPU
+    OCR_DEVICE                            auto (default), cuda or cpu
+    OCR_MODEL_MMAP                        1 to require safetensors weights and always
+                                          memory-map them (see load_olmocr)
+    OCR_QUANTIZE                          int8 for dynamically quantized Linear layers
+                                          (CPU only), or none (default)
+    OCR_TORCH_THREADS                     intra-op threads per process (default: torch's)
+    OCR_TORCH_INTEROP_THREADS             inter-op threads per process
+    OCR_MIN_PIXELS / OCR_MAX_PIXELS       processor image size bounds; a lower max
+                                          means fewer vision tokens per page
+    """
+
+    def __init__(self, loader: str = DEFAULT_LOADER,
+                 model_path: str = "./models/olmOCR-7B-0225-preview",
+                 processor_path: str = "./models/Qwen2-VL-7B-Instruct",
+                 dtype: str | None = None, device: str = "auto", mmap: bool = False,
+                 quantize: str = "none", threads: int | None = None,
+                 interop_threads: int | None = None, min_pixels: int | None = None,
+                 max_pixels: int | None = None):
+        if dtype is not None and dtype not in _DTYPES:
+            raise ValueError(f"Unknown model dtype '{dtype}'. Available: {', '.join(_DTYPES)}")
+        if device not in ("auto", "cuda", "cpu"):
+            raise ValueError(f"Unknown device '{device}'. Available: auto, cuda, cpu")
+        if quantize not in _QUANTIZE:
+            raise ValueError(f"Unknown quantization '{quantize}'. Available: {', '.join(_QUANTIZE)}")
+        self.loader = loader
+        self.model_path = model_path
+        self.processor_path = processor_path
+        self.device = device
+        self.dtype = dtype or ("bfloat16" if self.resolve_device().type == "cuda" else "float32")
+        self.mmap = mmap
+        self.quantize = quantize
+        self.threads = threads
+        self.interop_threads = interop_threads
+        self.min_pixels = min_pixels
+        self.max_pixels = max_pixels
+
+    @classmethod
+    def from_env(cls) -> "ModelConfig":
+        def env_int(name):
+            value = os.environ.get(name)
+            return int(value) if value else None
+
+        defaults = cls()
+        return cls(
+            loader=os.environ.get("OCR_MODEL_LOADER", defaults.loader),
+            model_path=os.environ.get("OCR_MODEL_PATH", defaults.model_path),
+            processor_path=os.environ.get("OCR_PROCESSOR_PATH", defaults.processor_path),
+            dtype=os.environ.get("OCR_MODEL_DTYPE") or None,
+            device=os.environ.get("OCR_DEVICE", defaults.device),
+            mmap=os.environ.get("OCR_MODEL_MMAP", "0") == "1",
+            quantize=os.environ.get("OCR_QUANTIZE", defaults.quantize),
+            threads=env_int("OCR_TORCH_THREADS"),
+            interop_threads=env_int("OCR_TORCH_INTEROP_THREADS"),
+            min_pixels=env_int("OCR_MIN_PIXELS"),
+            max_pixels=env_int("OCR_MAX_PIXELS"),
+        )
+
+    def resolve_device(self) -> torch.device:
+        if self.device == "auto":
+            return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        return torch.device(self.device)
+
+    def describe(self) -> dict:
+        return {
+            "loader": self.loader,
+            "model_path": self.model_path,
+            "processor_path": self.processor_path,
+            "dtype": self.dtype,
+            "device": self.device,
+            "mmap": self.mmap,
+            "quantize": self.quantize,
+            "threads": self.threads,
+            "interop_threads": self.interop_threads,
+            "min_pixels": self.min_pixels,
+            "max_pixels": self.max_pixels,
+        }
+
+    def processor_kwargs(self) -> dict:
+        """Image size bounds to pass to AutoProcessor.from_pretrained, when set."""
+        kwargs = {}
+        if self.min_pixels:
+            kwargs["min_pixels"] = self.min_pixels
+        if self.max_pixels:
+            kwargs["max_pixels"] = self.max_pixels
+        return kwargs
+
+def configure_logging():
+    """Send log records to stderr at OCR_LOG_LEVEL (default INFO); per-page
+    and per-event lines are DEBUG. Called by the server and each model worker."""
+    logging.basicConfig(level=os.environ.get("OCR_LOG_LEVEL", "INFO").upper(),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+def configure_threads(threads: int | None, interop_threads: int | None = None):
+    """Set torch's CPU thread pools for this process.
+
+    Inter-op threads can only be set before torch first runs parallel work;
+    if that has already happened the existing setting is kept.
+    """
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            log.warning("Could not set inter-op threads: %s", e)
+
+def load_olmocr(with_model: bool = True, config: ModelConfig | None = None):
+    """olmOCR-7B with the Qwen2-VL processor, from the local model directories."""
+    config = config or ModelConfig.from_env()
+    device = config.resolve_device()
+    if with_model and not os.path.isdir(config.model_path):
+        raise FileNotFoundError(f"[OCR] model dir missing: {config.model_path}")
+    if not os.path.isdir(config.processor_path):
+        raise FileNotFoundError(f"[OCR] processor dir missing: {config.processor_path}")
+
+    processor = AutoProcessor.from_pretrained(
+        config.processor_path, use_fast=True, local_files_only=True, **config.processor_kwargs()
+    )
+    log.info("Processor loaded from %s", config.processor_path)
+    if not with_model:
+        return None, processor, device
+
+    kwargs = {}
+    if config.mmap:
+        # transformers builds the model on the meta device and memory-maps
+        # safetensors shards unless it guesses the directory is a network
+        # mount. Requiring safetensors and passing disable_mmap=False makes
+        # the mapping unconditional, so a restart mostly reads weights back
+        # from the page cache. With dtype "auto" no conversion copy is made
+        # either.
+        kwargs.update(use_safetensors=True, disable_mmap=False)
+    if config.quantize != "none":
+        if device.type != "cpu":
+            raise ValueError(f"OCR_QUANTIZE={config.quantize} is only supported on CPU")
+        if config.dtype != "float32":
+            # Dynamic quantization replaces float32 Linear layers only
+            raise ValueError(f"OCR_QUANTIZE={config.quantize} needs OCR_MODEL_DTYPE=float32")
+    model = Qwen2VLForConditionalGeneration.from_pretrained(
+        config.model_path,
+        dtype=_DTYPES[config.dtype],
+        device_map="auto" if device.type == "cuda" else {"": "cpu"},
+        local_files_only=True,
+        **kwargs,
+    ).eval()
+    if config.quantize == "int8":
+        model = quantize_int8(model)
+    log.info("Model loaded from %s (%s%s on %s)", config.model_path, config.dtype,
+             ", int8 dynamic" if config.quantize == "int8" else "", device)
+    return model, processor, device
+
+def quantize_int8(model):
+    """Dynamically quantize every Linear layer to int8 weights for CPU inference.
+
+    Weights are stored as int8 and activations are quantized on the fly per
+    batch, which cuts the weight memory to about a quarter of float32 and
+    speeds up the matmuls that dominate decoding on CPU.
+    """
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def resolve_loader(spec: str):
+    """Import a loader given as "module:function"."""
+    module, _, name = spec.partition(":")
+    if not module or not name:
+        raise ValueError(f"Model loader must look like 'module:function', got '{spec}'")
+    return getattr(importlib.import_module(module), name)
+
+class ModelRegistry:
+    """Loads the configured model once, on first use.
+
+    ``processor()`` loads only the processor, which is cheap and all the
+    front end needs to size pages. ``load()`` returns ``(model, processor,
+    device)`` and blocks concurrent callers until the one load finishes;
+    ``warm_up()`` starts that load in the background so the server can answer
+    health checks meanwhile. A failed load is reported by ``status()`` and
+    retried on the next ``load()``.
+    """
+
+    def __init__(self, config: ModelConfig):
+        self.config = config
+        self.state = "idle"  # idle, loading, ready or failed
+        self.error: str | None = None
+        self.load_seconds: float | None = None
+        self._lock = threading.Lock()
+        self._processor_lock = threading.Lock()  # so the processor is not stuck behind a model load
+        self._processor = None
+        self._loaded = None
+
+    def processor(self):
+        if self._loaded is not None:
+            return self._loaded[1]
+        with self._processor_lock:
+            if self._processor is None:
+                self._processor = resolve_loader(self.config.loader)(with_model=False)[1]
+            return self._processor
+
+    def load(self):
+        if self._loaded is not None:
+            return self._loaded
+        with self._lock:
+            if self._loaded is None:
+                self.state = "loading"
+                started = time.monotonic()
+                configure_threads(self.config.threads, self.config.interop_threads)
+                try:
+                    self._loaded = resolve_loader(self.config.loader)(with_model=True)
+                except Exception as e:
+                    self.state, self.error = "failed", f"{type(e).__name__}: {e}"
+                    raise
+                self.load_seconds = time.monotonic() - started
+                self.state, self.error = "ready", None
+            return self._loaded
+
+    def warm_up(self, with_model: bool = True) -> threading.Thread:
+        """Load in a background thread; ``with_model=False`` loads just the processor."""
+        def run():
+            try:
+                self.processor()
+                if with_model:
+                    self.load()
+            except Exception as e:
+                log.warning("Model warm-up failed: %s", e)
+        thread = threading.Thread(target=run, name="model-warm-up", daemon=True)
+        thread.start()
+        return thread
+
+    @property
+    def ready(self) -> bool:
+        return self._loaded is not None
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "error": self.error,
+            "load_seconds": round(self.load_seconds, 1) if self.load_seconds is not None else None,
+            **self.config.describe(),
+        }
@@ -0,0 +1,411 @@
+# model_workers.py - model replicas in worker processes behind one front end
+import asyncio, itertools, logging, multiprocessing, os, queue, threading, time, traceback
+from collections import deque
+from concurrent.futures import Future
+
+import metrics
+from scheduler import GenerationJob, GenerationOutput
+
+log = logging.getLogger("ocr.model_workers")
+
+HEARTBEAT_INTERVAL = 2.0
+
+def _worker_main(index: int, loader_spec: str, scheduler_kwargs: dict, torch_threads: int | None,
+                 interop_threads: int | None, inbox, outbox):
+    """Entry point of a model worker process.
+
+    Loads a model with the named loader, then runs the groups of jobs it is
+    sent through its own InferenceScheduler, so each worker batches like the
+    single-process server. Messages back to the front end are
+    ``(kind, job_id, value)`` tuples on ``outbox``.
+    """
+    from model_loader import configure_logging, configure_threads, resolve_loader
+
+    configure_logging()
+    try:
+        configure_threads(torch_threads, interop_threads)
+        model, processor, device = resolve_loader(loader_spec)()
+        from scheduler import InferenceScheduler
+        scheduler = InferenceScheduler(model, processor, device, **scheduler_kwargs)
+    except Exception:
+        outbox.put(("failed", None, traceback.format_exc()))
+        return
+    outbox.put(("ready", None, {"pid": os.getpid(), "device": str(device)}))
+
+    def heartbeat():
+        while True:
+            outbox.put(("heartbeat", None, scheduler.stats()))
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    threading.Thread(target=heartbeat, name="worker-heartbeat", daemon=True).start()
+
+    def finished(job_id, future):
+        try:
+            outbox.put(("done", job_id, future.result()))
+        except Exception as e:
+            # The exception itself may not pickle
+            outbox.put(("error", job_id, f"{type(e).__name__}: {e}"))
+
+    while True:
+        group = inbox.get()
+        if group is None:
+            break
+        jobs = []
+        for job_id, payload in group:
+            on_text = (lambda chunk, job_id=job_id: outbox.put(("text", job_id, chunk))) \
+                if payload.pop("stream") else None
+            jobs.append(GenerationJob(**payload, on_text=on_text))
+        for (job_id, _), future in zip(group, scheduler.submit_many(jobs)):
+            future.add_done_callback(lambda f, job_id=job_id: finished(job_id, f))
+    scheduler.stop()
+
+class _WorkItem:
+    def __init__(self, job: GenerationJob):
+        self.job = job
+        # Everything but the future, callback and session cache crosses the
+        # process boundary; a KV cache stays in the process that made it, so
+        # chat sessions prefill their prompt in full in worker mode
+        self.payload = {
+            "messages": job.messages,
+            "images": job.images,
+            "gen_kwargs": job.gen_kwargs,
+            "size_bucket": job.size_bucket,
+            "max_new_tokens": job.max_new_tokens,
+            "stop_on_repetition": job.stop_on_repetition,
+            "text_interval": job.text_interval,
+            "cache_prefix": job.cache_prefix,
+            "stream": job.on_text is not None,
+        }
+        self.attempts = 0
+        self.submitted = time.monotonic()
+        self.dispatched = self.submitted
+        self.streamed = 0   # characters already passed to on_text
+        self.received = 0   # characters received during the current attempt
+
+class _Worker:
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.inbox = None
+        self.outbox = None
+        self.reader: threading.Thread | None = None
+        self.pid = None
+        self.ready = False
+        self.started_at = 0.0
+        self.last_seen = 0.0
+        self.inflight: set[int] = set()
+        self.groups: list[list[int]] = []
+        self.scheduler_stats: dict = {}
+        self.jobs_done = 0
+        self.restarts = 0
+        self.start_failures = 0
+        self.respawn_at = 0.0
+
+class ModelWorkerPool:
+    """Spreads generation jobs over ``workers`` model processes.
+
+    A drop-in for InferenceScheduler (``submit``, ``submit_many``, ``generate``,
+    ``stop``, ``stats``): each worker process loads its own model through
+    ``loader_spec`` (see model_loader) and batches with its own scheduler.
+    A group passed to ``submit_many`` always goes to one worker, the least
+    loaded ready one with room under ``max_inflight`` jobs; groups wait in
+    order when every worker is full. Workers are spawned by ``start()`` or the
+    first submit.
+
+    A monitor thread replaces workers that exit or stop sending heartbeats
+    for ``heartbeat_timeout`` seconds. Their unfinished jobs are queued again
+    ahead of new work, up to ``max_retries`` times each; text a job already
+    streamed is not sent again when it is retried.
+    """
+
+    def __init__(self, workers: int, loader_spec: str, scheduler_kwargs: dict | None = None,
+                 max_inflight: int = 16, heartbeat_timeout: float = 60.0,
+                 startup_timeout: float = 600.0, max_retries: int = 2,
+                 max_start_failures: int = 3, torch_threads: int | None = None,
+                 interop_threads: int | None = None):
+        self.loader_spec = loader_spec
+        self.scheduler_kwargs = dict(scheduler_kwargs or {})
+        self.max_inflight = max(1, max_inflight)
+        self.heartbeat_timeout = heartbeat_timeout
+        self.startup_timeout = startup_timeout
+        self.max_retries = max_retries
+        self.max_start_failures = max_start_failures
+        self.torch_threads = torch_threads
+        self.interop_threads = interop_threads
+        self._ctx = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._items: dict[int, _WorkItem] = {}
+        self._pending: deque[list[int]] = deque()
+        self._workers = [_Worker(i) for i in range(max(1, workers))]
+        self._started = False
+        self._stopped = False
+        self._requeued = 0
+        self._failed = 0
+        self._monitor = threading.Thread(target=self._monitor_loop, name="model-worker-monitor", daemon=True)
+
+    def start(self):
+        """Spawn the worker processes; the first submit does this if it was not called."""
+        with self._lock:
+            self._start()
+
+    @property
+    def ready(self) -> bool:
+        """True once at least one worker has loaded its model."""
+        with self._lock:
+            return any(w.ready for w in self._workers)
+
+    # Submission
+    def submit(self, job: GenerationJob) -> Future:
+        """Queue a job and return a concurrent future for its GenerationOutput."""
+        return self.submit_many([job])[0]
+
+    def submit_many(self, jobs: list[GenerationJob]) -> list[Future]:
+        """Queue several jobs as one group; a group is always run by a single worker."""
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("Model worker pool is stopped")
+            group = []
+            for job in jobs:
+                job_id = next(self._ids)
+                self._items[job_id] = _WorkItem(job)
+                group.append(job_id)
+            self._pending.append(group)
+            self._start()
+            self._dispatch()
+        return [job.future for job in jobs]
+
+    async def generate(self, job: GenerationJob) -> GenerationOutput:
+        """Await a job's output without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(job))
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            items, self._items = self._items, {}
+            self._pending.clear()
+        for worker in self._workers:
+            if worker.process is not None and worker.process.is_alive():
+                try:
+                    worker.inbox.put(None)
+                except (OSError, ValueError):
+                    pass
+        for worker in self._workers:
+            if worker.process is not None:
+                worker.process.join(timeout=5)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+        for item in items.values():
+            if not item.job.future.done():
+                item.job.future.set_exception(RuntimeError("Model worker pool is stopped"))
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "workers": [
+                    {
+                        "index": w.index,
+                        "pid": w.pid,
+                        "alive": w.process is not None and w.process.is_alive(),
+                        "ready": w.ready,
+                        "inflight": len(w.inflight),
+                        "jobs_done": w.jobs_done,
+                        "restarts": w.restarts,
+                        "heartbeat_age_s": round(now - w.last_seen, 1) if w.ready else None,
+                        "scheduler": w.scheduler_stats,
+                    }
+                    for w in self._workers
+                ],
+                "queue_depth": sum(len(group) for group in self._pending),
+                "max_inflight_per_worker": self.max_inflight,
+                "requeued_jobs": self._requeued,
+                "failed_jobs": self._failed,
+            }
+
+    # Dispatch (called with the lock held)
+    def _start(self):
+        if self._started or self._stopped:
+            return
+        self._started = True
+        for worker in self._workers:
+            self._spawn(worker)
+        self._monitor.start()
+
+    def _dispatch(self):
+        while self._pending:
+            group = self._pending[0]
+            ready = [w for w in self._workers if w.ready]
+            if not ready:
+                return
+            worker = min(ready, key=lambda w: len(w.inflight))
+            # An idle worker takes a group even if it is larger than the limit
+            if worker.inflight and len(worker.inflight) + len(group) > self.max_inflight:
+                return
+            self._pending.popleft()
+            for job_id in group:
+                item = self._items[job_id]
+                item.attempts += 1
+                item.received = 0
+                item.dispatched = time.monotonic()
+                worker.inflight.add(job_id)
+            worker.groups.append(group)
+            try:
+                worker.inbox.put([(job_id, dict(self._items[job_id].payload)) for job_id in group])
+            except (OSError, ValueError) as e:
+                self._retire(worker, f"could not be sent work ({e})")
+
+    def _retire(self, worker: _Worker, reason: str):
+        """Take a failed worker out of rotation, queue its unfinished jobs again and schedule a respawn."""
+        log.warning("Model worker %d (pid %s) %s; requeueing %d jobs",
+                    worker.index, worker.pid, reason, len(worker.inflight))
+        if not worker.ready:
+            worker.start_failures += 1
+        worker.ready = False
+        groups, worker.groups = worker.groups, []
+        for group in reversed(groups):
+            remaining = [job_id for job_id in group if job_id in worker.inflight]
+            retry = []
+            for job_id in remaining:
+                item = self._items[job_id]
+                if item.attempts > self.max_retries:
+                    self._fail(job_id, RuntimeError(
+                        f"Model worker died while running this job ({item.attempts} attempts)"))
+                else:
+                    retry.append(job_id)
+            if retry:
+                self._requeued += len(retry)
+                self._pending.appendleft(retry)
+        worker.inflight.clear()
+        if worker.process is not None and worker.process.is_alive():
+            worker.process.kill()
+        # Back off a worker that keeps failing to start
+        backoff = min(30.0, 2.0 ** worker.start_failures) if worker.start_failures else 0.0
+        worker.respawn_at = time.monotonic() + backoff
+
+    def _fail(self, job_id: int, error: Exception):
+        item = self._items.pop(job_id, None)
+        if item is not None and not item.job.future.done():
+            self._failed += 1
+            item.job.future.set_exception(error)
+
+    # Worker processes
+    def _spawn(self, worker: _Worker):
+        worker.inbox = self._ctx.Queue()
+        worker.outbox = self._ctx.Queue()
+        worker.process = self._ctx.Process(
+            target=_worker_main,
+            args=(worker.index, self.loader_spec, self.scheduler_kwargs, self.torch_threads,
+                  self.interop_threads, worker.inbox, worker.outbox),
+            name=f"model-worker-{worker.index}",
+            daemon=True,
+        )
+        worker.process.start()
+        worker.pid = worker.process.pid
+        worker.ready = False
+        worker.respawn_at = 0.0
+        worker.started_at = worker.last_seen = time.monotonic()
+        worker.reader = threading.Thread(
+            target=self._read_loop, args=(worker, worker.process, worker.outbox),
+            name=f"model-worker-{worker.index}-reader", daemon=True,
+        )
+        worker.reader.start()
+        log.info("Started model worker %d (pid %s)", worker.index, worker.pid)
+
+    def _read_loop(self, worker: _Worker, process, outbox):
+        # Bound to one process: a respawned worker gets a new reader
+        while True:
+            try:
+                kind, job_id, value = outbox.get(timeout=1.0)
+            except queue.Empty:
+                if self._stopped or worker.process is not process or not process.is_alive():
+                    return
+                continue
+            except (EOFError, OSError):
+                return
+            if worker.process is not process:
+                return
+            self._handle(worker, kind, job_id, value)
+
+    def _handle(self, worker: _Worker, kind: str, job_id: int | None, value):
+        if kind == "text":
+            self._forward_text(worker, job_id, value)
+            return
+        with self._lock:
+            if worker.respawn_at:
+                return  # retired; its jobs belong to other workers now
+            worker.last_seen = time.monotonic()
+            if kind == "heartbeat":
+                worker.scheduler_stats = value
+            elif kind == "ready":
+                worker.ready = True
+                worker.start_failures = 0
+                log.info("Model worker %d ready on %s", worker.index, value["device"])
+            elif kind == "failed":
+                log.error("Model worker %d failed to load the model:\n%s", worker.index, value)
+            elif kind in ("done", "error") and job_id in worker.inflight:
+                worker.inflight.discard(job_id)
+                worker.groups = [g for g in worker.groups if any(i in worker.inflight for i in g)]
+                worker.jobs_done += 1
+                item = self._items.pop(job_id, None)
+                if item is not None and not item.job.future.done():
+                    if kind == "done":
+                        # Outputs are counted here: the workers' own metrics are never scraped
+                        value.queue_seconds += item.dispatched - item.submitted
+                        metrics.observe_generation(value)
+                        item.job.future.set_result(value)
+                    else:
+                        self._failed += 1
+                        metrics.ERRORS.inc(stage="generation")
+                        item.job.future.set_exception(RuntimeError(value))
+            self._dispatch()
+
+    def _forward_text(self, worker: _Worker, job_id: int, chunk: str):
+        with self._lock:
+            item = self._items.get(job_id)
+            if worker.respawn_at or job_id not in worker.inflight or item is None or item.job.on_text is None:
+                return
+            # After a retry, skip what the previous attempt already streamed
+            start = item.received
+            item.received += len(chunk)
+            if item.received <= item.streamed:
+                return
+            chunk = chunk[max(0, item.streamed - start):]
+            item.streamed = item.received
+            on_text = item.job.on_text
+        try:
+            on_text(chunk)
+        except Exception as e:
+            log.warning("Text listener failed: %s", e)
+
+    # Health
+    def _monitor_loop(self):
+        while not self._stopped:
+            time.sleep(1.0)
+            now = time.monotonic()
+            with self._lock:
+                if self._stopped:
+                    return
+                for worker in self._workers:
+                    if worker.respawn_at:
+                        if now >= worker.respawn_at:
+                            worker.restarts += 1
+                            self._spawn(worker)
+                        continue
+                    alive = worker.process.is_alive()
+                    if worker.ready:
+                        if not alive:
+                            self._retire(worker, "exited")
+                        elif now - worker.last_seen > self.heartbeat_timeout:
+                            self._retire(worker, "stopped sending heartbeats")
+                    elif not alive:
+                        self._retire(worker, "exited while loading")
+                    elif now - worker.started_at > self.startup_timeout:
+                        self._retire(worker, "timed out loading")
+                if all(w.start_failures >= self.max_start_failures for w in self._workers):
+                    # No worker can load the model: fail queued work instead of waiting forever
+                    for group in self._pending:
+                        for job_id in group:
+                            self._fail(job_id, RuntimeError("No model worker could be started"))
+                    self._pending.clear()
+                self._dispatch()
@@ -0,0 +1,148 @@
+# ocr_cache.py - persistent, content-addressed cache of OCR page results
+import hashlib, json, logging, os, sqlite3, threading, time
+
+log = logging.getLogger("ocr.cache")
+
+def file_digest(buf: bytes) -> str:
+    return hashlib.sha256(buf).hexdigest()
+
+def path_digest(path: str, chunk_size: int = 1 << 20) -> str:
+    """file_digest of a file on disk, read in chunks."""
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def image_digest(img) -> str:
+    """Hash of a rendered page's pixels (plus size and mode, so reshaped images differ)."""
+    h = hashlib.sha256(f"{img.mode}:{img.size[0]}x{img.size[1]}:".encode())
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+def settings_digest(**settings) -> str:
+    """Hash of everything besides the pixels that changes the OCR output (prompt, model, generation)."""
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+class OCRCache:
+    """SQLite-backed OCR result cache with size-based LRU eviction.
+
+    Results are stored once per (page image hash, settings hash). A second
+    table maps (file hash, page number, settings hash) to the page image, so a
+    re-upload of the same file is answered before anything is rendered, while a
+    page that shows up in a different file is still a hit once rendered.
+    Each result keeps the page's JPEG thumbnail (in the ``preview`` column).
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                image_key TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                preview TEXT,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_lru ON results (last_access)")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS file_pages (
+                file_hash TEXT NOT NULL,
+                settings TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                image_key TEXT NOT NULL,
+                PRIMARY KEY (file_hash, settings, page)
+            )""")
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    @staticmethod
+    def _image_key(image_hash: str, settings: str) -> str:
+        return f"{image_hash}:{settings}"
+
+    def lookup_file(self, file_hash: str, settings: str) -> dict[int, dict]:
+        """Cached results for every known page of a file, keyed by page number."""
+        with self._lock:
+            rows = self._db.execute("""
+                SELECT f.page, r.image_key, r.text, r.preview
+                FROM file_pages f JOIN results r ON r.image_key = f.image_key
+                WHERE f.file_hash = ? AND f.settings = ?""", (file_hash, settings)).fetchall()
+            self._touch([row[1] for row in rows])
+            self.hits += len(rows)
+        return {page: {"text": text, "thumbnail": preview} for page, _, text, preview in rows}
+
+    def get(self, image_hash: str, settings: str) -> dict | None:
+        """Cached result for a rendered page image, counting a hit or miss."""
+        key = self._image_key(image_hash, settings)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT text, preview FROM results WHERE image_key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touch([key])
+        return {"text": row[0], "thumbnail": row[1]}
+
+    def put(self, file_hash: str | None, page: int, image_hash: str, settings: str,
+            text: str, thumbnail: bytes | None):
+        key = self._image_key(image_hash, settings)
+        size = len(text.encode()) + len(thumbnail or b"")
+        with self._lock:
+            old = self._db.execute("SELECT size FROM results WHERE image_key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO results (image_key, text, preview, size, last_access) "
+                "VALUES (?, ?, ?, ?, ?)", (key, text, thumbnail, size, time.time()))
+            self._size += size - (old[0] if old else 0)
+            if file_hash:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO file_pages (file_hash, settings, page, image_key) "
+                    "VALUES (?, ?, ?, ?)", (file_hash, settings, page, key))
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": entries,
+                "size_bytes": self._size,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _touch(self, keys: list[str]):
+        if keys:
+            now = time.time()
+            self._db.executemany(
+                "UPDATE results SET last_access = ? WHERE image_key = ?", [(now, k) for k in keys]
+            )
+
+    def _evict(self):
+        # Drop least recently used results until we are back under 90% of the cap
+        target = int(self.max_bytes * 0.9)
+        rows = self._db.execute(
+            "SELECT image_key, size FROM results ORDER BY last_access"
+        ).fetchall()
+        victims = []
+        for key, size in rows:
+            if self._size <= target:
+                break
+            victims.append((key,))
+            self._size -= size
+        self._db.executemany("DELETE FROM results WHERE image_key = ?", victims)
+        self._db.executemany("DELETE FROM file_pages WHERE image_key = ?", victims)
+        self.evictions += len(victims)
+        log.debug("Evicted %d entries, cache now %d bytes", len(victims), self._size)
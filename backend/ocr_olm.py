@@ -1,45 +1,163 @@
 # ocr_olm.py -
 from io import BytesIO
-import base64, os, warnings, json, asyncio
-from typing import AsyncGenerator
+from concurrent.futures import Future, wait
+import os, warnings, json, asyncio, functools, logging, math, time
+from typing import AsyncGenerator, Callable
 
 from PIL import Image
-from PyPDF2 import PdfReader
-import torch
-from transformers import AutoProcessor, Qwen2VLForConditionalGeneration
-
-# Optional direct PDF → image converter
-try:
-    from pdf2image import convert_from_bytes
-    PDF2IMAGE = True
-except ImportError:
-    PDF2IMAGE = False
-    from local_proc.renderpdf import render_pdf_to_base64png
+
+import metrics, tracing
+from generation import get_profile, token_budget
+from executors import (
+    RENDER_PROCESS_POOL, RENDER_PROCESSES, RENDER_WORKERS, run_in_document_pool, run_in_render_pool,
+)
+from local_proc.renderpdf import PdfDocument, RENDER_BACKEND
+from model_loader import ModelConfig, ModelRegistry
+from model_workers import ModelWorkerPool
+from ocr_cache import OCRCache, file_digest, image_digest, path_digest, settings_digest
+from pipeline import (
+    PREVIEW_PIXELS, PagePipeline, ResolutionPolicy, estimate_chars, fit_image, make_thumbnail,
+    preprocess_image, render_page, route_page, vision_tokens,
+)
+from preview_store import PreviewStore
+from scheduler import GenerationJob, InferenceScheduler
 
 # Environment & model paths
 warnings.filterwarnings("ignore", message=".*preprocessor.json.*")
 
-DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-MODEL_PATH = "./models/olmOCR-7B-0225-preview"
-PROCESSOR_PATH = "./models/Qwen2-VL-7B-Instruct"
+log = logging.getLogger("ocr")
+
+# Nothing is loaded at import. OCR_MODEL_LOADER names the "module:function"
+# that loads the model and processor (model_loader.load_olmocr, or
+# standin_model.load_standin for a tiny CPU-only model); paths, dtype and
+# device come from the environment too (see ModelConfig). The model is loaded
+# by warm_up() or the first generate call. With OCR_MODEL_WORKERS=N it is
+# loaded in N worker processes instead, and this process only needs the processor.
+MODEL_CONFIG = ModelConfig.from_env()
+MODEL_REGISTRY = ModelRegistry(MODEL_CONFIG)
+OCR_MODEL_WORKERS = max(0, int(os.environ.get("OCR_MODEL_WORKERS", "0")))
+
+# Batched page inference: up to OCR_BATCH_SIZE pages share one generate call.
+# Pages are only grouped when their vision-token counts are within
+# OCR_BATCH_TOLERANCE of each other, so short pages are not padded out to the
+# length of a much larger one.
+OCR_BATCH_SIZE = max(1, int(os.environ.get("OCR_BATCH_SIZE", "4")))
+OCR_BATCH_TOLERANCE = float(os.environ.get("OCR_BATCH_TOLERANCE", "0.15"))
+
+# Pages are rendered directly at the size the vision processor will use: 300 DPI,
+# lowered for large-format pages so no page exceeds OCR_RENDER_PIXELS (default:
+# a US-letter page at 300 DPI) or the processor's own max_pixels.
+OCR_RENDER_PIXELS = int(os.environ.get("OCR_RENDER_PIXELS", str(2550 * 3300)))
+
+def _render_pixels() -> int:
+    image_processor = MODEL_REGISTRY.processor().image_processor
+    # transformers 5 keeps the processor's pixel bounds in ``size`` only
+    max_pixels = getattr(image_processor, "max_pixels", None) or image_processor.size["longest_edge"]
+    return min(OCR_RENDER_PIXELS, max_pixels)
+
+# Within that cap, OCR_RESOLUTION=adaptive (the default) sizes each page by a
+# vision-token budget: OCR_PAGE_TOKENS for an ordinary page, OCR_DENSE_PAGE_TOKENS
+# for one dense with ink, and up to OCR_MAX_PAGE_TOKENS for small type, which
+# is scaled until its text lines are OCR_MIN_LINE_PX tall. Prefill time and
+# memory grow with the vision tokens. OCR_RESOLUTION=fixed renders every page
+# at 300 DPI.
+OCR_RESOLUTION = os.environ.get("OCR_RESOLUTION", "adaptive")
 
-if not os.path.isdir(MODEL_PATH):
-    raise FileNotFoundError(f"[OCR] model dir missing: {MODEL_PATH}")
-if not os.path.isdir(PROCESSOR_PATH):
-    raise FileNotFoundError(f"[OCR] processor dir missing: {PROCESSOR_PATH}")
+@functools.cache
+def _resolution_policy() -> ResolutionPolicy | None:
+    if OCR_RESOLUTION == "fixed":
+        return None
+    image_processor = MODEL_REGISTRY.processor().image_processor
+    return ResolutionPolicy(
+        base_tokens=int(os.environ.get("OCR_PAGE_TOKENS", "2000")),
+        dense_tokens=int(os.environ.get("OCR_DENSE_PAGE_TOKENS", "3000")),
+        max_tokens=int(os.environ.get("OCR_MAX_PAGE_TOKENS", "5000")),
+        min_line_px=float(os.environ.get("OCR_MIN_LINE_PX", "16")),
+        token_pixels=(image_processor.patch_size * image_processor.merge_size) ** 2,
+    )
+
+# Streaming PDFs render ahead of the model; at most this many pages are in
+# flight (rendering, waiting for the model or being OCRed) per document.
+OCR_PIPELINE_DEPTH = max(1, int(os.environ.get("OCR_PIPELINE_DEPTH", str(2 * OCR_BATCH_SIZE))))
+
+# Token streaming over the WebSocket: partial page text is sent at most this often
+OCR_STREAM_INTERVAL_MS = float(os.environ.get("OCR_STREAM_INTERVAL_MS", "100"))
+
+# Every generate call in the process (OCR pages, chat, analysis) goes through the
+# scheduler, which batches compatible jobs across requests. With model workers
+# each worker process runs its own scheduler and the pool spreads jobs over them.
+SCHEDULER_SETTINGS = {
+    "max_batch_size": int(os.environ.get("SCHEDULER_MAX_BATCH_SIZE", "8")),
+    "max_wait_ms": float(os.environ.get("SCHEDULER_MAX_WAIT_MS", "20")),
+    "prefix_cache_entries": int(os.environ.get("OCR_PREFIX_CACHE_ENTRIES", "4")),
+}
 
-PROCESSOR = AutoProcessor.from_pretrained(
-    PROCESSOR_PATH, use_fast=True, local_files_only=True
+# The OCR instruction ahead of every page image is prefilled once and its KV
+# cache reused for all pages; OCR_PREFIX_CACHE=0 prefills every page in full
+OCR_PREFIX_CACHE = os.environ.get("OCR_PREFIX_CACHE", "1") != "0"
+
+if OCR_MODEL_WORKERS:
+    SCHEDULER = ModelWorkerPool(
+        OCR_MODEL_WORKERS,
+        MODEL_CONFIG.loader,
+        SCHEDULER_SETTINGS,
+        max_inflight=int(os.environ.get(
+            "OCR_WORKER_MAX_INFLIGHT", str(2 * SCHEDULER_SETTINGS["max_batch_size"]))),
+        heartbeat_timeout=float(os.environ.get("OCR_WORKER_HEARTBEAT_TIMEOUT", "60")),
+        # On CPU the workers split the cores instead of each using all of them
+        torch_threads=MODEL_CONFIG.threads or (
+            None if MODEL_CONFIG.resolve_device().type == "cuda"
+            else max(1, (os.cpu_count() or 1) // OCR_MODEL_WORKERS)),
+        interop_threads=MODEL_CONFIG.interop_threads,
+    )
+else:
+    SCHEDULER = InferenceScheduler(loader=MODEL_REGISTRY.load, **SCHEDULER_SETTINGS)
+
+def warm_up():
+    """Start loading the model in the background (or spawning the model workers)."""
+    if isinstance(SCHEDULER, ModelWorkerPool):
+        SCHEDULER.start()
+        MODEL_REGISTRY.warm_up(with_model=False)
+    else:
+        MODEL_REGISTRY.warm_up()
+
+def model_status() -> dict:
+    """Whether the model can serve requests yet, for the readiness check."""
+    if isinstance(SCHEDULER, ModelWorkerPool):
+        workers = SCHEDULER.stats()["workers"]
+        ready = sum(1 for w in workers if w["ready"])
+        return {
+            "ready": ready > 0,
+            "state": "ready" if ready else "loading",
+            "model_workers": {"ready": ready, "total": len(workers)},
+            **MODEL_CONFIG.describe(),
+        }
+    return {"ready": MODEL_REGISTRY.ready, **MODEL_REGISTRY.status()}
+
+metrics.REGISTRY.gauge("model_ready", "1 once the model (or a model worker) can serve requests",
+                       lambda: int(model_status()["ready"]))
+metrics.REGISTRY.gauge("scheduler_queue_depth", "Generation jobs waiting for the model",
+                       lambda: SCHEDULER.stats()["queue_depth"])
+
+# Born-digital pages whose embedded text layer scores as trustworthy skip the
+# vision model entirely; OCR_TEXT_LAYER=0 sends every page through OCR.
+OCR_TEXT_LAYER = os.environ.get("OCR_TEXT_LAYER", "1") != "0"
+
+# Persistent page-result cache keyed by content hashes; OCR_CACHE=0 disables it
+OCR_CACHE = (
+    OCRCache(
+        os.environ.get("OCR_CACHE_PATH", "./cache/ocr_cache.sqlite3"),
+        int(os.environ.get("OCR_CACHE_MAX_MB", "512")) * 1024 * 1024,
+    )
+    if os.environ.get("OCR_CACHE", "1") != "0" else None
 )
-print(f"[OCR] processor loaded from {PROCESSOR_PATH}")
 
-MODEL = Qwen2VLForConditionalGeneration.from_pretrained(
-    MODEL_PATH,
-    torch_dtype=torch.bfloat16,
-    device_map="auto",
-    local_files_only=True,
-).eval()
-print(f"[OCR] model loaded from {MODEL_PATH} (device_map=auto)")
+# Page thumbnails are served from disk by GET /preview/{job}/{page} rather
+# than inlined into results; a request's thumbnails are kept OCR_PREVIEW_TTL seconds
+PREVIEW_STORE = PreviewStore(
+    os.environ.get("OCR_PREVIEW_DIR", "./cache/previews"),
+    float(os.environ.get("OCR_PREVIEW_TTL", "3600")),
+)
 
 # Helper utilities
 def _is_pdf(buf: bytes) -> bool:
@@ -111,304 +229,682 @@ def _extract_actual_text(raw: str) -> str:
         return raw.strip() if len(result) < 10 else result
         
     except Exception as e:
-        print(f"[WARN] Error cleaning text output: {e}")
+        log.warning("Error cleaning text output: %s", e)
         return raw.strip()  # Return the raw text on error
 
-def _preprocess_image(img: Image.Image) -> Image.Image:
-    """Enhanced image preprocessing for better OCR results."""
-    # Convert to RGB if needed
-    if img.mode != 'RGB':
-        img = img.convert('RGB')
-    
-    # Resize if too small (minimum 800px on shortest side)
-    width, height = img.size
-    min_dim = min(width, height)
-    if min_dim < 800:
-        scale_factor = 800 / min_dim
-        new_width = int(width * scale_factor)
-        new_height = int(height * scale_factor)
-        img = img.resize((new_width, new_height), Image.LANCZOS)
-        print(f"[DEBUG] Upscaled image to {new_width}x{new_height}")
-    
-    return img
+def _can_batch(first: Image.Image, img: Image.Image) -> bool:
+    """True if two preprocessed pages are close enough in size to share a batch."""
+    a, b = vision_tokens(first), vision_tokens(img)
+    return abs(a - b) <= OCR_BATCH_TOLERANCE * max(a, b)
 
-def _run_ocr_on_image(img: Image.Image, prompt: str) -> str:
-    """Enhanced OCR with optimized generation parameters for better text extraction."""
-    img = _preprocess_image(img)
-    
-    messages = [{
-        "role": "user",
-        "content": [
-            {"type": "text", "text": prompt},
-            {"type": "image", "image": img}
-        ]
-    }]
-    
-    text_for_model = PROCESSOR.apply_chat_template(
-        messages, tokenize=False, add_generation_prompt=True
-    )
-    inputs = PROCESSOR(text=text_for_model, images=img, return_tensors="pt").to(DEVICE)
-
-    with torch.no_grad():
-        out_ids = MODEL.generate(
-            **inputs,
-            temperature=0.8,              # Higher temperature for more natural text
-            do_sample=True,               # Enable sampling for better coverage
-            max_new_tokens=3072,          # Increased token limit for longer documents
-            top_p=0.95,                   # Higher top_p for more diverse output
-            repetition_penalty=1.1,       # Reduce repetition
-            pad_token_id=PROCESSOR.tokenizer.pad_token_id,
-        )
+def _size_bucket(img: Image.Image) -> int:
+    """Scheduler bucket: images in the same bucket differ by at most ~OCR_BATCH_TOLERANCE in tokens."""
+    return int(math.log(vision_tokens(img)) / math.log(1 + OCR_BATCH_TOLERANCE))
 
-    new_ids = out_ids[:, inputs["input_ids"].shape[1]:]
-    decoded = PROCESSOR.batch_decode(new_ids, skip_special_tokens=True)[0]
-    print(f"[DEBUG] Raw model output: {decoded[:200]}...")
-    
-    extracted = _extract_actual_text(decoded)
-    print(f"[DEBUG] Extracted text length: {len(extracted)} chars")
+def _submit_ocr(imgs: list[Image.Image], prompt: str, profile: str,
+                estimates: list[int | None] | None = None,
+                listeners: list[Callable[[str], None] | None] | None = None,
+                text_interval: float = OCR_STREAM_INTERVAL_MS / 1000) -> list[Future]:
+    """Queue several pages on the scheduler together; one future per image.
+
+    Each page's max_new_tokens comes from the profile and its estimated amount
+    of text (``estimates``, computed here when not given). ``listeners``
+    optionally receive each page's raw text in chunks while it is generated.
+    """
+    _, settings = get_profile(profile)
+    jobs = []
+    estimates = estimates or [None] * len(imgs)
+    listeners = listeners or [None] * len(imgs)
+    for img, estimated, listener in zip(imgs, estimates, listeners):
+        img = preprocess_image(img)
+        if estimated is None:
+            estimated = estimate_chars(img)
+        messages = [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt},
+                {"type": "image", "image": img}
+            ]
+        }]
+        jobs.append(GenerationJob(
+            messages,
+            images=[img],
+            gen_kwargs=settings["gen_kwargs"],
+            size_bucket=_size_bucket(img),
+            max_new_tokens=token_budget(settings, estimated),
+            stop_on_repetition=settings["stop_on_repetition"],
+            on_text=listener,
+            text_interval=text_interval,
+            cache_prefix=OCR_PREFIX_CACHE,
+        ))
+    return SCHEDULER.submit_many(jobs)
+
+def _ocr_text(future: Future) -> str:
+    """Wait for a submitted page and clean up the raw model output."""
+    output = future.result()
+    extracted = _extract_actual_text(output.text)
+    log.debug("Generated %d/%d tokens (%.1f tok/s, stopped on %s), %d chars after cleanup",
+              output.tokens, output.budget, output.tokens_per_second, output.stop_reason, len(extracted))
     return extracted
 
+def _generation_report(future: Future, profile: str) -> dict:
+    """Per-page generation stats reported with each OCRed page."""
+    return {"profile": profile, **future.result().summary()}
+
+def _preview(job: str | None, page_num: int, thumbnail: bytes | None) -> str | None:
+    """Store a page's thumbnail under the job and return its URL; None when previews are off."""
+    if job is None or thumbnail is None:
+        return None
+    return PREVIEW_STORE.put(job, page_num, thumbnail)
+
+def model_version() -> str:
+    """Hash of the configured model and the settings that change its output."""
+    return settings_digest(
+        model=MODEL_CONFIG.model_path,
+        loader=MODEL_CONFIG.loader,
+        dtype=MODEL_CONFIG.dtype,
+        quantize=MODEL_CONFIG.quantize,
+    )
+
+def _cache_settings(prompt: str, profile: str) -> str:
+    """Everything besides the page pixels that affects a cached page result."""
+    return settings_digest(
+        model=MODEL_CONFIG.model_path,
+        loader=MODEL_CONFIG.loader,
+        dtype=MODEL_CONFIG.dtype,
+        quantize=MODEL_CONFIG.quantize,
+        min_pixels=MODEL_CONFIG.min_pixels,
+        prompt=prompt,
+        profile=profile,
+        generation=get_profile(profile)[1],
+        render_pixels=_render_pixels(),
+        resolution=vars(_resolution_policy()) if _resolution_policy() else "fixed",
+        thumbnail="jpeg",
+    )
+
+def _render_settings(prompt: str, profile: str) -> tuple[str, int, ResolutionPolicy | None]:
+    """A request's cache settings, render pixel cap and resolution policy.
+
+    These read the processor, which the first call loads (or waits for while
+    warm-up loads it), so async code runs this in an executor.
+    """
+    return _cache_settings(prompt, profile), _render_pixels(), _resolution_policy()
+
+def _cached_pages(file_hash: str, settings: str, job: str | None) -> dict[int, dict]:
+    """Page results already cached for this exact file, keyed by page number."""
+    if OCR_CACHE is None:
+        return {}
+    return {
+        page: {"page": page, "text": hit["text"], "error": None,
+               "preview": _preview(job, page, hit["thumbnail"]), "cached": True, "route": "cache"}
+        for page, hit in OCR_CACHE.lookup_file(file_hash, settings).items()
+    }
+
+def _cached_page(page_num: int, image_hash: str, settings: str, job: str | None) -> dict | None:
+    """Cached result for a rendered page image, if any."""
+    if OCR_CACHE is None:
+        return None
+    hit = OCR_CACHE.get(image_hash, settings)
+    if hit is None:
+        return None
+    return {"page": page_num, "text": hit["text"], "error": None,
+            "preview": _preview(job, page_num, hit["thumbnail"]), "cached": True, "route": "cache"}
+
+def _store_results(results: list[dict], hashes: dict[int, str], thumbnails: dict[int, bytes | None],
+                   file_hash: str | None, settings: str):
+    """Cache successfully OCRed pages together with their thumbnails."""
+    if OCR_CACHE is None:
+        return
+    for result in results:
+        if result["error"] is None and result["page"] in hashes:
+            OCR_CACHE.put(file_hash, result["page"], hashes[result["page"]], settings,
+                          result["text"], thumbnails.get(result["page"]))
+
+def _page_result(page_num: int, thumbnail: bytes | None, future: Future, profile: str,
+                 job: str | None) -> dict:
+    """Turn a page's scheduler future into a page result with text, preview and generation stats."""
+    try:
+        txt, error = _ocr_text(future), None
+        generation = _generation_report(future, profile)
+    except Exception as e:
+        log.warning("Error processing page %d: %s", page_num, e)
+        txt, error, generation = "", str(e), None
+    return {
+        "page": page_num,
+        "text": txt,
+        "error": error,
+        "preview": _preview(job, page_num, thumbnail) if error is None else None,
+        "cached": False,
+        "route": "vision",
+        "generation": generation
+    }
+
+def _text_layer_result(page_num: int, text: str, thumbnail: bytes | None, job: str | None) -> dict:
+    """Page result served straight from the PDF's embedded text layer."""
+    return {"page": page_num, "text": text, "error": None, "preview": _preview(job, page_num, thumbnail),
+            "cached": False, "route": "text_layer"}
+
+# A page queued for OCR: (page_num, image, estimated_chars, thumbnail)
+OCRPage = tuple[int, Image.Image, int | None, bytes | None]
+
+def _trace_batch(batch: list[OCRPage], futures: list[Future], started: float, generated: float,
+                 finished: float):
+    """Add an OCR batch to the request's trace: the generate call on the model track and
+    each page's OCR and postprocessing on its own track."""
+    trace = tracing.current()
+    if trace is None:
+        return
+    outputs = [future.result() for future in futures if future.exception() is None]
+    args = {"pages": [page_num for page_num, _, _, _ in batch]}
+    if outputs:
+        # The scheduler reports the batch's own tokenize and generate time; what
+        # comes before is queueing behind other requests' batches
+        generate_start = max(started, generated - outputs[0].seconds)
+        tokenize_start = max(started, generate_start - outputs[0].tokenize_seconds)
+        trace.span("queue", "model", started, tokenize_start, **args)
+        trace.span("tokenize", "model", tokenize_start, generate_start, **args)
+        trace.span("generate", "model", generate_start, generated,
+                   tokens=sum(output.tokens for output in outputs),
+                   prefix_tokens=sum(output.prefix_tokens for output in outputs), **args)
+    for (page_num, _, _, _), future in zip(batch, futures):
+        output = future.result() if future.exception() is None else None
+        trace.span("ocr", f"page {page_num}", started, generated,
+                   **({"tokens": output.tokens, "stop_reason": output.stop_reason} if output
+                      else {"error": str(future.exception())}))
+        trace.span("postprocess", f"page {page_num}", generated, finished)
+
+def _trace_render(trace: tracing.Trace, page: dict):
+    """Add a streamed page's render stages to the trace.
+
+    They were timed in a render worker, so they are laid out back to back
+    ending when the page was ready, then its wait for the model.
+    """
+    track = f"page {page['page']}"
+    end = page["ready_at"]
+    for stage in ("preview", "preprocess", "render", "route"):
+        ms = page["timings"].get(f"{stage}_ms")
+        if ms is not None:
+            trace.span(stage, track, end - ms / 1000, end)
+            end -= ms / 1000
+    trace.span("queue_wait", track, page["ready_at"],
+               page["ready_at"] + page["timings"].get("queue_wait_ms", 0.0) / 1000, route=page["route"])
+
+def _ocr_page_batch(batch: list[OCRPage], prompt: str, profile: str, job: str | None) -> list[dict]:
+    """OCR a group of pages and return per-page results in page order.
+
+    The scheduler retries a failed batch job by job, so an error on one page
+    only marks that page as failed.
+    """
+    started = time.perf_counter()
+    futures = _submit_ocr([img for _, img, _, _ in batch], prompt, profile, [est for _, _, est, _ in batch])
+    wait(futures)
+    generated = time.perf_counter()
+    results = [_page_result(page_num, thumb, future, profile, job)
+               for (page_num, _, _, thumb), future in zip(batch, futures)]
+    finished = time.perf_counter()
+    _trace_batch(batch, futures, started, generated, finished)
+    for result in results:
+        result["timings"] = {
+            "ocr_ms": round(1000 * (generated - started), 1),
+            "postprocess_ms": round(1000 * (finished - generated), 1),
+        }
+    return results
+
+async def _ocr_page_batch_async(batch: list[OCRPage], prompt: str, profile: str,
+                                job: str | None, on_results=None, on_delta=None,
+                                delta_interval: float = OCR_STREAM_INTERVAL_MS / 1000) -> list[dict]:
+    """Like _ocr_page_batch, but awaits the scheduler instead of blocking the event loop.
+
+    ``on_results`` is called with the page results in the render pool, e.g. to
+    write them to the cache without touching the event loop. ``on_delta`` is
+    called on the event loop with (page_num, text chunk) while pages generate.
+    """
+    listeners = None
+    if on_delta is not None:
+        loop = asyncio.get_running_loop()
+        listeners = [
+            (lambda text, page_num=page_num: loop.call_soon_threadsafe(on_delta, page_num, text))
+            for page_num, _, _, _ in batch
+        ]
+
+    started = time.perf_counter()
+    futures = _submit_ocr([img for _, img, _, _ in batch], prompt, profile, [est for _, _, est, _ in batch],
+                          listeners, delta_interval)
+    await asyncio.wait([asyncio.wrap_future(future) for future in futures])
+    generated = time.perf_counter()
+
+    # Output cleanup, preview writes and cache writes are CPU/IO work; keep them off the loop too
+    def finish():
+        results = [_page_result(page_num, thumb, future, profile, job)
+                   for (page_num, _, _, thumb), future in zip(batch, futures)]
+        if on_results:
+            on_results(results)
+        return results
+
+    results = await run_in_render_pool(finish)
+    finished = time.perf_counter()
+    _trace_batch(batch, futures, started, generated, finished)
+    for result in results:
+        result["timings"] = {
+            "ocr_ms": 1000 * (generated - started),
+            "postprocess_ms": 1000 * (finished - generated),
+        }
+    return results
+
 # ENHANCED: Streaming OCR for real-time results - FORCED for all PDF sizes
-async def stream_ocr_bytes(buf: bytes) -> AsyncGenerator[dict, None]:
-    """Stream OCR results page by page for real-time processing - OPTIMIZED for ALL PDF sizes."""
+async def stream_ocr_bytes(buf: bytes, profile: str | None = None, stream_tokens: bool = False,
+                           stream_interval_ms: float | None = None,
+                           previews: bool = True) -> AsyncGenerator[dict, None]:
+    """Stream OCR results page by page for real-time processing - OPTIMIZED for ALL PDF sizes.
+
+    ``profile`` names a generation profile (None for the default); an unknown
+    name raises ValueError before anything is processed.
+
+    With ``stream_tokens`` PDF pages that go through the model also emit
+    ``page_delta`` events between their ``page_start`` and ``page_complete``,
+    each carrying the raw text generated since the previous delta, at most
+    every ``stream_interval_ms`` (default OCR_STREAM_INTERVAL_MS). The cleaned
+    text in ``page_complete`` is authoritative and replaces the deltas.
+
+    Each page's ``preview`` is the URL of its thumbnail in the preview store,
+    or None with ``previews`` off.
+    """
+    profile, _ = get_profile(profile)
     if _is_pdf(buf):
-        async for result in _stream_pdf(buf):
+        async for result in _stream_pdf(buf, profile, _delta_interval(stream_tokens, stream_interval_ms),
+                                        previews=previews):
             yield result
     else:
-        result = _run_single_image(buf)
+        result = await run_in_document_pool(_run_single_image, buf, profile, previews)
         yield result
 
-async def _stream_pdf(buf: bytes) -> AsyncGenerator[dict, None]:
-    """Stream PDF pages one by one - OPTIMIZED for ALL PDF sizes with FORCED real-time processing."""
-    if PDF2IMAGE:
-        print("[INFO] FORCED real-time streaming PDF with pdf2image (page-by-page mode)")
-        
-        try:
-            # ENHANCED: Get total page count first WITHOUT loading all pages
-            from PyPDF2 import PdfReader
-            reader = PdfReader(BytesIO(buf))
-            total_pages = len(reader.pages)
-            print(f"[STREAM] FORCED processing {total_pages} pages individually (no batching)")
-            
-            # CRITICAL: Process pages one by one WITHOUT loading all in memory
-            for page_num in range(1, total_pages + 1):
-                try:
-                    # Yield page start notification IMMEDIATELY
-                    yield {
-                        "type": "page_start",
-                        "page": page_num,
-                        "total_pages": total_pages,
-                        "status": "processing"
-                    }
-                    print(f"[STREAM] Starting page {page_num}/{total_pages}")
-                    
-                    # Convert SINGLE page (memory efficient - no bulk loading)
-                    images = convert_from_bytes(
-                        buf, 
-                        dpi=300, 
-                        first_page=page_num, 
-                        last_page=page_num  # Process ONLY this page
-                    )
-                    
-                    if images:
-                        img = images[0]  # Should be only one image
-                        txt = _run_ocr_on_image(img, _get_enhanced_prompt("document"))
-                        
-                        # Generate preview image
-                        preview_img = img.copy()
-                        preview_img.thumbnail((400, 600), Image.LANCZOS)
-                        preview_buffer = BytesIO()
-                        preview_img.save(preview_buffer, format='JPEG', quality=85)
-                        preview_b64 = base64.b64encode(preview_buffer.getvalue()).decode('utf-8')
-                        preview_url = f"data:image/jpeg;base64,{preview_b64}"
-                        
-                        # Yield completed page result IMMEDIATELY - NO BUFFERING
-                        yield {
-                            "type": "page_complete",
-                            "page": page_num,
-                            "text": txt,
-                            "error": None,
-                            "total_pages": total_pages,
-                            "status": "completed",
-                            "preview": preview_url
-                        }
-                        
-                        print(f"[STREAM] Page {page_num}/{total_pages} completed and IMMEDIATELY streamed")
-                    
-                except Exception as e:
-                    print(f"[STREAM] Error processing page {page_num}: {e}")
-                    yield {
-                        "type": "page_complete",
-                        "page": page_num,
-                        "text": "",
-                        "error": str(e),
-                        "total_pages": total_pages,
-                        "status": "error",
-                        "preview": None
-                    }
-            
-            # Send final completion signal
-            yield {
-                "type": "processing_complete",
-                "status": "finished",
-                "total_pages": total_pages
-            }
-            print(f"[STREAM] FORCED real-time processing completed for all {total_pages} pages")
-            
-        except Exception as e:
-            print(f"[STREAM] PDF processing error: {e}")
-            yield {
-                "type": "error",
-                "error": str(e)
-            }
+async def stream_ocr_file(path: str, profile: str | None = None, stream_tokens: bool = False,
+                          stream_interval_ms: float | None = None, file_hash: str | None = None,
+                          previews: bool = True, skip_pages: set[int] | None = None,
+                          preview_job: str | None = None) -> AsyncGenerator[dict, None]:
+    """stream_ocr_bytes for a file already on disk (e.g. a chunked upload).
+
+    PDFs are rendered straight from ``path`` and never read into memory as a
+    whole; ``file_hash`` (its sha256, if already known) saves a pass over the
+    file for the cache lookup. PDF pages in ``skip_pages`` (e.g. finished
+    before a restart) are neither processed nor reported. Thumbnails go under
+    ``preview_job`` in the preview store if given, else under a new job id.
+    The caller owns and removes the file.
+    """
+    profile, _ = get_profile(profile)
+    with open(path, "rb") as fh:
+        head = fh.read(4)
+    if _is_pdf(head):
+        async for result in _stream_pdf(path, profile, _delta_interval(stream_tokens, stream_interval_ms),
+                                        file_hash=file_hash, previews=previews, skip_pages=skip_pages,
+                                        preview_job=preview_job):
+            yield result
     else:
-        # Fallback implementation for systems without pdf2image
-        print("[INFO] FORCED real-time streaming with fallback renderer")
-        stream = BytesIO(buf)
-        total = len(PdfReader(stream).pages)
-        
-        for idx in range(1, total + 1):
-            try:
+        result = await run_in_document_pool(_run_single_image, path, profile, previews, preview_job)
+        yield result
+
+def _delta_interval(stream_tokens: bool, stream_interval_ms: float | None) -> float | None:
+    """Seconds between page_delta events, or None when token streaming is off."""
+    if not stream_tokens:
+        return None
+    return (OCR_STREAM_INTERVAL_MS if stream_interval_ms is None else stream_interval_ms) / 1000
+
+async def _deltas_until_done(deltas: asyncio.Queue, task: asyncio.Future):
+    """Yield queued items as they arrive until ``task`` is done and the queue is drained."""
+    while True:
+        getter = asyncio.ensure_future(deltas.get())
+        done, _ = await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+        if getter in done:
+            yield getter.result()
+            continue
+        getter.cancel()
+        while not deltas.empty():
+            yield deltas.get_nowait()
+        return
+
+async def _stream_pdf(source: bytes | str, profile: str, delta_interval: float | None = None,
+                      file_hash: str | None = None, previews: bool = True,
+                      skip_pages: set[int] | None = None,
+                      preview_job: str | None = None) -> AsyncGenerator[dict, None]:
+    """Stream PDF pages through the render -> OCR pipeline, emitting results in page order.
+
+    Upcoming pages are rendered and preprocessed in worker processes while the
+    model works on the current batch. Each page_complete event carries the
+    page's per-stage timings and processing_complete carries the totals. With a
+    ``delta_interval`` (seconds) OCRed pages also stream page_delta events and
+    report their time to first text as ``first_text_ms``. ``source`` is the
+    PDF's bytes or its path on disk. Thumbnails are encoded by the render
+    workers and written to the preview store under ``preview_job``, or a new
+    job id for this request.
+    Pages in ``skip_pages`` are passed over without a page_start/page_complete.
+    When the request is traced (see tracing.py) every page's stages go on the
+    trace and processing_complete carries its id.
+    """
+    log.info("Streaming PDF with %s (batch size %d, pipeline depth %d, profile %s)",
+             RENDER_BACKEND, OCR_BATCH_SIZE, OCR_PIPELINE_DEPTH, profile)
+    trace = tracing.current()
+    prompt = _get_enhanced_prompt("document")
+
+    settings, render_pixels, policy = await run_in_render_pool(_render_settings, prompt, profile)
+    if file_hash is None:
+        digest = path_digest if isinstance(source, str) else file_digest
+        file_hash = await run_in_render_pool(digest, source)
+    job = (preview_job or await run_in_render_pool(PREVIEW_STORE.new_job)) if previews else None
+    cached = await run_in_render_pool(_cached_pages, file_hash, settings, job)
+    if cached:
+        log.debug("%d pages answered from the cache", len(cached))
+
+    hashes = {}
+    thumbnails = {}
+
+    def store(results: list[dict]):
+        _store_results(results, hashes, thumbnails, file_hash, settings)
+
+    def cache_hit(page: dict) -> dict | None:
+        # Looked up once per page; pages carried over to the next batch keep their answer
+        if "hit" not in page:
+            if page["route"] == "cache":
+                page["hit"] = cached[page["page"]]
+            elif page["route"] == "vision" and OCR_CACHE is not None:
+                page["hit"] = _cached_page(page["page"], page["image_hash"], settings, job)
+            else:
+                page["hit"] = None
+        return page["hit"]
+
+    # Thumbnails are still made with previews off if the cache is on, so
+    # cached pages have one for later requests
+    skip_pages = skip_pages or set()
+    pipeline = PagePipeline(source, OCR_PIPELINE_DEPTH, RENDER_PROCESS_POOL, render_pixels,
+                            skip_pages=set(cached) | skip_pages, text_layer=OCR_TEXT_LAYER,
+                            thumbnails=previews or OCR_CACHE is not None, policy=policy)
+    try:
+        total_pages = await pipeline.start()
+    except Exception as e:
+        log.warning("PDF processing error: %s", e)
+        metrics.ERRORS.inc(stage="render")
+        await pipeline.close()
+        yield {
+            "type": "error",
+            "error": str(e)
+        }
+        return
+    log.debug("Processing %d pages", total_pages)
+
+    stage_totals = {"route_ms": 0.0, "render_ms": 0.0, "preprocess_ms": 0.0, "preview_ms": 0.0,
+                    "queue_wait_ms": 0.0, "ocr_ms": 0.0, "postprocess_ms": 0.0}
+    routes = {"vision": 0, "text_layer": 0, "cache": 0}
+    generation_totals = {"tokens": 0, "prefix_tokens": 0,
+                         "stop_reasons": {"eos": 0, "budget": 0, "repetition": 0}}
+    resolution_totals = {"vision_tokens": 0, "reasons": {}}
+    first_text = []
+
+    def completed(result: dict, timings: dict, resolution: dict | None = None,
+                  failed: str | None = None) -> dict:
+        metrics.observe_page(result.get("route"), timings, resolution, failed)
+        for stage, ms in timings.items():
+            if stage in stage_totals:
+                stage_totals[stage] += ms
+        if "first_text_ms" in timings:
+            first_text.append(timings["first_text_ms"])
+        if result.get("route") in routes:
+            routes[result["route"]] += 1
+        if result.get("generation"):
+            generation_totals["tokens"] += result["generation"]["tokens"]
+            generation_totals["prefix_tokens"] += result["generation"].get("prefix_tokens", 0)
+            generation_totals["stop_reasons"][result["generation"]["stop_reason"]] += 1
+        if resolution and result.get("route") == "vision":
+            resolution_totals["vision_tokens"] += resolution["tokens"]
+            reasons = resolution_totals["reasons"]
+            reasons[resolution["reason"]] = reasons.get(resolution["reason"], 0) + 1
+        return {
+            "type": "page_complete",
+            "page": result["page"],
+            "text": result["text"],
+            "error": result["error"],
+            "total_pages": total_pages,
+            "status": "error" if result["error"] else "completed",
+            "preview": result["preview"],
+            "cached": result.get("cached", False),
+            "route": result.get("route"),
+            "generation": result.get("generation"),
+            "resolution": resolution if result.get("route") == "vision" else None,
+            "timings": {stage: round(ms, 1) for stage, ms in timings.items()}
+        }
+
+    try:
+        carry = None
+        while True:
+            page = carry or await pipeline.next_page()
+            carry = None
+            if page is None:
+                break
+            if page["page"] in skip_pages:
+                pipeline.release()
+                continue
+
+            # Batch whatever compatible pages are already rendered, without
+            # waiting on the renderer for more
+            batch = [page]
+            needs_ocr = page["route"] == "vision" and cache_hit(page) is None
+            while needs_ocr and len(batch) < OCR_BATCH_SIZE:
+                upcoming = pipeline.next_page_nowait()
+                if upcoming is None:
+                    break
+                if (upcoming["route"] != "vision" or cache_hit(upcoming) is not None
+                        or not _can_batch(page["image"], upcoming["image"])):
+                    carry = upcoming
+                    break
+                batch.append(upcoming)
+
+            for item in batch:
                 yield {
                     "type": "page_start",
-                    "page": idx,
-                    "total_pages": total,
+                    "page": item["page"],
+                    "total_pages": total_pages,
                     "status": "processing"
                 }
-                
-                stream.seek(0)
-                b64 = render_pdf_to_base64png(stream, page_number=idx, resolution=1800)
-                img = Image.open(BytesIO(base64.b64decode(b64)))
-                txt = _run_ocr_on_image(img, _get_enhanced_prompt("document"))
-                
-                yield {
-                    "type": "page_complete",
-                    "page": idx,
-                    "text": txt,
-                    "error": None,
-                    "total_pages": total,
-                    "status": "completed"
-                }
-                print(f"[STREAM] Fallback: Page {idx}/{total} completed and streamed")
-                
-            except Exception as e:
-                yield {
-                    "type": "page_complete",
-                    "page": idx,
-                    "text": "",
-                    "error": str(e),
-                    "total_pages": total,
-                    "status": "error"
-                }
-        
-        # Send final completion signal
-        yield {
-            "type": "processing_complete",
-            "status": "finished",
-            "total_pages": total
-        }
+
+            if page["error"]:
+                results = [{"page": page["page"], "text": "", "error": page["error"], "preview": None}]
+            elif page["route"] == "text_layer":
+                results = [await run_in_render_pool(
+                    _text_layer_result, page["page"], page["text"], page["thumbnail"], job
+                )]
+            elif not needs_ocr:
+                results = [cache_hit(page)]
+            else:
+                hashes.update({item["page"]: item["image_hash"] for item in batch})
+                thumbnails.update({item["page"]: item["thumbnail"] for item in batch})
+                ocr_batch = [(item["page"], item["image"], item["estimated_chars"], item["thumbnail"])
+                             for item in batch]
+                if delta_interval is None:
+                    results = await _ocr_page_batch_async(ocr_batch, prompt, profile, job, on_results=store)
+                else:
+                    deltas = asyncio.Queue()
+                    started = time.perf_counter()
+                    first_delta = {}
+                    task = asyncio.ensure_future(_ocr_page_batch_async(
+                        ocr_batch, prompt, profile, job, on_results=store,
+                        on_delta=lambda page_num, text: deltas.put_nowait((page_num, text)),
+                        delta_interval=delta_interval,
+                    ))
+                    try:
+                        async for page_num, text in _deltas_until_done(deltas, task):
+                            first_delta.setdefault(page_num, 1000 * (time.perf_counter() - started))
+                            yield {
+                                "type": "page_delta",
+                                "page": page_num,
+                                "text": text,
+                                "total_pages": total_pages
+                            }
+                        results = await task
+                    finally:
+                        task.cancel()
+                    for result in results:
+                        if result["page"] in first_delta:
+                            result["timings"]["first_text_ms"] = first_delta[result["page"]]
+
+            for item, result in zip(batch, results):
+                if trace is not None:
+                    _trace_render(trace, item)
+                failed = ("render" if item["error"] else "page") if result["error"] else None
+                yield completed(result, {**item["timings"], **result.get("timings", {})},
+                                item.get("resolution"), failed)
+            pipeline.release(len(batch))
+    finally:
+        await pipeline.close()
+
+    # Rendering runs in parallel workers, so compare per-worker render time with model time
+    render_workers = max(1, RENDER_PROCESSES or RENDER_WORKERS)
+    render_busy = (stage_totals["render_ms"] + stage_totals["preprocess_ms"]
+                   + stage_totals["preview_ms"]) / render_workers
+    bottleneck = "render" if render_busy > stage_totals["ocr_ms"] else "ocr"
+    ocr_seconds = stage_totals["ocr_ms"] / 1000
+    generation_totals["tokens_per_second"] = (
+        round(generation_totals["tokens"] / ocr_seconds, 1) if ocr_seconds else 0.0
+    )
+    log.info("Processed %d pages - stage totals (ms): %s - bottleneck: %s - routes: %s - generation: %s",
+             total_pages, stage_totals, bottleneck, routes, generation_totals)
+
+    # Send final completion signal
+    yield {
+        "type": "processing_complete",
+        "status": "finished",
+        "total_pages": total_pages,
+        "stage_totals_ms": {stage: round(ms, 1) for stage, ms in stage_totals.items()},
+        "bottleneck": bottleneck,
+        "routes": routes,
+        "avg_first_text_ms": round(sum(first_text) / len(first_text), 1) if first_text else None,
+        "profile": profile,
+        "generation": generation_totals,
+        "resolution": resolution_totals,
+        "job": job,
+        "trace": trace.id if trace is not None else None
+    }
 
 # Legacy compatibility functions
-def run_ocr_bytes(buf: bytes) -> dict:
+def run_ocr_bytes(buf: bytes, profile: str | None = None, previews: bool = True) -> dict:
     """Standard OCR for backward compatibility."""
+    profile, _ = get_profile(profile)
     if _is_pdf(buf):
-        return _run_pdf(buf)
-    return _run_single_image(buf)
+        return _run_pdf(buf, profile, previews)
+    return _run_single_image(buf, profile, previews)
 
-def extract_text_from_pdf(path: str, lang: str | None = None) -> dict:
+def extract_text_from_pdf(path: str, lang: str | None = None, profile: str | None = None,
+                          previews: bool = True) -> dict:
+    """OCR a PDF or image file on disk without reading it into memory as a whole."""
+    profile, _ = get_profile(profile)
     with open(path, "rb") as fh:
-        data = fh.read()
-    print(f"[OCR] processing {path}")
-    return run_ocr_bytes(data)
-
-def _run_pdf(buf: bytes) -> dict:
-    """Enhanced PDF processing with image previews."""
-    pages = []
-    if PDF2IMAGE:
-        print("[INFO] Enhanced pdf2image processing with previews")
-        images = convert_from_bytes(buf, dpi=300)  # Higher DPI
-        total = len(images)
-        for idx, img in enumerate(images, 1):
-            try:
-                txt = _run_ocr_on_image(img, _get_enhanced_prompt("document"))
-                
-                # Generate preview image (smaller version for UI)
-                preview_img = img.copy()
-                preview_img.thumbnail((400, 600), Image.LANCZOS)
-                preview_buffer = BytesIO()
-                preview_img.save(preview_buffer, format='JPEG', quality=85)
-                preview_b64 = base64.b64encode(preview_buffer.getvalue()).decode('utf-8')
-                preview_url = f"data:image/jpeg;base64,{preview_b64}"
-                
-                pages.append({
-                    "page": idx,
-                    "text": txt,
-                    "error": None,
-                    "preview": preview_url
-                })
-            except Exception as e:
-                pages.append({
-                    "page": idx,
-                    "text": "",
-                    "error": str(e),
-                    "preview": None
-                })
-    else:
-        print("[INFO] Enhanced fallback processing with previews")
-        stream = BytesIO(buf)
-        total = len(PdfReader(stream).pages)
-        for idx in range(1, total + 1):
-            try:
-                stream.seek(0)
-                b64 = render_pdf_to_base64png(stream, page_number=idx, resolution=1800)
-                img = Image.open(BytesIO(base64.b64decode(b64)))
-                txt = _run_ocr_on_image(img, _get_enhanced_prompt("document"))
-                
-                # Generate preview (reuse the rendered image but make it smaller)
-                preview_img = img.copy()
-                preview_img.thumbnail((400, 600), Image.LANCZOS)
-                preview_buffer = BytesIO()
-                preview_img.save(preview_buffer, format='JPEG', quality=85)
-                preview_b64 = base64.b64encode(preview_buffer.getvalue()).decode('utf-8')
-                preview_url = f"data:image/jpeg;base64,{preview_b64}"
-                
-                pages.append({
-                    "page": idx,
-                    "text": txt,
-                    "error": None,
-                    "preview": preview_url
-                })
-            except Exception as e:
-                pages.append({
-                    "page": idx,
-                    "text": "",
-                    "error": str(e),
-                    "preview": None
-                })
-    
+        head = fh.read(4)
+    log.debug("Processing %s", path)
+    if _is_pdf(head):
+        return _run_pdf(path, profile, previews)
+    return _run_single_image(path, profile, previews)
+
+def _source_digest(source: bytes | str) -> str:
+    """Cache key of a document given as bytes or as a path on disk."""
+    return path_digest(source) if isinstance(source, str) else file_digest(source)
+
+def _run_pdf(source: bytes | str, profile: str, previews: bool = True) -> dict:
+    """Enhanced PDF processing with image previews, OCRing pages in batches.
+
+    ``source`` is the PDF's bytes or its path. Pages are rendered one at a
+    time as they are needed, so at most one batch of page images is in memory.
+    """
+    log.info("Processing PDF with %s (profile %s)", RENDER_BACKEND, profile)
+    trace = tracing.current()
+    prompt = _get_enhanced_prompt("document")
+    settings = _cache_settings(prompt, profile)
+    file_hash = _source_digest(source)
+    job = PREVIEW_STORE.new_job() if previews else None
+    thumbnail = previews or OCR_CACHE is not None
+    cached = _cached_pages(file_hash, settings, job)
+    pages = list(cached.values())
+    batch = []
+    hashes = {}
+    thumbnails = {}
+    timings = {}
+    resolutions = {}
+
+    def flush():
+        results = _ocr_page_batch(batch, prompt, profile, job)
+        _store_results(results, hashes, thumbnails, file_hash, settings)
+        for result in results:
+            rendering = timings.pop(result["page"], {})
+            result["timings"] = {**{stage: round(ms, 1) for stage, ms in rendering.items()}, **result["timings"]}
+        pages.extend(results)
+        batch.clear()
+
+    # The document is parsed once; pages are rendered one at a time as needed
+    with PdfDocument(source) as doc:
+        for idx in range(1, doc.page_count + 1):
+            if idx in cached:
+                continue
+            score = None
+            if OCR_TEXT_LAYER:
+                text, score = route_page(doc, idx)
+                if text is not None:
+                    thumb = make_thumbnail(doc.render(idx, dpi=None, max_pixels=PREVIEW_PIXELS)) if previews else None
+                    pages.append(_text_layer_result(idx, text, thumb, job))
+                    continue
+            started = time.perf_counter()
+            img, resolutions[idx] = render_page(doc, idx, _render_pixels(), _resolution_policy())
+            rendered = time.perf_counter()
+            img = preprocess_image(img)
+            hashes[idx] = image_digest(img)
+            preprocessed = time.perf_counter()
+            if trace is not None:
+                trace.span("render", f"page {idx}", started, rendered)
+                trace.span("preprocess", f"page {idx}", rendered, preprocessed)
+            hit = _cached_page(idx, hashes[idx], settings, job)
+            if hit is not None:
+                pages.append(hit)
+                continue
+            if batch and (len(batch) >= OCR_BATCH_SIZE or not _can_batch(batch[0][1], img)):
+                flush()
+            thumbnails[idx] = make_thumbnail(img) if thumbnail else None
+            timings[idx] = {"render_ms": 1000 * (rendered - started),
+                            "preprocess_ms": 1000 * (preprocessed - rendered),
+                            "preview_ms": 1000 * (time.perf_counter() - preprocessed)}
+            batch.append((idx, img, estimate_chars(img, score["chars"] if score else 0), thumbnails[idx]))
+    if batch:
+        flush()
+
+    pages.sort(key=lambda page: page["page"])
+    for page in pages:
+        metrics.observe_page(page.get("route"), page.get("timings", {}), resolutions.get(page["page"]),
+                             "page" if page["error"] else None)
     return {"success": True, "pages": pages, "total_pages": len(pages), "error": None}
 
-def _run_single_image(buf: bytes) -> dict:
-    """Enhanced single image processing with preview."""
+def _run_single_image(source: bytes | str, profile: str, previews: bool = True,
+                      preview_job: str | None = None) -> dict:
+    """Enhanced single image processing with preview; ``source`` is the image's bytes or path."""
+    prompt = _get_enhanced_prompt("image")
+    settings = _cache_settings(prompt, profile)
+    file_hash = _source_digest(source)
+    job = (preview_job or PREVIEW_STORE.new_job()) if previews else None
+    cached = _cached_pages(file_hash, settings, job)
+    if 1 in cached:
+        metrics.observe_page("cache", {})
+        return {"success": True, "pages": [cached[1]], "total_pages": 1, "error": None}
+
     try:
-        img = Image.open(BytesIO(buf))
+        img = Image.open(source if isinstance(source, str) else BytesIO(source))
     except Exception as e:
         return {"success": False, "pages": [], "total_pages": 0,
                 "error": f"Cannot open image: {e}"}
 
-    txt = _run_ocr_on_image(img, _get_enhanced_prompt("image"))
-    
-    # Generate preview image
-    preview_img = img.copy()
-    preview_img.thumbnail((400, 600), Image.LANCZOS)
-    preview_buffer = BytesIO()
-    preview_img.save(preview_buffer, format='JPEG', quality=85)
-    preview_b64 = base64.b64encode(preview_buffer.getvalue()).decode('utf-8')
-    preview_url = f"data:image/jpeg;base64,{preview_b64}"
-    
+    img, resolution = fit_image(img, _render_pixels(), _resolution_policy())
+    thumb = make_thumbnail(img) if previews or OCR_CACHE is not None else None
+    page = _ocr_page_batch([(1, img, None, thumb)], prompt, profile, job)[0]
+    metrics.observe_page(page["route"], page["timings"], resolution, "page" if page["error"] else None)
+    if page["error"] is not None:
+        return {"success": False, "pages": [page], "total_pages": 1, "error": page["error"]}
+    _store_results([page], {1: image_digest(img)}, {1: thumb}, file_hash, settings)
+
     return {
         "success": True,
-        "pages": [{"page": 1, "text": txt, "error": None, "preview": preview_url}],
+        "pages": [page],
         "total_pages": 1,
         "error": None,
     }
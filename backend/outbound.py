@@ -0,0 +1,144 @@
+# outbound.py - per-connection outbound message queue for WebSocket streaming
+import asyncio, json, time
+
+from fastapi import WebSocket
+
+import metrics, tracing
+
+# msgpack is optional; without it clients are only offered JSON
+try:
+    import msgpack
+    MSGPACK = True
+except ImportError:
+    MSGPACK = False
+
+# WebSocket subprotocols, in the server's order of preference. A client lists
+# the ones it understands in Sec-WebSocket-Protocol when it connects.
+SUBPROTOCOLS = {"ocr.msgpack": "msgpack", "ocr.json": "json"}
+
+_CLOSE = object()  # queued by close() after the last event
+
+def decode_message(message: dict, encoding: str) -> dict:
+    """Decode a received client message: a JSON text frame, or a msgpack binary frame."""
+    if message.get("text") is not None:
+        return json.loads(message["text"])
+    if encoding == "msgpack" and message.get("bytes") is not None:
+        return msgpack.unpackb(message["bytes"], raw=False)
+    raise ValueError("Expected a JSON text frame")
+
+def negotiate_encoding(websocket: WebSocket) -> tuple[str | None, str]:
+    """Pick the subprotocol to accept and the message encoding it implies.
+
+    Clients that do not ask for a subprotocol get plain JSON text frames, as
+    before.
+    """
+    offered = websocket.scope.get("subprotocols") or []
+    for subprotocol, encoding in SUBPROTOCOLS.items():
+        if subprotocol in offered and (encoding != "msgpack" or MSGPACK):
+            return subprotocol, encoding
+    return None, "json"
+
+class MessageSender:
+    """Sends a connection's events in order from a single writer task.
+
+    ``send`` only queues an event, so producers never wait on the network
+    unless the queue is full: at ``max_queue`` pending events ``send`` blocks,
+    which pushes back on the OCR stream when the client reads slowly. With
+    ``coalesce`` consecutive queued page_delta events for the same page go out
+    as one message. Events are encoded as JSON text frames or, for the
+    ``msgpack`` encoding, as binary frames. Each send is timed into the
+    websocket_send_seconds metric and onto the request's trace, if any.
+    """
+
+    def __init__(self, websocket: WebSocket, encoding: str = "json", max_queue: int = 64,
+                 coalesce: bool = True):
+        self.websocket = websocket
+        self.encoding = encoding
+        self.coalesce = coalesce
+        self.sent = 0
+        self.coalesced = 0
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, max_queue))
+        self._writer: asyncio.Task | None = None
+        self._held = None
+        self._trace = tracing.current()
+
+    def start(self):
+        self._writer = asyncio.create_task(self._write())
+
+    async def send(self, event: dict):
+        """Queue an event; waits while the queue is full. Raises once the writer has failed."""
+        await self._put(event)
+
+    async def close(self, flush: bool = True):
+        """Stop the writer, after sending everything queued if ``flush``."""
+        if self._writer is None:
+            return
+        if flush and not self._writer.done():
+            await self._put(_CLOSE)
+            await asyncio.shield(self._writer)
+        else:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except (asyncio.CancelledError, Exception):
+                pass
+
+    async def _put(self, item):
+        # Waiting on the writer as well means a dead connection cannot leave us
+        # blocked on a full queue forever
+        if not self._writer.done():
+            put = asyncio.ensure_future(self._queue.put(item))
+            try:
+                await asyncio.wait({put, self._writer}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                # A send cancelled while waiting (or outlived by the writer)
+                # must not leave its event to be sent later
+                queued = put.done()
+                if not queued:
+                    put.cancel()
+            if queued:
+                return
+        if not self._writer.cancelled():
+            self._writer.result()  # re-raise the send error (e.g. disconnect)
+        raise RuntimeError("Message sender is closed")
+
+    async def _next(self):
+        if self._held is not None:
+            event, self._held = self._held, None
+            return event
+        return await self._queue.get()
+
+    async def _write(self):
+        while True:
+            event = await self._next()
+            if event is _CLOSE:
+                return
+            if self.coalesce and event.get("type") == "page_delta":
+                event = self._merge_deltas(event)
+            started = time.perf_counter()
+            await self._send_frame(event)
+            sent = time.perf_counter()
+            metrics.WEBSOCKET_SEND_SECONDS.observe(sent - started, type=event.get("type", "unknown"))
+            if self._trace is not None:
+                self._trace.span(event.get("type", "unknown"), "websocket", started, sent,
+                                 **({"page": event["page"]} if "page" in event else {}))
+            self.sent += 1
+
+    def _merge_deltas(self, event: dict) -> dict:
+        # Only merges what is already waiting; never delays a message
+        while not self._queue.empty():
+            upcoming = self._queue.get_nowait()
+            if upcoming is not _CLOSE and upcoming.get("type") == "page_delta" \
+                    and upcoming["page"] == event["page"]:
+                event = {**event, "text": event["text"] + upcoming["text"]}
+                self.coalesced += 1
+                continue
+            self._held = upcoming
+            break
+        return event
+
+    async def _send_frame(self, event: dict):
+        if self.encoding == "msgpack":
+            await self.websocket.send_bytes(msgpack.packb(event, use_bin_type=True))
+        else:
+            await self.websocket.send_text(json.dumps(event))
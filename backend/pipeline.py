@@ -0,0 +1,359 @@
+# pipeline.py - bounded render -> preprocess -> OCR pipeline for streaming PDFs
+#
+# Nothing in this module touches the model, so its stage functions can run in
+# spawned worker processes without loading any weights.
+import asyncio, io, logging, os, tempfile, time
+from collections import deque
+
+from PIL import Image
+
+from local_proc.anchor import clean_text_layer, score_text_layer
+from local_proc.renderpdf import close_pdf, open_pdf
+from ocr_cache import image_digest
+
+log = logging.getLogger("ocr.pipeline")
+
+def preprocess_image(img: Image.Image, max_pixels: int | None = None) -> Image.Image:
+    """RGB conversion, plus a downscale for images larger than ``max_pixels``.
+
+    Images are never upscaled here: the processor already enlarges anything
+    below its min_pixels, and enlarging further only adds vision tokens.
+    """
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    width, height = img.size
+    if max_pixels and width * height > max_pixels * 1.05:
+        scale = (max_pixels / (width * height)) ** 0.5
+        img = img.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+    return img
+
+# Qwen2-VL turns every 14px patch into a vision token and merges them 2x2, so
+# each 28x28 block of the image costs one token of prefill (ocr_olm passes the
+# loaded processor's own sizes to ResolutionPolicy)
+VISION_PATCH_SIZE = 14
+VISION_MERGE_SIZE = 2
+TOKEN_PIXELS = (VISION_PATCH_SIZE * VISION_MERGE_SIZE) ** 2
+
+def vision_tokens(img: Image.Image) -> int:
+    """Approximate number of vision tokens the processor will produce for an image."""
+    width, height = img.size
+    block = VISION_PATCH_SIZE * VISION_MERGE_SIZE
+    return max(1, round(width / block)) * max(1, round(height / block))
+
+def text_line_height(gray: Image.Image) -> float | None:
+    """Median height in pixels of the bands of ink running across the page (its text lines).
+
+    None when the page has too few lines to say, e.g. a photo or a blank page.
+    """
+    width, height = gray.size
+    ink = gray.point(lambda v: 255 if v < 200 else 0)
+    rows = list(ink.resize((1, height), Image.BOX).getdata())
+    runs, run = [], 0
+    for value in rows:
+        if value > 2:  # at least ~1% of the row is ink
+            run += 1
+        elif run:
+            runs.append(run)
+            run = 0
+    if run:
+        runs.append(run)
+    runs = sorted(r for r in runs if r > 1)
+    if len(runs) < 3:
+        return None
+    return float(runs[len(runs) // 2])
+
+class ResolutionPolicy:
+    """Chooses how many pixels (and so vision tokens) each page gets.
+
+    A page first gets ``base_tokens`` worth of pixels. Pages dense with ink
+    get ``dense_tokens``, and pages whose text lines come out shorter than
+    ``min_line_px`` get enough pixels to bring them up to it, up to
+    ``max_tokens``. Rendering never goes above ``max_dpi``.
+    """
+
+    def __init__(self, base_tokens: int = 2000, dense_tokens: int = 3000, max_tokens: int = 5000,
+                 min_line_px: float = 16.0, dense_ink: float = 0.1, max_dpi: float = 300,
+                 token_pixels: int = TOKEN_PIXELS):
+        self.base_tokens = base_tokens
+        self.dense_tokens = max(dense_tokens, base_tokens)
+        self.max_tokens = max(max_tokens, self.dense_tokens)
+        self.min_line_px = min_line_px
+        self.dense_ink = dense_ink
+        self.max_dpi = max_dpi
+        self.token_pixels = token_pixels
+
+    def assess(self, img: Image.Image) -> tuple[int, str]:
+        """Vision tokens this page should get, and why, judged from a render of it."""
+        gray = img.convert("L")
+        width, height = gray.size
+        ink = sum(gray.histogram()[:200]) / max(1, width * height)
+        tokens, reason = self.base_tokens, "base"
+        if ink >= self.dense_ink:
+            tokens, reason = self.dense_tokens, "dense"
+        line = text_line_height(gray)
+        if line is not None and line < self.min_line_px:
+            # Pixel count grows with the square of the linear scale
+            needed = int(width * height * (self.min_line_px / line) ** 2 / self.token_pixels)
+            if needed > tokens:
+                tokens, reason = min(needed, self.max_tokens), "small_text"
+        return tokens, reason
+
+def render_page(doc, page_num: int, max_pixels: int | None = None,
+                policy: ResolutionPolicy | None = None) -> tuple[Image.Image, dict]:
+    """Render a page at the resolution it needs; returns the image and how it was sized.
+
+    Without a policy every page is rendered at 300 DPI (or the DPI that fits
+    ``max_pixels``). With one the page is rendered straight at the policy's
+    base budget and only rendered again, larger, when it turns out to be
+    dense or set in small type.
+    """
+    if policy is None:
+        img = doc.render(page_num, dpi=300, max_pixels=max_pixels)
+        return img, {"reason": "fixed", "tokens": vision_tokens(img)}
+
+    cap = max_pixels or float("inf")
+    def budget(tokens: int) -> int:
+        return int(min(tokens * policy.token_pixels, cap))
+
+    img = doc.render(page_num, dpi=policy.max_dpi, max_pixels=budget(policy.base_tokens))
+    tokens, reason = policy.assess(img)
+    if budget(tokens) > img.size[0] * img.size[1] * 1.1:
+        img = doc.render(page_num, dpi=policy.max_dpi, max_pixels=budget(tokens))
+    return img, {"reason": reason, "tokens": vision_tokens(img)}
+
+def fit_image(img: Image.Image, max_pixels: int | None = None,
+              policy: ResolutionPolicy | None = None) -> tuple[Image.Image, dict]:
+    """``render_page`` for an uploaded image: it can only be scaled down, never up."""
+    img = preprocess_image(img, max_pixels)
+    if policy is not None:
+        tokens, reason = policy.assess(img)
+        img = preprocess_image(img, tokens * policy.token_pixels)
+    else:
+        reason = "fixed"
+    return img, {"reason": reason, "tokens": vision_tokens(img)}
+
+# Share of non-background pixels on a densely typed page (at thumbnail size),
+# and roughly how many characters such a page holds
+DENSE_PAGE_INK = 0.2
+DENSE_PAGE_CHARS = 4000
+
+def estimate_chars(img: Image.Image, text_layer_chars: int = 0) -> int:
+    """Rough character count of a page image from its ink coverage.
+
+    Only used to size the page's token budget, so it errs on the high side;
+    an (untrusted) text layer's character count is taken if it is larger.
+    """
+    gray = img.convert("L")
+    gray.thumbnail((512, 512))
+    ink = sum(gray.histogram()[:200]) / max(1, gray.size[0] * gray.size[1])
+    return max(int(ink / DENSE_PAGE_INK * DENSE_PAGE_CHARS), text_layer_chars)
+
+# Page thumbnails shown by the UI
+THUMBNAIL_SIZE = (400, 600)
+
+def make_thumbnail(img: Image.Image) -> bytes:
+    """JPEG thumbnail of a page, sized for the UI."""
+    thumb = img.copy()
+    thumb.thumbnail(THUMBNAIL_SIZE, Image.LANCZOS)
+    buf = io.BytesIO()
+    thumb.convert("RGB").save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+def page_count_stage(path: str) -> int:
+    """Open the PDF at ``path`` in this worker and return its page count."""
+    with open_pdf(path) as doc:
+        return doc.page_count
+
+# Pages served from their text layer only need an image for the UI thumbnail
+PREVIEW_PIXELS = 400 * 600
+
+def route_page(doc, page_num: int) -> tuple[str | None, dict]:
+    """Score a page's embedded text layer; return its cleaned text if it can replace OCR."""
+    text, image_fraction = doc.text_layer(page_num)
+    width, height = doc.page_size(page_num)
+    score = score_text_layer(text, width, height, image_fraction)
+    return (clean_text_layer(text) if score["trusted"] else None), score
+
+def render_stage(path: str, page_num: int, max_pixels: int | None = None,
+                 text_layer: bool = False, thumbnail: bool = True,
+                 policy: ResolutionPolicy | None = None) -> dict:
+    """Route, render and preprocess one (1-based) page of the PDF at ``path``.
+
+    Runs in a render worker, which keeps the parsed document open between
+    pages. With ``text_layer`` the page's embedded text is scored first; a
+    trustworthy page takes the ``text_layer`` route and is only rendered at
+    thumbnail size, if at all. Otherwise the page takes the ``vision`` route:
+    it is rendered at the resolution ``policy`` picks for it (see
+    ``render_page``; ``resolution`` says how it was sized), never above
+    ``max_pixels``, preprocessed, hashed (the OCR cache key) and its amount
+    of text estimated (``estimated_chars``, for the token budget). With
+    ``thumbnail`` the page's UI thumbnail is encoded here too, as JPEG bytes
+    (timed as ``preview_ms``).
+    """
+    started = time.perf_counter()
+    with open_pdf(path) as doc:
+        return _render_stage(doc, page_num, max_pixels, text_layer, thumbnail, policy, started)
+
+def _render_stage(doc, page_num: int, max_pixels: int | None, text_layer: bool, thumbnail: bool,
+                  policy: ResolutionPolicy | None, started: float) -> dict:
+    text, score = route_page(doc, page_num) if text_layer else (None, None)
+    routed = time.perf_counter()
+
+    if text is not None:
+        preview = doc.render(page_num, dpi=None, max_pixels=PREVIEW_PIXELS) if thumbnail else None
+        rendered = time.perf_counter()
+        thumb = make_thumbnail(preview) if preview is not None else None
+        encoded = time.perf_counter()
+        return {"route": "text_layer", "text": text, "text_layer": score, "thumbnail": thumb,
+                "image": None, "image_hash": None, "estimated_chars": None, "resolution": None,
+                "timings": {"route_ms": 1000 * (routed - started),
+                            "render_ms": 1000 * (rendered - routed),
+                            "preview_ms": 1000 * (encoded - rendered)}}
+
+    img, resolution = render_page(doc, page_num, max_pixels, policy)
+    rendered = time.perf_counter()
+    img = preprocess_image(img)
+    digest = image_digest(img)
+    estimated = estimate_chars(img, score["chars"] if score else 0)
+    preprocessed = time.perf_counter()
+    thumb = make_thumbnail(img) if thumbnail else None
+    encoded = time.perf_counter()
+    return {"route": "vision", "text": None, "text_layer": score, "thumbnail": thumb,
+            "image": img, "image_hash": digest, "estimated_chars": estimated, "resolution": resolution,
+            "timings": {"route_ms": 1000 * (routed - started),
+                        "render_ms": 1000 * (rendered - routed),
+                        "preprocess_ms": 1000 * (preprocessed - rendered),
+                        "preview_ms": 1000 * (encoded - preprocessed)}}
+
+class PagePipeline:
+    """Renders upcoming pages in a worker pool while the model works on earlier ones.
+
+    Pages are handed out strictly in page order. At most ``depth`` pages are in
+    flight at once (submitted for rendering, rendered and waiting, or being
+    OCRed); the consumer returns slots with ``release`` once a page's result has
+    been emitted, which is what caps memory on very long documents.
+
+    Each page is a dict with ``page`` and ``error`` plus the fields returned by
+    ``render_stage`` (``route``, ``text``, ``image``, ``thumbnail``,
+    ``image_hash``, ``estimated_chars``, ``resolution``, ``timings``) and
+    ``ready_at``, the perf_counter time its render finished; ``queue_wait_ms``
+    is added to the timings when the page is handed out. Pages listed in
+    ``skip_pages`` (already known from the result cache) are handed out in
+    order without being rendered, with the ``cache`` route and no image.
+
+    ``source`` is the PDF's bytes or the path of a PDF already on disk; a
+    path is used as is and left in place on close.
+    """
+
+    def __init__(self, source: bytes | str, depth: int, executor, max_pixels: int | None = None,
+                 skip_pages: set[int] | None = None, text_layer: bool = False,
+                 thumbnails: bool = True, policy: ResolutionPolicy | None = None):
+        self.total_pages = 0
+        self.depth = max(1, depth)
+        self.executor = executor
+        self.max_pixels = max_pixels
+        self.skip_pages = skip_pages or set()
+        self.text_layer = text_layer
+        self.thumbnails = thumbnails
+        self.policy = policy
+        self._buf = None if isinstance(source, str) else source
+        self._path = source if isinstance(source, str) else None
+        self._owns_path = self._buf is not None
+        self._slots = asyncio.Semaphore(self.depth)
+        self._pages: deque[asyncio.Future] = deque()
+        self._changed = asyncio.Event()
+        self._submitted_all = False
+        self._producer = None
+
+    async def start(self) -> int:
+        """Spool the document to disk if needed, start rendering and return the page count."""
+        # Workers open the document from disk (once per worker) instead of
+        # receiving a pickled copy of the whole file with every page
+        if self._buf is not None:
+            fd, self._path = tempfile.mkstemp(suffix=".pdf", prefix="ocr_pipeline_")
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(self._buf)
+            self._buf = None
+
+        loop = asyncio.get_running_loop()
+        self.total_pages = await loop.run_in_executor(self.executor, page_count_stage, self._path)
+        self._producer = asyncio.create_task(self._produce())
+        return self.total_pages
+
+    async def close(self):
+        if self._producer is not None:
+            self._producer.cancel()
+            try:
+                await self._producer
+            except asyncio.CancelledError:
+                pass
+        for fut in self._pages:
+            fut.cancel()
+        if self._path:
+            # Each render worker keeps the document open; ask every one of them
+            # to close it. A worker that misses this drops it on its next
+            # render once the file is gone (see open_pdf).
+            loop = asyncio.get_running_loop()
+            try:
+                for _ in range(getattr(self.executor, "_max_workers", 1)):
+                    loop.run_in_executor(self.executor, close_pdf, self._path)
+            except RuntimeError:
+                pass  # the pool is shutting down
+        if self._path and self._owns_path:
+            try:
+                os.remove(self._path)
+            except OSError:
+                pass
+
+    async def _produce(self):
+        for page_num in range(1, self.total_pages + 1):
+            await self._slots.acquire()
+            self._pages.append(asyncio.ensure_future(self._render(page_num)))
+            self._changed.set()
+        self._submitted_all = True
+        self._changed.set()
+
+    async def _render(self, page_num: int) -> dict:
+        loop = asyncio.get_running_loop()
+        if page_num in self.skip_pages:
+            page = {"page": page_num, "error": None, "route": "cache", "text": None,
+                    "image": None, "thumbnail": None, "image_hash": None, "estimated_chars": None,
+                    "resolution": None, "timings": {}}
+        else:
+            try:
+                stage = await loop.run_in_executor(
+                    self.executor, render_stage, self._path, page_num, self.max_pixels,
+                    self.text_layer, self.thumbnails, self.policy
+                )
+                page = {"page": page_num, "error": None, **stage}
+            except Exception as e:
+                log.warning("Error rendering page %d: %s", page_num, e)
+                page = {"page": page_num, "error": str(e), "route": None, "text": None,
+                        "image": None, "thumbnail": None, "image_hash": None, "estimated_chars": None,
+                        "resolution": None, "timings": {}}
+        page["ready_at"] = time.perf_counter()
+        return page
+
+    def _handout(self, page: dict) -> dict:
+        page["timings"]["queue_wait_ms"] = 1000 * (time.perf_counter() - page["ready_at"])
+        return page
+
+    async def next_page(self) -> dict | None:
+        """Wait for the next page in order; None once every page has been handed out."""
+        while not self._pages:
+            if self._submitted_all:
+                return None
+            self._changed.clear()
+            await self._changed.wait()
+        return self._handout(await self._pages.popleft())
+
+    def next_page_nowait(self) -> dict | None:
+        """The next page if it has already been rendered, otherwise None."""
+        if self._pages and self._pages[0].done():
+            return self._handout(self._pages.popleft().result())
+        return None
+
+    def release(self, count: int = 1):
+        """Return in-flight slots for pages whose results have been emitted."""
+        for _ in range(count):
+            self._slots.release()
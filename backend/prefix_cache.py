@@ -0,0 +1,227 @@
+# prefix_cache.py - reuse the KV cache of a prompt prefix shared by many requests
+#
+# Every OCR page starts with the same chat-template header and instruction
+# text, ahead of its image. The keys and values for those tokens do not
+# depend on the page, so they are computed once and copied into each batch
+# instead of being prefilled again for every page. Likewise the analyses of
+# one document share the document text and differ only in the instruction
+# after it.
+import inspect, logging, threading
+from collections import OrderedDict
+
+import torch
+from transformers import DynamicCache
+
+log = logging.getLogger("ocr.prefix_cache")
+
+def set_rope_deltas(model, rope_deltas: torch.Tensor):
+    """Set the offset Qwen2-VL adds to cached positions when it decodes past a cache."""
+    for owner in (model, getattr(model, "model", None)):
+        if owner is not None and hasattr(owner, "rope_deltas"):
+            owner.rope_deltas = rope_deltas
+
+def rope_index(model, input_ids: torch.Tensor, image_grid_thw: torch.Tensor | None,
+               attention_mask: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+    """Qwen2-VL's rotary positions of a prompt and its rope deltas.
+
+    transformers 5 takes each token's modality as ``mm_token_type_ids`` (1 for
+    image tokens, 0 for text) ahead of the image grid; transformers 4 takes
+    the grid alone.
+    """
+    get_rope_index = getattr(model, "get_rope_index", None) or model.model.get_rope_index
+    if "mm_token_type_ids" not in inspect.signature(get_rope_index).parameters:
+        return get_rope_index(input_ids, image_grid_thw, None, attention_mask)
+    mm_token_type_ids = (input_ids == model.config.image_token_id).int()
+    return get_rope_index(input_ids, mm_token_type_ids=mm_token_type_ids, image_grid_thw=image_grid_thw,
+                          attention_mask=attention_mask)
+
+def cache_layers(cache) -> list[tuple[torch.Tensor, torch.Tensor]]:
+    """(keys, values) of each layer of a KV cache; transformers 5 caches are no longer indexable."""
+    layers = getattr(cache, "layers", None)
+    if layers is not None:
+        return [(layer.keys, layer.values) for layer in layers if getattr(layer, "keys", None) is not None]
+    return [(cache[i][0], cache[i][1]) for i in range(len(cache))]
+
+def trim_cache(cache: DynamicCache, length: int):
+    """Keep the first ``length`` tokens of a KV cache.
+
+    ``crop`` is given the number of tokens to remove, as a negative count:
+    transformers 4 and 5 both read it that way, while a positive target
+    length is deprecated in 5. Nothing is cropped when nothing is in excess
+    (``crop(0)`` empties the cache in transformers 4).
+    """
+    excess = cache.get_seq_length() - length
+    if excess > 0:
+        cache.crop(-excess)
+
+def cache_nbytes(cache) -> int:
+    return sum(keys.numel() * keys.element_size() * 2 for keys, _ in cache_layers(cache))
+
+class PrefixCache:
+    """KV caches of shared prompt prefixes for one model, kept in a small LRU.
+
+    ``prefill`` runs a batch whose rows all start with the same cached
+    prefix: it copies the prefix's keys and values into a fresh cache for
+    the batch, prefills only the rest of the prompt (image included), and
+    returns the cache and position settings ``generate`` needs to continue.
+
+    This leans on Qwen2-VL internals (multimodal rotary positions are
+    computed once for the whole prompt and stored on the model as
+    ``rope_deltas``). If a transformers release changes them the first
+    failure disables the cache, and batches are prefilled in full as before.
+    """
+
+    MIN_PREFIX_TOKENS = 16
+
+    def __init__(self, model, max_entries: int = 4):
+        self.model = model
+        self.max_entries = max(1, max_entries)
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[tuple, list[tuple[torch.Tensor, torch.Tensor]]] = OrderedDict()
+        self._boundary = getattr(model.config, "vision_start_token_id", None)
+
+    def prefix_length(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> int:
+        """Length of the prefix all rows share, up to their first image; 0 if unusable.
+
+        Rows may be left-padded: the prefix is compared on each row's own
+        tokens, which start at position 0 whatever the padding.
+        """
+        if not self.enabled:
+            return 0
+        rows = []
+        for ids, mask in zip(input_ids, attention_mask):
+            pad = int((mask == 0).sum())
+            if not bool(mask[pad:].all()):
+                return 0  # padded on the right or in the middle
+            rows.append(ids[pad:])
+        # At least one token of every row is left for the forward pass
+        limit = min(min(len(row) for row in rows) - 1, input_ids.shape[1] - 2)
+        if self._boundary is not None:
+            starts = (rows[0] == self._boundary).nonzero()
+            if len(starts):
+                limit = min(limit, int(starts[0]))
+        if limit < self.MIN_PREFIX_TOKENS:
+            return 0
+        same = torch.ones(limit, dtype=torch.bool, device=input_ids.device)
+        for row in rows[1:]:
+            same &= row[:limit] == rows[0][:limit]
+        length = limit if bool(same.all()) else int((~same).nonzero()[0])
+        return length if length >= self.MIN_PREFIX_TOKENS else 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = len(self._entries)
+        return {"enabled": self.enabled, "entries": entries, "hits": self.hits,
+                "misses": self.misses, "prefill_tokens_saved": self.tokens_saved}
+
+    def _layers(self, prefix_ids: torch.Tensor) -> list[tuple[torch.Tensor, torch.Tensor]]:
+        key = tuple(prefix_ids.tolist())
+        with self._lock:
+            layers = self._entries.get(key)
+            if layers is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return layers
+        output = self.model(input_ids=prefix_ids[None], use_cache=True)
+        layers = [(keys.detach(), values.detach()) for keys, values in cache_layers(output.past_key_values)]
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = layers
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return layers
+
+    def prefill(self, inputs: dict, prefix_len: int) -> DynamicCache:
+        """Fill a cache with every prompt token but the last; ``generate`` takes it from there.
+
+        ``prefix_len`` comes from ``prefix_length``; rows may be left-padded.
+
+        Call under ``torch.no_grad()``. Afterwards pass the full ``input_ids``
+        and ``attention_mask`` with ``past_key_values`` set to the returned
+        cache, and no image inputs: the image is already in the cache.
+        """
+        input_ids = inputs["input_ids"]
+        batch, length = input_ids.shape
+        pads = (inputs["attention_mask"] == 0).sum(dim=1).tolist()
+        cache = DynamicCache()
+        # The cache covers the first prefix_len columns. A row with p pad
+        # columns has only its first prefix_len - p prefix tokens there; the
+        # rest of its prefix is prefilled with its suffix below.
+        longest = pads.index(min(pads))
+        prefix_ids = input_ids[longest, pads[longest]:pads[longest] + prefix_len]
+        for layer, (keys, values) in enumerate(self._layers(prefix_ids)):
+            if not any(pads):
+                cache.update(keys.expand(batch, *keys.shape[1:]).contiguous(),
+                             values.expand(batch, *values.shape[1:]).contiguous(), layer)
+                continue
+            row_keys = keys.new_zeros(batch, *keys.shape[1:])
+            row_values = values.new_zeros(batch, *values.shape[1:])
+            for row, pad in enumerate(pads):
+                if pad < prefix_len:
+                    row_keys[row, :, pad:] = keys[0, :, :prefix_len - pad]
+                    row_values[row, :, pad:] = values[0, :, :prefix_len - pad]
+            cache.update(row_keys, row_values, layer)
+
+        # Rotary positions of the whole prompt, including the image's 3D ones
+        position_ids, rope_deltas = rope_index(
+            self.model, input_ids, inputs.get("image_grid_thw"), inputs["attention_mask"])
+        self.model(
+            input_ids=input_ids[:, prefix_len:length - 1],
+            attention_mask=inputs["attention_mask"][:, :length - 1],
+            position_ids=position_ids[..., prefix_len:length - 1],
+            pixel_values=inputs.get("pixel_values"),
+            image_grid_thw=inputs.get("image_grid_thw"),
+            past_key_values=cache,
+            cache_position=torch.arange(prefix_len, length - 1, device=input_ids.device),
+            use_cache=True,
+        )
+        # Decoding continues from these deltas instead of recomputing them
+        # from a prompt whose image it no longer sees
+        set_rope_deltas(self.model, rope_deltas)
+        with self._lock:
+            self.tokens_saved += sum(max(0, prefix_len - pad) for pad in pads)
+        return cache
+
+    def disable(self, error: Exception):
+        log.warning("Prefix cache disabled after an error (%s); prefilling prompts in full", error)
+        self.enabled = False
+        with self._lock:
+            self._entries.clear()
+
+class ConversationCache:
+    """The KV cache of one conversation's prompt so far, carried from turn to turn.
+
+    Chat prompts only grow at the end (history plus a new message), so the
+    tokens of the previous turn's prompt are a prefix of the next one and
+    their keys and values are reused; only the new tokens are prefilled. The
+    cache is trimmed back to the prompt after each turn, since the reply
+    comes back re-tokenized from its text in the next prompt.
+
+    ``lock`` is held while the scheduler uses the cache; ``drop`` frees it
+    (under memory pressure) and the next turn prefills in full.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids: list[int] = []
+        self.cache: DynamicCache | None = None
+        self.nbytes = 0
+
+    def reusable(self, input_ids: list[int]) -> int:
+        """How many leading tokens of ``input_ids`` the cache already covers (at least one is left to run)."""
+        if self.cache is None:
+            return 0
+        limit = min(len(self.ids), len(input_ids) - 1)
+        n = 0
+        while n < limit and self.ids[n] == input_ids[n]:
+            n += 1
+        return n
+
+    def drop(self) -> int:
+        """Free the cached keys and values; returns the bytes released."""
+        freed, self.cache, self.ids, self.nbytes = self.nbytes, None, [], 0
+        return freed
@@ -0,0 +1,82 @@
+# preview_store.py - page thumbnails written once and served by URL
+import os, re, shutil, threading, time, uuid
+
+_JOB_ID = re.compile(r"^[0-9a-f]{32}$")
+_KEEP = ".keep"  # marker file of a job exempt from the TTL
+
+class PreviewStore:
+    """JPEG page thumbnails on disk, grouped by job.
+
+    Each OCR request gets a job id; its thumbnails are written once to
+    ``<root>/<job>/<page>.jpg`` and served by ``GET /preview/{job}/{page}``
+    instead of being inlined into every response as base64. A thumbnail never
+    changes once written, so its ETag (size and mtime) is stable. Jobs older
+    than ``ttl`` seconds are removed, except those marked with ``keep``, which
+    stay until ``remove`` is called (e.g. the previews of a queued /jobs job,
+    kept as long as the job itself).
+    """
+
+    def __init__(self, root: str, ttl: float):
+        self.root = root
+        self.ttl = ttl
+        self.writes = 0
+        self._lock = threading.Lock()
+        self._last_cleanup = 0.0
+        os.makedirs(root, exist_ok=True)
+
+    def new_job(self) -> str:
+        self._maybe_cleanup()
+        return uuid.uuid4().hex
+
+    def keep(self, job: str):
+        """Exempt a job's thumbnails from the TTL until ``remove(job)``."""
+        job_dir = os.path.join(self.root, job)
+        os.makedirs(job_dir, exist_ok=True)
+        open(os.path.join(job_dir, _KEEP), "wb").close()
+
+    def remove(self, job: str):
+        """Delete a job's thumbnails."""
+        if _JOB_ID.match(job):
+            shutil.rmtree(os.path.join(self.root, job), ignore_errors=True)
+
+    def url(self, job: str, page: int) -> str:
+        return f"/preview/{job}/{page}"
+
+    def put(self, job: str, page: int, data: bytes) -> str:
+        """Write a page's thumbnail and return the URL it is served from."""
+        job_dir = os.path.join(self.root, job)
+        os.makedirs(job_dir, exist_ok=True)
+        path = os.path.join(job_dir, f"{page}.jpg")
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp, path)
+        self.writes += 1
+        return self.url(job, page)
+
+    def get(self, job: str, page: int) -> tuple[bytes, str] | None:
+        """A thumbnail's bytes and ETag, or None if unknown or expired."""
+        if not _JOB_ID.match(job):
+            return None
+        path = os.path.join(self.root, job, f"{int(page)}.jpg")
+        try:
+            st = os.stat(path)
+            with open(path, "rb") as fh:
+                data = fh.read()
+        except OSError:
+            return None
+        return data, f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+    def _maybe_cleanup(self):
+        now = time.time()
+        with self._lock:
+            if now - self._last_cleanup < min(self.ttl, 300):
+                return
+            self._last_cleanup = now
+        for entry in os.scandir(self.root):
+            try:
+                if (entry.is_dir() and now - entry.stat().st_mtime > self.ttl
+                        and not os.path.exists(os.path.join(entry.path, _KEEP))):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            except OSError:
+                pass
@@ -0,0 +1,162 @@
+# retrieval.py - page-aware chunking and BM25 search over OCR output
+#
+# The chat and analysis endpoints get a document's whole extracted text but
+# can only put a few thousand characters in front of the model. Instead of
+# truncating, the text is split into chunks that never cross a page and the
+# chunks relevant to the question are picked with an in-process BM25 index.
+import hashlib, math, re, threading
+from collections import Counter, OrderedDict
+
+# The frontend joins pages as "Page 3 (scan.pdf):\n<text>" with "\n\n---\n\n"
+_PAGE_HEADER = re.compile(r"^Page (\d+)(?: \([^\n]*\))?:\n", re.MULTILINE)
+_PAGE_SEPARATOR = "\n\n---\n\n"
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN.findall(text.lower())
+
+class Chunk:
+    """A piece of one page's text; ``page`` is None when the text has no page markers."""
+
+    def __init__(self, index: int, page: int | None, text: str):
+        self.index = index
+        self.page = page
+        self.text = text
+
+    def label(self) -> str:
+        return f"[Page {self.page}]" if self.page is not None else f"[Part {self.index + 1}]"
+
+def split_pages(text: str) -> list[tuple[int | None, str]]:
+    """The document's pages as (page number, text); one unnumbered page if unmarked."""
+    pages = []
+    for part in text.split(_PAGE_SEPARATOR):
+        match = _PAGE_HEADER.match(part)
+        if match:
+            pages.append((int(match.group(1)), part[match.end():]))
+        elif part.strip():
+            pages.append((None, part))
+    return pages or [(None, text)]
+
+def _pieces(text: str, max_chars: int) -> list[str]:
+    """Split text at paragraph, then line, then word boundaries into pieces of at most max_chars."""
+    if len(text) <= max_chars:
+        return [text]
+    for separator in ("\n\n", "\n", " "):
+        parts = text.split(separator)
+        if len(parts) > 1:
+            pieces, current = [], ""
+            for part in parts:
+                candidate = f"{current}{separator}{part}" if current else part
+                if len(candidate) <= max_chars:
+                    current = candidate
+                    continue
+                if current:
+                    pieces.append(current)
+                if len(part) > max_chars:
+                    pieces.extend(_pieces(part, max_chars))
+                    current = ""
+                else:
+                    current = part
+            if current:
+                pieces.append(current)
+            return pieces
+    return [text[i:i + max_chars] for i in range(0, len(text), max_chars)]
+
+def chunk_document(text: str, chunk_chars: int = 1000) -> list[Chunk]:
+    """Split extracted text into chunks of up to ``chunk_chars`` that never span two pages."""
+    chunks = []
+    for page, page_text in split_pages(text):
+        for piece in _pieces(page_text.strip(), chunk_chars):
+            if piece.strip():
+                chunks.append(Chunk(len(chunks), page, piece.strip()))
+    return chunks
+
+class BM25Index:
+    """Okapi BM25 over a document's chunks."""
+
+    def __init__(self, chunks: list[Chunk], k1: float = 1.5, b: float = 0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self._freqs = [Counter(tokenize(chunk.text)) for chunk in chunks]
+        self._lengths = [sum(freqs.values()) for freqs in self._freqs]
+        self._avg_length = (sum(self._lengths) / len(self._lengths)) if chunks else 0.0
+        df = Counter(term for freqs in self._freqs for term in freqs)
+        n = len(chunks)
+        self._idf = {term: math.log(1 + (n - count + 0.5) / (count + 0.5)) for term, count in df.items()}
+
+    def search(self, query: str, k: int = 5) -> list[tuple[float, Chunk]]:
+        """The ``k`` best-scoring chunks for the query, best first; chunks sharing no term are left out."""
+        terms = set(tokenize(query)) & self._idf.keys()
+        scored = []
+        for chunk, freqs, length in zip(self.chunks, self._freqs, self._lengths):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * length / (self._avg_length or 1))
+            for term in terms:
+                tf = freqs.get(term)
+                if tf:
+                    score += self._idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            if score > 0:
+                scored.append((score, chunk))
+        scored.sort(key=lambda item: (-item[0], item[1].index))
+        return scored[:k]
+
+class IndexCache:
+    """Recently built indexes by document text, so each chat turn does not re-chunk the document."""
+
+    def __init__(self, max_entries: int = 32, chunk_chars: int = 1000):
+        self.max_entries = max(1, max_entries)
+        self.chunk_chars = chunk_chars
+        self._lock = threading.Lock()
+        self._indexes: OrderedDict[str, BM25Index] = OrderedDict()
+
+    def get(self, text: str) -> BM25Index:
+        key = hashlib.sha256(text.encode("utf-8", "surrogatepass")).hexdigest()
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None:
+                self._indexes.move_to_end(key)
+                return index
+        index = BM25Index(chunk_document(text, self.chunk_chars))
+        with self._lock:
+            self._indexes[key] = index
+            while len(self._indexes) > self.max_entries:
+                self._indexes.popitem(last=False)
+        return index
+
+def select_context(index: BM25Index, query: str, max_chars: int, k: int = 8) -> list[Chunk]:
+    """Top-ranked chunks that fit in ``max_chars``, returned in document order.
+
+    When nothing matches the query (e.g. "summarize this") the document's
+    opening chunks are used instead.
+    """
+    ranked = [chunk for _, chunk in index.search(query, k)] or index.chunks[:k]
+    chosen, used = [], 0
+    for chunk in ranked:
+        if used + len(chunk.text) > max_chars:
+            continue
+        chosen.append(chunk)
+        used += len(chunk.text)
+    return sorted(chosen, key=lambda chunk: chunk.index)
+
+def format_chunks(chunks: list[Chunk]) -> str:
+    return "\n\n".join(f"{chunk.label()}\n{chunk.text}" for chunk in chunks)
+
+def group_chunks(chunks: list[Chunk], max_chars: int) -> list[list[Chunk]]:
+    """Consecutive chunks packed into groups of at most ``max_chars`` (for map-reduce)."""
+    groups, current, used = [], [], 0
+    for chunk in chunks:
+        if current and used + len(chunk.text) > max_chars:
+            groups.append(current)
+            current, used = [], 0
+        current.append(chunk)
+        used += len(chunk.text)
+    if current:
+        groups.append(current)
+    return groups
+
+def page_span(chunks: list[Chunk]) -> str:
+    pages = sorted({chunk.page for chunk in chunks if chunk.page is not None})
+    if not pages:
+        return ""
+    return f"page {pages[0]}" if len(pages) == 1 else f"pages {pages[0]}-{pages[-1]}"
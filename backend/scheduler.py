@@ -0,0 +1,396 @@
+# scheduler.py - cross-request dynamic batching for the shared model
+import asyncio, logging, threading, time
+from collections import deque
+from concurrent.futures import Future
+
+import torch
+from transformers import DynamicCache, StoppingCriteriaList
+
+import metrics
+from generation import BatchTextStreamer, RepetitionStoppingCriteria, TokenBudgetStoppingCriteria
+from prefix_cache import ConversationCache, PrefixCache, cache_nbytes, set_rope_deltas, trim_cache
+
+log = logging.getLogger("ocr.scheduler")
+
+
+class GenerationJob:
+    """A single generation request: chat messages, their images and generate() settings.
+
+    Jobs with the same batch key (generation settings, text-only vs. vision, and
+    the caller's size bucket) can be run together in one generate call.
+    ``max_new_tokens`` is a per-job budget and not part of the key: jobs with
+    different budgets share a batch and each row is stopped at its own budget.
+    ``stop_on_repetition`` ends the job early if it falls into a repetition loop.
+    ``on_text``, if given, is called from the scheduler thread with chunks of
+    the raw output while it is generated, at most every ``text_interval``
+    seconds; the future still resolves with the complete output.
+    ``cache_prefix`` marks prompts that start like the other jobs they are
+    submitted with (the OCR instruction ahead of each page image, or the
+    document ahead of each analysis instruction), so that shared prefix's KV
+    cache is computed once per batch.
+    ``session_state`` is a chat session's ConversationCache: the job reuses
+    the KV cache of the session's previous prompt and leaves its own prompt's
+    cache there for the next turn. Such jobs always run alone.
+    """
+
+    def __init__(self, messages: list, images: list | None = None,
+                 gen_kwargs: dict | None = None, size_bucket: int | None = None,
+                 max_new_tokens: int | None = None, stop_on_repetition: bool = False,
+                 on_text=None, text_interval: float = 0.1, cache_prefix: bool = False,
+                 session_state: ConversationCache | None = None):
+        self.messages = messages
+        self.images = images or []
+        self.gen_kwargs = dict(gen_kwargs or {})
+        self.max_new_tokens = max_new_tokens or self.gen_kwargs.pop("max_new_tokens", 512)
+        self.gen_kwargs.pop("max_new_tokens", None)
+        self.stop_on_repetition = stop_on_repetition
+        self.on_text = on_text
+        self.text_interval = text_interval
+        self.cache_prefix = cache_prefix
+        self.session_state = session_state
+        self.size_bucket = size_bucket
+        self.batch_key = (
+            tuple(sorted(self.gen_kwargs.items())),
+            bool(self.images),
+            size_bucket,
+            cache_prefix,
+            id(self) if session_state is not None else None,
+        )
+        self.future: Future = Future()
+        self.enqueued_at = 0.0
+        self.started_at = 0.0
+
+
+class GenerationOutput:
+    """Decoded text of a finished job plus how its generation went."""
+
+    def __init__(self, text: str, tokens: int, seconds: float, stop_reason: str, budget: int,
+                 prefix_tokens: int = 0, tokenize_seconds: float = 0.0):
+        self.text = text
+        self.tokens = tokens
+        self.seconds = seconds
+        self.stop_reason = stop_reason  # "eos", "budget" or "repetition"
+        self.budget = budget
+        self.prefix_tokens = prefix_tokens  # prompt tokens served from a prefix or session cache
+        self.tokenize_seconds = tokenize_seconds  # chat template, tokenizer and image processor
+        self.queue_seconds = 0.0  # waiting in the scheduler queue, set when the job's batch starts
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.tokens / self.seconds if self.seconds > 0 else 0.0
+
+    def summary(self) -> dict:
+        return {
+            "tokens": self.tokens,
+            "budget": self.budget,
+            "seconds": round(self.seconds, 3),
+            "tokens_per_second": round(self.tokens_per_second, 1),
+            "stop_reason": self.stop_reason,
+            "prefix_tokens": self.prefix_tokens,
+            "tokenize_seconds": round(self.tokenize_seconds, 3),
+        }
+
+
+class InferenceScheduler:
+    """Owns the model/processor pair and batches compatible jobs from all callers.
+
+    Jobs are queued from any thread or coroutine. A single worker thread takes the
+    oldest job, waits up to ``max_wait_ms`` for more jobs with the same batch key
+    (up to ``max_batch_size``), runs them in one generate call and resolves each
+    job's future with a GenerationOutput (decoded text plus token stats).
+
+    Instead of a model, a ``loader`` returning ``(model, processor, device)``
+    may be given; it is called from the worker thread before the first batch,
+    and again for the next batch if it fails.
+
+    Batches of ``cache_prefix`` jobs reuse the KV cache of their shared
+    prompt prefix (see PrefixCache); ``prefix_cache_entries`` prefixes are kept.
+    """
+
+    def __init__(self, model=None, processor=None, device=None, max_batch_size: int = 8,
+                 max_wait_ms: float = 20.0, loader=None, prefix_cache_entries: int = 4):
+        if model is None and loader is None:
+            raise ValueError("InferenceScheduler needs a model or a loader")
+        self.model = None
+        self.processor = None
+        self.device = None
+        self.prefix_cache: PrefixCache | None = None
+        self.prefix_cache_entries = prefix_cache_entries
+        self._loader = loader
+        if model is not None:
+            self._set_model(model, processor, device)
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+
+        self._pending: deque[GenerationJob] = deque()
+        self._cond = threading.Condition()
+        self._worker: threading.Thread | None = None
+        self._stopped = False
+
+        self._batches = 0
+        self._jobs = 0
+        self._max_batch_seen = 0
+        self._total_wait = 0.0
+        self._max_wait_seen = 0.0
+        self._last_batch_size = 0
+        self._last_generate_ms = 0.0
+
+    # Submission
+    def submit(self, job: GenerationJob) -> Future:
+        """Queue a job and return a concurrent future for its GenerationOutput."""
+        return self.submit_many([job])[0]
+
+    def submit_many(self, jobs: list[GenerationJob]) -> list[Future]:
+        """Queue several jobs at once so they are guaranteed to be seen together."""
+        now = time.monotonic()
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Inference scheduler is stopped")
+            for job in jobs:
+                job.enqueued_at = now
+                self._pending.append(job)
+            self._ensure_worker()
+            self._cond.notify()
+        return [job.future for job in jobs]
+
+    async def generate(self, job: GenerationJob) -> GenerationOutput:
+        """Await a job's output without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(job))
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            queue_depth = len(self._pending)
+        return {
+            "queue_depth": queue_depth,
+            "batches": self._batches,
+            "jobs": self._jobs,
+            "avg_batch_size": round(self._jobs / self._batches, 2) if self._batches else 0.0,
+            "max_batch_size_seen": self._max_batch_seen,
+            "last_batch_size": self._last_batch_size,
+            "avg_wait_ms": round(1000 * self._total_wait / self._jobs, 2) if self._jobs else 0.0,
+            "max_wait_ms": round(1000 * self._max_wait_seen, 2),
+            "last_generate_ms": round(self._last_generate_ms, 2),
+            "max_batch_size": self.max_batch_size,
+            "max_wait_window_ms": round(1000 * self.max_wait, 2),
+            "prefix_cache": self.prefix_cache.stats() if self.prefix_cache else None,
+        }
+
+    # Worker
+    def _set_model(self, model, processor, device):
+        # Left padding keeps the generated tokens of every row at the same offset
+        processor.tokenizer.padding_side = "left"
+        self.model, self.processor, self.device = model, processor, device
+        if self.prefix_cache_entries:
+            self.prefix_cache = PrefixCache(model, self.prefix_cache_entries)
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(
+                target=self._worker_loop, name="inference-scheduler", daemon=True
+            )
+            self._worker.start()
+
+    def _next_batch(self) -> list[GenerationJob]:
+        with self._cond:
+            while not self._pending and not self._stopped:
+                self._cond.wait()
+            if self._stopped:
+                return []
+
+            first = self._pending[0]
+            deadline = first.enqueued_at + self.max_wait
+            while True:
+                batch = [j for j in self._pending if j.batch_key == first.batch_key]
+                batch = batch[:self.max_batch_size]
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.max_batch_size or remaining <= 0 or self._stopped:
+                    break
+                self._cond.wait(remaining)
+
+            for job in batch:
+                self._pending.remove(job)
+            return batch
+
+    def _worker_loop(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+
+            started = time.monotonic()
+            for job in batch:
+                job.started_at = started
+                wait = started - job.enqueued_at
+                self._total_wait += wait
+                self._max_wait_seen = max(self._max_wait_seen, wait)
+            self._batches += 1
+            self._jobs += len(batch)
+            self._last_batch_size = len(batch)
+            self._max_batch_seen = max(self._max_batch_seen, len(batch))
+
+            self._run_batch(batch)
+            self._last_generate_ms = 1000 * (time.monotonic() - started)
+
+    def _run_batch(self, batch: list[GenerationJob]):
+        if self.model is None:
+            try:
+                self._set_model(*self._loader())
+            except Exception as e:
+                metrics.ERRORS.inc(len(batch), stage="generation")
+                for job in batch:
+                    job.future.set_exception(e)
+                return
+        try:
+            outputs = self._generate(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                metrics.ERRORS.inc(stage="generation")
+                batch[0].future.set_exception(e)
+                return
+            log.warning("Batch of %d jobs failed (%s), retrying one by one", len(batch), e)
+            for job in batch:
+                self._run_batch([job])
+            return
+
+        for job, output in zip(batch, outputs):
+            output.queue_seconds = job.started_at - job.enqueued_at
+            metrics.observe_generation(output)
+            job.future.set_result(output)
+
+    def _generate(self, batch: list[GenerationJob]) -> list[GenerationOutput]:
+        """Run one batched generate call and return each job's output and stop reason."""
+        prepare_started = time.monotonic()
+        texts = [
+            self.processor.apply_chat_template(
+                job.messages, tokenize=False, add_generation_prompt=True
+            )
+            for job in batch
+        ]
+        images = [img for job in batch for img in job.images]
+        inputs = self.processor(
+            text=texts,
+            images=images or None,
+            padding=True,
+            return_tensors="pt",
+        ).to(self.device)
+        prompt_length = inputs["input_ids"].shape[1]
+        tokenize_seconds = time.monotonic() - prepare_started
+
+        budgets = [job.max_new_tokens for job in batch]
+        stopping = StoppingCriteriaList()
+        if len(set(budgets)) > 1:
+            stopping.append(TokenBudgetStoppingCriteria(budgets, prompt_length))
+        pad_id = self.processor.tokenizer.pad_token_id
+        eos_ids = self._eos_token_ids()
+        repetition = None
+        if any(job.stop_on_repetition for job in batch):
+            repetition = RepetitionStoppingCriteria(prompt_length, [job.stop_on_repetition for job in batch],
+                                                    end_ids=[i for i in (pad_id, *eos_ids) if i is not None])
+            stopping.append(repetition)
+
+        streamer = None
+        if any(job.on_text for job in batch):
+            streamer = BatchTextStreamer(
+                self.processor.tokenizer,
+                [job.on_text for job in batch],
+                [job.text_interval for job in batch],
+            )
+
+        generate_kwargs = dict(
+            **batch[0].gen_kwargs,
+            max_new_tokens=max(budgets),
+            stopping_criteria=stopping,
+            streamer=streamer,
+            pad_token_id=pad_id,
+        )
+        started = time.monotonic()
+        with torch.no_grad():
+            if batch[0].session_state is not None:
+                out_ids, reused = self._generate_in_session(batch[0].session_state, inputs, generate_kwargs)
+                prefix_tokens = [reused]
+            else:
+                out_ids, prefix_tokens = self._generate_with_prefix(batch, inputs, generate_kwargs)
+        seconds = time.monotonic() - started
+
+        new_ids = out_ids[:, prompt_length:]
+        decoded = self.processor.batch_decode(new_ids, skip_special_tokens=True)
+        token_counts = (new_ids != pad_id).sum(dim=1).tolist()
+        # Rows that produced EOS; padding is left out in case it shares the EOS token
+        own_eos = [i for i in eos_ids if i != pad_id]
+        ended = (torch.isin(new_ids, torch.tensor(own_eos, device=new_ids.device)).any(dim=1).tolist()
+                 if own_eos else [False] * len(batch))
+
+        outputs = []
+        for row, (text, tokens, budget, cached) in enumerate(zip(decoded, token_counts, budgets, prefix_tokens)):
+            # A row that ended on its own is reported as such, whatever ran on after it
+            if ended[row]:
+                stop_reason = "eos"
+            elif tokens >= budget:
+                stop_reason = "budget"
+            elif repetition is not None and repetition.stopped[row]:
+                stop_reason = "repetition"
+            else:
+                stop_reason = "eos"
+            outputs.append(GenerationOutput(text, tokens, seconds, stop_reason, budget, cached, tokenize_seconds))
+        return outputs
+
+    def _eos_token_ids(self) -> list[int]:
+        eos = getattr(getattr(self.model, "generation_config", None), "eos_token_id", None)
+        if eos is None:
+            eos = self.processor.tokenizer.eos_token_id
+        if eos is None:
+            return []
+        return [eos] if isinstance(eos, int) else list(eos)
+
+    def _generate_with_prefix(self, batch: list[GenerationJob], inputs, generate_kwargs: dict):
+        """Generate, reusing the cached prompt prefix of ``cache_prefix`` batches; also returns
+        how many prompt tokens of each row came from the cache."""
+        prefix_len = 0
+        model_inputs = inputs
+        if self.prefix_cache is not None and all(job.cache_prefix for job in batch):
+            prefix_len = self.prefix_cache.prefix_length(inputs["input_ids"], inputs["attention_mask"])
+        if prefix_len:
+            try:
+                cache = self.prefix_cache.prefill(inputs, prefix_len)
+                model_inputs = {"input_ids": inputs["input_ids"], "attention_mask": inputs["attention_mask"],
+                                "past_key_values": cache}
+            except Exception as e:
+                self.prefix_cache.disable(e)
+                prefix_len = 0
+        # Left-padded rows have part of the cached columns as padding
+        pads = (inputs["attention_mask"] == 0).sum(dim=1).tolist()
+        cached = [max(0, prefix_len - pad) for pad in pads]
+        return self.model.generate(**model_inputs, **generate_kwargs), cached
+
+    def _generate_in_session(self, state: ConversationCache, inputs, generate_kwargs: dict):
+        """Generate for one chat turn on top of the session's cached prompt."""
+        prompt_ids = inputs["input_ids"][0].tolist()
+        with state.lock:
+            reused = state.reusable(prompt_ids)
+            if reused:
+                trim_cache(state.cache, reused)
+                # A text-only prompt has plain 1D positions; without this the
+                # model would continue from whatever rope deltas the last
+                # (possibly vision) batch left behind
+                set_rope_deltas(self.model, torch.zeros(1, 1, dtype=torch.long, device=self.device))
+            else:
+                state.drop()
+                state.cache = DynamicCache()
+            try:
+                out_ids = self.model.generate(**inputs, past_key_values=state.cache, **generate_kwargs)
+            except Exception as e:
+                state.drop()
+                if not reused:
+                    raise
+                log.warning("Session cache failed (%s), prefilling the prompt in full", e)
+                return self.model.generate(**inputs, **generate_kwargs), 0
+            # Keep the prompt only: the reply returns re-tokenized in the next prompt
+            trim_cache(state.cache, len(prompt_ids))
+            state.ids = prompt_ids
+            state.nbytes = cache_nbytes(state.cache)
+        return out_ids, reused
@@ -1,12 +1,34 @@
 # server.py with WebSocket support for real-time processing
-from fastapi import FastAPI, File, UploadFile, Form, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, File, UploadFile, Form, Query, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-import os, traceback, uuid, pathlib, json, asyncio
+from fastapi.responses import JSONResponse, Response
+import os, uuid, pathlib, json, asyncio, hashlib, logging, tempfile, shutil, time
 import torch
 from datetime import datetime
 
-from ocr_olm import extract_text_from_pdf, stream_ocr_bytes
+import metrics, tracing
+from analysis_cache import AnalysisCache, document_digest
+from executors import run_in_document_pool, run_in_request_pool, shutdown_executors
+from generation import GENERATION_PROFILES, DEFAULT_PROFILE, get_profile
+from jobs import JobRunner, JobStore
+from outbound import MessageSender, decode_message, negotiate_encoding
+from retrieval import Chunk, IndexCache, format_chunks, group_chunks, page_span, select_context
+from chat_sessions import ChatSession, ChatSessionStore
+from ocr_olm import (
+    extract_text_from_pdf, stream_ocr_bytes, stream_ocr_file, model_status, model_version, warm_up,
+    SCHEDULER, OCR_CACHE, PREVIEW_STORE,
+)
+from model_loader import configure_logging
+from model_workers import ModelWorkerPool
+from scheduler import GenerationJob
+
+# Progress goes through logging; OCR_LOG_LEVEL=DEBUG adds per-page and per-event lines
+configure_logging()
+log = logging.getLogger("ocr.server")
+
+# Requests that ask for a trace get its id back; the last OCR_TRACE_KEEP
+# traces are served by GET /traces/{id}
+TRACES = tracing.TraceStore(int(os.environ.get("OCR_TRACE_KEEP", "32")))
 
 app = FastAPI()
 
@@ -18,21 +40,73 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Asynchronous jobs: POST /jobs/ queues a document and returns at once; the
+# queue and page results live in SQLite, so jobs survive a restart
+JOB_STORE = JobStore(
+    os.environ.get("OCR_JOBS_PATH", "./cache/jobs.sqlite3"),
+    os.environ.get("OCR_JOBS_DIR", "./cache/jobs"),
+)
+
+def _job_stream(job_id: str, path: str, options: dict, skip_pages: set[int]):
+    # A job's previews are stored under its own id, so they last as long as the job
+    return stream_ocr_file(path, options.get("profile"), previews=options.get("previews", True),
+                           skip_pages=skip_pages, preview_job=job_id)
+
+JOB_RUNNER = JobRunner(
+    JOB_STORE,
+    _job_stream,
+    workers=int(os.environ.get("OCR_JOB_WORKERS", "1")),
+    retention=float(os.environ.get("OCR_JOB_RETENTION_HOURS", "168")) * 3600,
+    previews=PREVIEW_STORE,
+)
+
+@app.on_event("startup")
+async def startup():
+    # OCR_WARMUP=0 leaves the model to be loaded by the first request
+    if os.environ.get("OCR_WARMUP", "1") != "0":
+        warm_up()
+    await JOB_RUNNER.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await JOB_RUNNER.stop()
+    SCHEDULER.stop()
+    shutdown_executors()
+
+UPLOAD_COPY_CHUNK_SIZE = 1024 * 1024
+
 # Standard upload endpoint (existing)
 @app.post("/upload/")
-async def upload_file(file: UploadFile = File(...), lang: str = Form(...)):
+async def upload_file(file: UploadFile = File(...), lang: str = Form(...),
+                      profile: str = Form(default=""), previews: bool = Form(default=True),
+                      trace: bool = Form(default=False)):
+    try:
+        profile, _ = get_profile(profile or None)
+    except ValueError as e:
+        return JSONResponse(
+            status_code=400,
+            content={"success": False, "error": str(e), "filename": file.filename}
+        )
+
     temp_file_path = None
+    trace = TRACES.new(f"upload {file.filename}") if trace else None
     try:
         safe_name = pathlib.Path(file.filename).name.replace(" ", "_")
         temp_file_path = f"temp_{uuid.uuid4().hex}_{safe_name}"
         
+        # Copy the upload to disk in fixed-size chunks; the OCR engine works
+        # from the file path, so the document is never held in memory whole
         with open(temp_file_path, "wb") as f:
-            f.write(await file.read())
+            await run_in_request_pool(shutil.copyfileobj, file.file, f, UPLOAD_COPY_CHUNK_SIZE)
         
-        print(f"[INFO] File saved: {temp_file_path}")
-        print(f"[INFO] Language: {lang}")
+        log.debug("File saved: %s (language %s, profile %s)", temp_file_path, lang, profile)
         
-        ocr_result = extract_text_from_pdf(temp_file_path, lang)
+        # Rendering and OCR run in worker threads so the event loop stays free
+        # for /health, other uploads and WebSocket pings
+        started = time.perf_counter()
+        ocr_result = await run_in_document_pool(extract_text_from_pdf, temp_file_path, lang, profile, previews)
+        if trace is not None:
+            trace.span("ocr", "request", started, time.perf_counter(), pages=ocr_result["total_pages"])
         
         if os.path.exists(temp_file_path):
             os.remove(temp_file_path)
@@ -59,9 +133,11 @@ async def upload_file(file: UploadFile = File(...), lang: str = Form(...)):
                 "success": True,
                 "filename": file.filename,
                 "lang": lang,
+                "profile": profile,
                 "text": extracted_text,
                 "pages": ocr_result["pages"],
-                "total_pages": ocr_result["total_pages"]
+                "total_pages": ocr_result["total_pages"],
+                "trace": trace.id if trace is not None else None
             }
         else:
             return JSONResponse(
@@ -89,48 +165,321 @@ async def upload_file(file: UploadFile = File(...), lang: str = Form(...)):
             }
         )
 
+@app.post("/jobs/", status_code=202)
+async def create_job(file: UploadFile = File(...), lang: str = Form(default="eng"),
+                     profile: str = Form(default=""), previews: bool = Form(default=True)):
+    """Queue a document for OCR and return its job id without waiting for the result."""
+    try:
+        profile, _ = get_profile(profile or None)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"success": False, "error": str(e)})
+
+    job_id, path = await run_in_request_pool(JOB_STORE.new_file_path, file.filename)
+    try:
+        with open(path, "wb") as f:
+            await run_in_request_pool(shutil.copyfileobj, file.file, f, UPLOAD_COPY_CHUNK_SIZE)
+    except Exception as e:
+        if os.path.exists(path):
+            os.remove(path)
+        return JSONResponse(status_code=500, content={"success": False, "error": f"Server error: {str(e)}"})
+
+    await run_in_request_pool(JOB_STORE.create, job_id, file.filename, path,
+                              {"lang": lang, "profile": profile, "previews": previews})
+    JOB_RUNNER.notify()
+    log.info("Queued job %s for %s", job_id, file.filename)
+    return {"success": True, "job_id": job_id, "status": "queued"}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Status and progress of a job."""
+    job = await run_in_request_pool(JOB_STORE.get, job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"success": False, "error": "Job not found"})
+    job.pop("file_path")
+    return {"success": True, **job}
+
+@app.get("/jobs/{job_id}/pages")
+async def get_job_pages(job_id: str, start: int = Query(default=1, alias="from", ge=1),
+                        limit: int = Query(default=100, ge=1, le=1000)):
+    """Completed page results of a job, in page order, from page ``from`` on.
+
+    Pages are added as they finish, so polling with ``from`` set to the
+    returned ``next`` picks up new pages as the job progresses.
+    """
+    job = await run_in_request_pool(JOB_STORE.get, job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"success": False, "error": "Job not found"})
+    pages = await run_in_request_pool(JOB_STORE.pages, job_id, start, limit)
+    return {
+        "success": True,
+        "status": job["status"],
+        "total_pages": job["total_pages"],
+        "pages": pages,
+        "next": pages[-1]["page"] + 1 if pages else start,
+    }
+
+# Chunked WebSocket uploads: the client sends a JSON metadata frame with the
+# file's "size" (and optionally its "sha256"), waits for "upload_ready", then
+# sends the file as binary frames. Chunks go straight to a temp file, so memory
+# use does not depend on the file size.
+WS_UPLOAD_MAX_BYTES = int(os.environ.get("WS_UPLOAD_MAX_MB", "512")) * 1024 * 1024
+WS_UPLOAD_CHUNK_SIZE = int(os.environ.get("WS_UPLOAD_CHUNK_KB", "1024")) * 1024
+
+async def _receive_chunked_upload(websocket: WebSocket, request_data: dict,
+                                  sender: MessageSender) -> tuple[str, str]:
+    """Receive a chunked binary upload into a temp file; returns (path, sha256).
+
+    The size and checksum announced in the metadata frame are enforced; the
+    temp file is removed again if the upload fails.
+    """
+    size = int(request_data.get("size", -1))
+    if not 0 < size <= WS_UPLOAD_MAX_BYTES:
+        raise ValueError(f"Upload size must be between 1 and {WS_UPLOAD_MAX_BYTES} bytes, got {size}")
+    expected = (request_data.get("sha256") or "").lower() or None
+
+    suffix = pathlib.Path(request_data.get("filename") or "").suffix
+    fd, path = tempfile.mkstemp(prefix="ocr_upload_", suffix=suffix)
+    digest = hashlib.sha256()
+    received = 0
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            await sender.send({
+                "type": "upload_ready",
+                "chunk_size": WS_UPLOAD_CHUNK_SIZE,
+                "max_bytes": WS_UPLOAD_MAX_BYTES
+            })
+            while received < size:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(message.get("code", 1000))
+                chunk = message.get("bytes")
+                if chunk is None:
+                    raise ValueError("Expected a binary frame with file data")
+                received += len(chunk)
+                if received > size:
+                    raise ValueError(f"Upload exceeds its announced size of {size} bytes")
+                digest.update(chunk)
+                await run_in_request_pool(fh.write, chunk)
+
+        sha256 = digest.hexdigest()
+        if expected and sha256 != expected:
+            raise ValueError("Upload checksum mismatch")
+        await sender.send({"type": "upload_complete", "size": received, "sha256": sha256})
+        return path, sha256
+    except BaseException:
+        os.remove(path)
+        raise
+
+# Outbound events are queued per connection and written by one task, which
+# keeps them in order; at WS_SEND_QUEUE pending events the OCR stream waits
+# for the client
+WS_SEND_QUEUE = max(1, int(os.environ.get("WS_SEND_QUEUE", "64")))
+
 # Real-time streaming endpoint
 @app.websocket("/ws/upload/")
 async def websocket_upload(websocket: WebSocket):
-    await websocket.accept()
-    print("[WebSocket] Client connected")
+    # Clients may ask for msgpack binary frames via the "ocr.msgpack" subprotocol
+    subprotocol, encoding = negotiate_encoding(websocket)
+    await websocket.accept(subprotocol=subprotocol)
+    log.debug("WebSocket client connected (%s)", encoding)
     
+    upload_path = None
+    sender = None
     try:
-        # Receive file data
-        data = await websocket.receive_text()
-        request_data = json.loads(data)
+        # Receive file metadata (and, for legacy clients, the base64 file data)
+        request_data = decode_message(await websocket.receive(), encoding)
         
-        file_data = request_data.get("file_data")  # Base64 encoded file
+        file_data = request_data.get("file_data")  # Base64 encoded file (legacy protocol)
         filename = request_data.get("filename")
         lang = request_data.get("lang", "eng")
-        
-        print(f"[WebSocket] Processing file: {filename}")
-        
-        # Decode file data
-        import base64
-        file_bytes = base64.b64decode(file_data)
+        profile, _ = get_profile(request_data.get("profile"))  # unknown names are reported as an error
+        # Opt-in page_delta events with partial page text while pages are generated
+        stream_tokens = bool(request_data.get("stream_tokens", False))
+        stream_interval_ms = request_data.get("stream_interval_ms")
+        if stream_interval_ms is not None:
+            stream_interval_ms = max(0.0, float(stream_interval_ms))
+        # Page previews are URLs into the preview store; clients can skip them entirely
+        previews = bool(request_data.get("previews", True))
+        # With "trace" the stages of every page are traced; processing_complete carries the trace id
+        trace = TRACES.new(f"ws {filename}") if request_data.get("trace") else None
+
+        sender = MessageSender(websocket, encoding, max_queue=WS_SEND_QUEUE,
+                               coalesce=bool(request_data.get("coalesce", True)))
+        sender.start()
+        
+        if file_data is None:
+            started = time.perf_counter()
+            upload_path, sha256 = await _receive_chunked_upload(websocket, request_data, sender)
+            if trace is not None:
+                trace.span("upload", "request", started, time.perf_counter())
+            log.info("WebSocket processing %s (%d bytes, profile %s)", filename,
+                     os.path.getsize(upload_path), profile)
+            results = stream_ocr_file(upload_path, profile, stream_tokens, stream_interval_ms,
+                                      file_hash=sha256, previews=previews)
+        else:
+            log.info("WebSocket processing %s (profile %s)", filename, profile)
+            # Decode file data
+            import base64
+            file_bytes = await run_in_request_pool(base64.b64decode, file_data)
+            results = stream_ocr_bytes(file_bytes, profile, stream_tokens, stream_interval_ms, previews)
         
         # Stream OCR results
-        async for result in stream_ocr_bytes(file_bytes):
-            print(f"[WebSocket] Sending result: {result.get('type', 'unknown')} - Page {result.get('page', 'N/A')}")
-            await websocket.send_text(json.dumps(result))
-            
-            # Small delay to ensure proper message ordering
-            await asyncio.sleep(0.1)
+        async for result in results:
+            await sender.send(result)
         
-        print("[WebSocket] Processing completed")
+        await sender.close()
+        log.debug("WebSocket processing completed (%d messages, %d deltas coalesced)",
+                  sender.sent, sender.coalesced)
         
     except WebSocketDisconnect:
-        print("[WebSocket] Client disconnected")
+        log.debug("WebSocket client disconnected")
     except Exception as e:
-        print(f"[WebSocket] Error: {str(e)}")
+        log.warning("WebSocket error: %s", e)
+        metrics.ERRORS.inc(stage="websocket")
         try:
-            await websocket.send_text(json.dumps({
-                "type": "error",
-                "error": str(e)
-            }))
+            # A request rejected before its sender exists still gets the
+            # negotiated framing
+            if sender is None:
+                sender = MessageSender(websocket, encoding)
+                sender.start()
+            await sender.send({"type": "error", "error": str(e)})
+            await sender.close()
         except:
             pass  # Connection might be closed
+    finally:
+        if sender is not None:
+            await sender.close(flush=False)
+        if upload_path and os.path.exists(upload_path):
+            os.remove(upload_path)
+
+# Long documents in /chat/ and /analyze/: chat prompts get the best-matching
+# chunks of the document, analysis runs map-reduce over all of it
+CHAT_CONTEXT_CHARS = int(os.environ.get("CHAT_CONTEXT_CHARS", "3000"))
+CHAT_TOP_K = int(os.environ.get("CHAT_TOP_K", "8"))
+ANALYZE_CONTEXT_CHARS = int(os.environ.get("ANALYZE_CONTEXT_CHARS", "3500"))
+ANALYZE_MAP_BATCH = max(1, int(os.environ.get("ANALYZE_MAP_BATCH", "8")))
+INDEX_CACHE = IndexCache(int(os.environ.get("RETRIEVAL_CACHE_DOCS", "32")),
+                         int(os.environ.get("RETRIEVAL_CHUNK_CHARS", "1000")))
+
+ANALYSIS_PROMPTS = {
+    "summary": "Provide a comprehensive summary of this document, highlighting the main topics and key information.",
+    "key_points": "Extract the main key points, important information, and significant details from this document. Present them as a structured list.",
+    "entities": "Identify and list all important entities mentioned in this document: names, organizations, locations, dates, amounts, etc.",
+    "dates": "Find and list all dates, deadlines, time periods, and temporal information mentioned in this document.",
+    "questions": "Based on this document content, suggest 5-7 relevant questions that users might want to ask about it."
+}
+ANALYSIS_GEN_KWARGS = {"temperature": 0.6, "do_sample": True, "top_p": 0.9, "repetition_penalty": 1.1}
+
+# Finished analyses by (document hash, analysis type, model version); ANALYSIS_CACHE=0 disables it
+ANALYSIS_CACHE = (
+    AnalysisCache(os.environ.get("ANALYSIS_CACHE_PATH", "./cache/analysis.sqlite3"),
+                  int(os.environ.get("ANALYSIS_CACHE_ENTRIES", "2000")))
+    if os.environ.get("ANALYSIS_CACHE", "1") != "0" else None
+)
+
+async def _map_sections(prompts: dict[str, str], groups: list[list[Chunk]]) -> tuple[dict, dict]:
+    """Notes on each group of chunks for each prompt, generated ANALYZE_MAP_BATCH at a time.
+
+    Section text comes before the instruction, so the jobs for one section
+    share it as a prompt prefix. Returns the notes and the generation seconds
+    spent, both keyed like ``prompts``.
+    """
+    work = [(group, kind) for group in groups for kind in prompts]
+    notes = {kind: [] for kind in prompts}
+    seconds = dict.fromkeys(prompts, 0.0)
+    for start in range(0, len(work), ANALYZE_MAP_BATCH):
+        part = work[start:start + ANALYZE_MAP_BATCH]
+        jobs = []
+        for group, kind in part:
+            span = page_span(group)
+            section = f"""This is one section{f" ({span})" if span else ""} of a longer document.
+
+Content: {format_chunks(group)}
+
+For this section only, {prompts[kind]}
+Keep it brief; your notes will be combined with those of the other sections.
+
+Notes:"""
+            jobs.append(GenerationJob(
+                [{"role": "user", "content": [{"type": "text", "text": section}]}],
+                gen_kwargs={"do_sample": False, "repetition_penalty": 1.1},
+                max_new_tokens=300,
+                stop_on_repetition=True,
+                cache_prefix=True,
+            ))
+        # Submitted together so the scheduler can batch them
+        outputs = await asyncio.gather(*(asyncio.wrap_future(f) for f in SCHEDULER.submit_many(jobs)))
+        for (group, kind), output in zip(part, outputs):
+            note = output.text.strip()
+            if "Notes:" in note:
+                note = note.split("Notes:")[-1].strip()
+            span = page_span(group)
+            notes[kind].append(f"[{span.capitalize()}] {note}" if span else note)
+            seconds[kind] += output.seconds
+    return notes, seconds
+
+async def _condense(kind: str, prompt: str, notes: list[str]) -> tuple[list[str], float]:
+    """Notes too long for one prompt, condensed again section by section."""
+    seconds = 0.0
+    while len(notes) > 1 and sum(len(note) for note in notes) > ANALYZE_CONTEXT_CHARS:
+        condensed, spent = await _map_sections({kind: prompt}, group_chunks(
+            [Chunk(i, None, note) for i, note in enumerate(notes)], ANALYZE_CONTEXT_CHARS))
+        notes, seconds = condensed[kind], seconds + spent[kind]
+    return notes, seconds
+
+async def _run_analyses(extracted_text: str, document_name: str, kinds: list[str]) -> dict[str, dict]:
+    """Generate the analyses in one pass: for short documents one batch whose
+    prompts share the document text as a prefix, for long ones map-reduce
+    with every type's section notes batched together."""
+    prompts = {kind: ANALYSIS_PROMPTS[kind] for kind in kinds}
+    seconds = dict.fromkeys(kinds, 0.0)
+    sections = 1
+    if len(extracted_text) > ANALYZE_CONTEXT_CHARS:
+        # Map-reduce: analyze the document in parts, then combine the notes
+        index = await run_in_request_pool(INDEX_CACHE.get, extracted_text)
+        groups = group_chunks(index.chunks, ANALYZE_CONTEXT_CHARS)
+        notes, seconds = await _map_sections(prompts, groups)
+        sections = len(groups)
+        condensed = await asyncio.gather(*(_condense(kind, prompts[kind], notes[kind]) for kind in kinds))
+        contexts = {}
+        for kind, (kind_notes, spent) in zip(kinds, condensed):
+            contexts[kind] = "\n\n".join(kind_notes)
+            seconds[kind] += spent
+        log.debug("Combined notes from %d sections for %s", sections, ", ".join(kinds))
+    else:
+        contexts = dict.fromkeys(kinds, extracted_text)
+
+    jobs = []
+    for kind in kinds:
+        # The document comes first so the analyses of one document share it as a prefix
+        system_prompt = f"""Document: {document_name}
+Content: {contexts[kind]}
+
+Analyze the document above and {prompts[kind]}
+
+Analysis:"""
+        jobs.append(GenerationJob(
+            [{"role": "user", "content": [{"type": "text", "text": system_prompt}]}],
+            gen_kwargs=ANALYSIS_GEN_KWARGS,
+            max_new_tokens=600,
+            stop_on_repetition=True,
+            cache_prefix=True,
+        ))
+    outputs = await asyncio.gather(*(asyncio.wrap_future(f) for f in SCHEDULER.submit_many(jobs)))
+
+    results = {}
+    for kind, output in zip(kinds, outputs):
+        response = output.text.strip()
+        if "Analysis:" in response:
+            response = response.split("Analysis:")[-1].strip()
+        results[kind] = {
+            "analysis": response,
+            "sections": sections,
+            "cached": False,
+            "seconds": round(seconds[kind] + output.seconds, 3),
+            "prefix_tokens": output.prefix_tokens,
+        }
+    return results
 
 # NEW: AI Document Assistant Chat Endpoint
 @app.post("/chat/")
@@ -142,13 +491,20 @@ async def chat_with_document(
 ):
     """Chat endpoint for AI Document Assistant - leverages existing OCR model for text analysis"""
     try:
-        from ocr_olm import PROCESSOR, MODEL, DEVICE
-        
-        print(f"[CHAT] Received message: {message[:100]}...")
-        print(f"[CHAT] Document context: {len(extracted_text)} characters")
-        
-        # Build context-aware prompt for document analysis
-        context_text = extracted_text[:3000] if extracted_text else "No document content available."
+        log.debug("Chat message of %d characters, document of %d characters", len(message), len(extracted_text))
+        
+        # Long documents: only the chunks most relevant to the question go in the prompt
+        sources = []
+        if not extracted_text:
+            context_text = "No document content available."
+        elif len(extracted_text) <= CHAT_CONTEXT_CHARS:
+            context_text = extracted_text
+        else:
+            index = await run_in_request_pool(INDEX_CACHE.get, extracted_text)
+            chunks = select_context(index, message, CHAT_CONTEXT_CHARS, CHAT_TOP_K)
+            context_text = format_chunks(chunks)
+            sources = sorted({chunk.page for chunk in chunks if chunk.page is not None})
+            log.debug("Using %d/%d chunks (pages %s)", len(chunks), len(index.chunks), sources)
         
         # Parse conversation history
         try:
@@ -185,57 +541,46 @@ Instructions:
 
 Response:"""
 
-        # Use existing model for text analysis (without image input)
+        # Use existing model for text analysis (without image input); the
+        # scheduler batches this with any other compatible requests in flight
         messages = [{
             "role": "user",
             "content": [{"type": "text", "text": system_prompt}]
         }]
         
-        text_for_model = PROCESSOR.apply_chat_template(
-            messages, tokenize=False, add_generation_prompt=True
-        )
-        
-        # Process without image input - just text
-        inputs = PROCESSOR(
-            text=text_for_model, 
-            images=None,  # No image needed for chat
-            return_tensors="pt"
-        ).to(DEVICE)
-        
-        with torch.no_grad():
-            out_ids = MODEL.generate(
-                **inputs,
-                temperature=0.7,              # Balanced creativity
-                do_sample=True,               
-                max_new_tokens=800,          # Longer responses for detailed analysis
-                top_p=0.9,                   
-                repetition_penalty=1.1,      
-                pad_token_id=PROCESSOR.tokenizer.pad_token_id,
-            )
-        
-        new_ids = out_ids[:, inputs["input_ids"].shape[1]:]
-        response = PROCESSOR.batch_decode(new_ids, skip_special_tokens=True)[0]
+        output = await SCHEDULER.generate(GenerationJob(
+            messages,
+            gen_kwargs={
+                "temperature": 0.7,              # Balanced creativity
+                "do_sample": True,
+                "top_p": 0.9,
+                "repetition_penalty": 1.1,
+            },
+            max_new_tokens=800,                  # Longer responses for detailed analysis
+            stop_on_repetition=True,
+        ))
         
         # Clean up response
-        response = response.strip()
+        response = output.text.strip()
         
         # Remove any potential prompt echoing
         if "Response:" in response:
             response = response.split("Response:")[-1].strip()
         
-        print(f"[CHAT] Generated response: {response[:200]}...")
+        log.debug("Generated a response of %d characters", len(response))
         
         return {
             "success": True,
             "response": response,
             "timestamp": datetime.now().isoformat(),
             "model": "olmOCR-7B-0225-preview",
-            "document_context": bool(extracted_text)
+            "document_context": bool(extracted_text),
+            "sources": sources
         }
         
     except Exception as e:
-        print(f"[CHAT] Error: {str(e)}")
-        traceback.print_exc()
+        log.exception("Chat error: %s", e)
+        metrics.ERRORS.inc(stage="chat")
         return JSONResponse(
             status_code=500,
             content={
@@ -245,78 +590,207 @@ Response:"""
             }
         )
 
+# Chat sessions: the document is sent once and the history kept server-side,
+# so each turn reuses the KV cache of the prompt so far (see chat_sessions)
+CHAT_SESSIONS = ChatSessionStore(
+    max_sessions=int(os.environ.get("CHAT_SESSION_MAX", "64")),
+    ttl=float(os.environ.get("CHAT_SESSION_TTL", "3600")),
+    max_cache_bytes=int(float(os.environ.get("CHAT_SESSION_CACHE_MB", "2048")) * 2**20),
+)
+CHAT_SESSION_CONTEXT_CHARS = int(os.environ.get("CHAT_SESSION_CONTEXT_CHARS", "6000"))
+CHAT_SESSION_MAX_TURNS = max(1, int(os.environ.get("CHAT_SESSION_MAX_TURNS", "8")))
+CHAT_GEN_KWARGS = {"temperature": 0.7, "do_sample": True, "top_p": 0.9, "repetition_penalty": 1.1}
+
+def _session_system_prompt(session: ChatSession) -> str:
+    extent = "" if session.complete else (
+        " Only the opening of the document is shown here; relevant excerpts from the rest "
+        "are added to the questions.")
+    return f"""You are an AI Document Assistant specialized in analyzing and answering questions about documents.{extent}
+
+Document: {session.document_name}
+Content: {session.context or "No document content available."}
+
+Instructions:
+1. Answer based primarily on the document content provided
+2. Be specific and cite relevant parts when possible
+3. If the answer isn't in the document, clearly state that
+4. Provide helpful, accurate, and concise responses
+5. For analysis requests, be thorough but organized"""
+
+def _session_messages(session: ChatSession, message: str, excerpts: list[Chunk]) -> list[dict]:
+    """The turn's prompt: fixed document context, then the history, then the question.
+
+    Only ever appended to between turns, so the previous prompt is a prefix of
+    this one. Excerpts go with the current question only and are left out of
+    the history, to keep the prompt from growing by them every turn.
+    """
+    def text(role, content):
+        return {"role": role, "content": [{"type": "text", "text": content}]}
+
+    question = message
+    if excerpts:
+        question = f"Relevant excerpts:\n{format_chunks(excerpts)}\n\nQuestion: {message}"
+    return ([text("system", _session_system_prompt(session))]
+            + [text(turn["role"], turn["content"]) for turn in session.history]
+            + [text("user", question)])
+
+async def _prime_session(session: ChatSession):
+    """Prefill the document context ahead of the first question."""
+    async with session.lock:
+        try:
+            await SCHEDULER.generate(GenerationJob(
+                [{"role": "system", "content": [{"type": "text", "text": _session_system_prompt(session)}]}],
+                gen_kwargs={"do_sample": False}, max_new_tokens=1, session_state=session.cache,
+            ))
+        except Exception as e:
+            log.warning("Could not prefill chat session %s: %s", session.id, e)
+
+@app.post("/chat/sessions/", status_code=201)
+async def create_chat_session(extracted_text: str = Form(default=""), document_name: str = Form(default="")):
+    """Start a chat session about a document; messages then go to /chat/sessions/{id}/messages."""
+    session = await run_in_request_pool(ChatSession, document_name, extracted_text,
+                                        CHAT_SESSION_CONTEXT_CHARS, INDEX_CACHE.chunk_chars)
+    CHAT_SESSIONS.add(session)
+    # A KV cache cannot be shared with model worker processes, so priming only
+    # pays off when the model runs in this process
+    if extracted_text and not isinstance(SCHEDULER, ModelWorkerPool):
+        asyncio.create_task(_prime_session(session))
+    log.info("Chat session %s: %d characters, %d/%d chunks in context", session.id, len(extracted_text),
+             len(session.context_chunks), len(session.index.chunks))
+    return {"success": True, **session.describe()}
+
+@app.post("/chat/sessions/{session_id}/messages")
+async def chat_session_message(session_id: str, message: str = Form(...)):
+    session = CHAT_SESSIONS.get(session_id)
+    if session is None:
+        return JSONResponse(status_code=404, content={"success": False, "error": "Chat session not found or expired"})
+    async with session.lock:
+        try:
+            excerpts = []
+            if not session.complete:
+                in_context = {chunk.index for chunk in session.context_chunks}
+                ranked = [chunk for _, chunk in session.index.search(message, CHAT_TOP_K)
+                          if chunk.index not in in_context]
+                used = 0
+                for chunk in ranked:
+                    if used + len(chunk.text) <= CHAT_CONTEXT_CHARS:
+                        excerpts.append(chunk)
+                        used += len(chunk.text)
+                excerpts.sort(key=lambda chunk: chunk.index)
+
+            output = await SCHEDULER.generate(GenerationJob(
+                _session_messages(session, message, excerpts),
+                gen_kwargs=CHAT_GEN_KWARGS,
+                max_new_tokens=800,
+                stop_on_repetition=True,
+                session_state=session.cache,
+            ))
+            response = output.text.strip()
+            session.history += [{"role": "user", "content": message},
+                                {"role": "assistant", "content": response}]
+            # Dropping the oldest turns breaks the cached prefix once, after the document context
+            del session.history[:-2 * CHAT_SESSION_MAX_TURNS]
+            log.debug("Chat session %s: %d prompt tokens from cache", session.id, output.prefix_tokens)
+        except Exception as e:
+            log.exception("Chat error: %s", e)
+            metrics.ERRORS.inc(stage="chat")
+            return JSONResponse(
+                status_code=500,
+                content={"success": False, "error": f"Chat processing error: {str(e)}",
+                         "timestamp": datetime.now().isoformat()},
+            )
+    CHAT_SESSIONS.evict()
+    pages = {chunk.page for chunk in excerpts if chunk.page is not None}
+    return {
+        "success": True,
+        "response": response,
+        "timestamp": datetime.now().isoformat(),
+        "model": "olmOCR-7B-0225-preview",
+        "document_context": bool(session.text),
+        "sources": sorted(pages),
+        "cached_tokens": output.prefix_tokens,
+    }
+
+@app.get("/chat/sessions/{session_id}")
+async def get_chat_session(session_id: str):
+    session = CHAT_SESSIONS.get(session_id)
+    if session is None:
+        return JSONResponse(status_code=404, content={"success": False, "error": "Chat session not found or expired"})
+    return {"success": True, **session.describe()}
+
+@app.delete("/chat/sessions/{session_id}")
+async def delete_chat_session(session_id: str):
+    if not CHAT_SESSIONS.remove(session_id):
+        return JSONResponse(status_code=404, content={"success": False, "error": "Chat session not found or expired"})
+    return {"success": True}
+
+@app.get("/chat/sessions/")
+async def chat_session_stats():
+    """Session count and KV cache memory of the chat sessions."""
+    return CHAT_SESSIONS.stats()
+
 # NEW: Quick analysis endpoint for automatic document insights
 @app.post("/analyze/")
 async def analyze_document(
     extracted_text: str = Form(...),
     document_name: str = Form(default=""),
-    analysis_type: str = Form(default="summary")  # summary, key_points, entities, dates
+    analysis_type: str = Form(default="summary"),  # summary, key_points, entities, dates, questions
+    analysis_types: str = Form(default=""),        # comma-separated, to run several in one pass
 ):
-    """Quick document analysis endpoint"""
-    try:
-        from ocr_olm import PROCESSOR, MODEL, DEVICE
-        
-        analysis_prompts = {
-            "summary": "Provide a comprehensive summary of this document, highlighting the main topics and key information.",
-            "key_points": "Extract the main key points, important information, and significant details from this document. Present them as a structured list.",
-            "entities": "Identify and list all important entities mentioned in this document: names, organizations, locations, dates, amounts, etc.",
-            "dates": "Find and list all dates, deadlines, time periods, and temporal information mentioned in this document.",
-            "questions": "Based on this document content, suggest 5-7 relevant questions that users might want to ask about it."
-        }
-        
-        prompt = analysis_prompts.get(analysis_type, analysis_prompts["summary"])
-        context_text = extracted_text[:3500] if extracted_text else ""
-        
-        system_prompt = f"""Analyze the following document and {prompt}
+    """Quick document analysis endpoint.
 
-Document: {document_name}
-Content: {context_text}
+    With ``analysis_types`` every listed analysis is generated in one pass
+    and returned under "analyses", each with its own timing. Results are
+    cached per document, analysis type and model, so repeated requests
+    return without generating anything.
+    """
+    try:
+        if analysis_types:
+            kinds = list(dict.fromkeys(kind.strip() for kind in analysis_types.split(",") if kind.strip()))
+            unknown = [kind for kind in kinds if kind not in ANALYSIS_PROMPTS]
+            if unknown or not kinds:
+                return JSONResponse(status_code=400, content={
+                    "success": False,
+                    "error": f"Unknown analysis types: {', '.join(unknown) or '(none given)'}. "
+                             f"Available: {', '.join(ANALYSIS_PROMPTS)}",
+                })
+        else:
+            kinds = [analysis_type if analysis_type in ANALYSIS_PROMPTS else "summary"]
 
-Analysis:"""
+        started = time.monotonic()
+        document = document_digest(extracted_text, document_name)
+        version = model_version()
+        results = {}
+        if ANALYSIS_CACHE is not None:
+            cached = await run_in_request_pool(ANALYSIS_CACHE.get_many, document, kinds, version)
+            results = {kind: {**hit, "cached": True, "seconds": 0.0, "prefix_tokens": 0}
+                       for kind, hit in cached.items()}
+        missing = [kind for kind in kinds if kind not in results]
+        if missing:
+            generated = await _run_analyses(extracted_text, document_name, missing)
+            results.update(generated)
+            if ANALYSIS_CACHE is not None:
+                for kind, result in generated.items():
+                    await run_in_request_pool(ANALYSIS_CACHE.put, document, kind, version,
+                                              result["analysis"], result["sections"])
+        log.info("Analyses %s: %d cached, %d generated in %.1fs", ", ".join(kinds),
+                 len(kinds) - len(missing), len(missing), time.monotonic() - started)
 
-        messages = [{
-            "role": "user",
-            "content": [{"type": "text", "text": system_prompt}]
-        }]
-        
-        text_for_model = PROCESSOR.apply_chat_template(
-            messages, tokenize=False, add_generation_prompt=True
-        )
-        
-        inputs = PROCESSOR(
-            text=text_for_model, 
-            images=None,
-            return_tensors="pt"
-        ).to(DEVICE)
-        
-        with torch.no_grad():
-            out_ids = MODEL.generate(
-                **inputs,
-                temperature=0.6,
-                do_sample=True,
-                max_new_tokens=600,
-                top_p=0.9,
-                repetition_penalty=1.1,
-                pad_token_id=PROCESSOR.tokenizer.pad_token_id,
-            )
-        
-        new_ids = out_ids[:, inputs["input_ids"].shape[1]:]
-        response = PROCESSOR.batch_decode(new_ids, skip_special_tokens=True)[0]
-        
-        response = response.strip()
-        if "Analysis:" in response:
-            response = response.split("Analysis:")[-1].strip()
-        
+        first = results[kinds[0]]
         return {
             "success": True,
-            "analysis": response,
-            "analysis_type": analysis_type,
+            "analysis": first["analysis"],
+            "analysis_type": kinds[0],
+            "analyses": {kind: results[kind] for kind in kinds},
             "timestamp": datetime.now().isoformat(),
-            "document_name": document_name
+            "document_name": document_name,
+            "sections": first["sections"],
+            "seconds": round(time.monotonic() - started, 3),
         }
         
     except Exception as e:
-        print(f"[ANALYSIS] Error: {str(e)}")
+        log.warning("Analysis error: %s", e)
+        metrics.ERRORS.inc(stage="analysis")
         return JSONResponse(
             status_code=500,
             content={
@@ -331,8 +805,66 @@ async def root():
 
 @app.get("/health")
 async def health_check():
+    """Liveness: answers as soon as the server is up, whether or not the model is loaded."""
     return {"status": "healthy", "device": "cuda" if torch.cuda.is_available() else "cpu"}
 
+@app.get("/ready")
+async def readiness_check():
+    """Readiness: 503 until the model is loaded (or a model worker is ready)."""
+    status = model_status()
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
+@app.get("/scheduler/stats")
+async def scheduler_stats():
+    """Queue depth, batch sizes and wait times of the shared inference scheduler
+    (per worker process when the model runs in model workers)."""
+    return SCHEDULER.stats()
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus metrics: page stage times, vision and generated tokens, queue waits,
+    WebSocket send times, routes and errors."""
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/traces/{trace_id}")
+async def get_trace(trace_id: str):
+    """A traced request in the Chrome trace event format (chrome://tracing, ui.perfetto.dev)."""
+    trace = TRACES.get(trace_id)
+    if trace is None:
+        return JSONResponse(status_code=404, content={"success": False, "error": "Trace not found"})
+    return trace.to_chrome()
+
+@app.get("/preview/{job}/{page}")
+async def get_preview(job: str, page: int, request: Request):
+    """A page thumbnail from an OCR request; the URLs come from the page results."""
+    preview = await run_in_request_pool(PREVIEW_STORE.get, job, page)
+    if preview is None:
+        return JSONResponse(status_code=404, content={"error": "Preview not found"})
+    data, etag = preview
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=3600, immutable"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=data, media_type="image/jpeg", headers=headers)
+
+@app.get("/profiles/")
+async def get_profiles():
+    """Generation profiles accepted by /upload/ and /ws/upload/."""
+    return {
+        "default": DEFAULT_PROFILE,
+        "profiles": [
+            {"id": name, "max_new_tokens": p["max_new_tokens"], "deterministic": not p["gen_kwargs"].get("do_sample", False)}
+            for name, p in GENERATION_PROFILES.items()
+        ]
+    }
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Hit/miss counters and size of the OCR result cache (and of the analysis cache)."""
+    analysis = ANALYSIS_CACHE.stats() if ANALYSIS_CACHE is not None else None
+    if OCR_CACHE is None:
+        return {"enabled": False, "analysis": analysis}
+    return {"enabled": True, **OCR_CACHE.stats(), "analysis": analysis}
+
 # NEW: Get available analysis types
 @app.get("/analysis-types/")
 async def get_analysis_types():
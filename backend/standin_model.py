@@ -0,0 +1,189 @@
+# standin_model.py - a tiny randomly initialised Qwen2-VL for CPU-only testing
+#
+# Same architecture, tokenizer and processor as olmOCR, but two 64-wide layers
+# (about 10M parameters, nearly all of them embeddings), so the serving stack
+# (scheduler, model workers, streaming) can be exercised on a CPU box without
+# the 7B checkpoint.
+# Its output is gibberish. Select it with OCR_MODEL_LOADER=standin_model:load_standin.
+#
+# load_timing_stub goes further and replaces the model with one that only
+# sleeps for as long as a real model of a given speed would, so throughput of
+# everything around the model can be measured (see benchmark.py).
+import logging, os, time
+
+import torch
+from transformers import AutoProcessor, DynamicCache, Qwen2VLConfig, Qwen2VLForConditionalGeneration
+from transformers.modeling_outputs import CausalLMOutputWithPast
+
+from model_loader import ModelConfig, quantize_int8
+
+log = logging.getLogger("ocr.standin_model")
+
+# The tokenizer and preprocessor configs shipped next to this file
+STANDIN_PROCESSOR_PATH = os.environ.get("OCR_STANDIN_PROCESSOR", os.path.dirname(os.path.abspath(__file__)))
+# Keeps the vision sequence short; the real processor allows ~12.8M pixels
+STANDIN_MAX_PIXELS = int(os.environ.get("OCR_STANDIN_MAX_PIXELS", str(256 * 28 * 28)))
+
+def standin_config(vocab_size: int) -> Qwen2VLConfig:
+    return Qwen2VLConfig(
+        vocab_size=vocab_size,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=4096,
+        rope_scaling={"type": "mrope", "mrope_section": [2, 3, 3]},
+        vision_config={
+            "depth": 1,
+            "embed_dim": 32,
+            "hidden_size": 64,
+            "num_heads": 2,
+            "mlp_ratio": 2,
+            "in_chans": 3,
+            "patch_size": 14,
+            "spatial_merge_size": 2,
+            "temporal_patch_size": 2,
+        },
+        vision_start_token_id=151652,
+        vision_end_token_id=151653,
+        image_token_id=151655,
+        video_token_id=151656,
+        bos_token_id=151643,
+        eos_token_id=151645,
+    )
+
+def _standin_processor(config: ModelConfig, **defaults):
+    processor = AutoProcessor.from_pretrained(
+        STANDIN_PROCESSOR_PATH,
+        use_fast=True,
+        local_files_only=True,
+        **{**defaults, **config.processor_kwargs()},
+    )
+    log.info("Stand-in processor loaded from %s", STANDIN_PROCESSOR_PATH)
+    return processor
+
+def load_standin(with_model: bool = True, config: ModelConfig | None = None, seed: int = 0):
+    """Loader with the same contract as model_loader.load_olmocr, always on CPU in float32.
+
+    Of the model config only OCR_QUANTIZE and the pixel bounds apply.
+    """
+    config = config or ModelConfig.from_env()
+    device = torch.device("cpu")
+    processor = _standin_processor(config, max_pixels=STANDIN_MAX_PIXELS)
+    if not with_model:
+        return None, processor, device
+
+    torch.manual_seed(seed)
+    model = Qwen2VLForConditionalGeneration(standin_config(len(processor.tokenizer))).to(torch.float32).eval()
+    params = sum(p.numel() for p in model.parameters())
+    if config.quantize == "int8":
+        model = quantize_int8(model)
+    log.info("Stand-in model built (%.1fM parameters%s)", params / 1e6,
+             ", int8 dynamic" if config.quantize == "int8" else "")
+    return model, processor, device
+
+class TimingStubModel(torch.nn.Module):
+    """A model that sleeps instead of computing.
+
+    Prefill takes ``prefill_ms_per_1k`` per thousand prompt tokens (vision
+    tokens included, so page size still matters) and every decoding step
+    ``decode_ms`` for the whole batch. Rows get random tokens, ``tokens`` of
+    them unless a stopping criterion ends them earlier; the streamer and
+    stopping criteria are driven as ``generate`` would drive them.
+
+    The KV cache is a placeholder: one layer of zeros with the real sequence
+    length and nothing else. ``forward`` (the prefix cache's prefill) and
+    ``generate`` extend it, and ``generate`` only charges prefill time for the
+    prompt tokens a passed-in cache does not cover, so prefix-cache and
+    chat-session savings show up in timings as they would on the real model.
+    """
+
+    def __init__(self, config: Qwen2VLConfig, prefill_ms_per_1k: float = 50.0, decode_ms: float = 20.0,
+                 tokens: int = 100, seed: int = 0):
+        super().__init__()
+        self.config = config
+        self.prefill_ms_per_1k = prefill_ms_per_1k
+        self.decode_ms = decode_ms
+        self.tokens = tokens
+        self.rope_deltas = None
+        self._generator = torch.Generator().manual_seed(seed)
+
+    @staticmethod
+    def _extend(cache: DynamicCache, batch: int, count: int):
+        if count > 0:
+            zeros = torch.zeros(batch, 1, count, 1)
+            cache.update(zeros, zeros, 0)
+
+    def forward(self, input_ids, past_key_values=None, **kwargs):
+        """Prefill ``input_ids`` on top of ``past_key_values``; returns no logits."""
+        time.sleep(self.prefill_ms_per_1k * input_ids.numel() / 1e6)
+        cache = past_key_values if past_key_values is not None else DynamicCache()
+        self._extend(cache, input_ids.shape[0], input_ids.shape[1])
+        return CausalLMOutputWithPast(logits=None, past_key_values=cache)
+
+    def get_rope_index(self, input_ids, mm_token_type_ids=None, image_grid_thw=None, video_grid_thw=None,
+                       attention_mask=None, **kwargs):
+        """Plain 1D positions in Qwen2-VL's 3-section layout, and no offset for decoding.
+
+        The signature is transformers 5's, which prefix_cache.rope_index calls by keyword.
+        """
+        if attention_mask is None:
+            positions = torch.arange(input_ids.shape[1]).expand_as(input_ids)
+        else:
+            positions = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+        return positions.expand(3, *positions.shape), torch.zeros(input_ids.shape[0], 1, dtype=torch.long)
+
+    def generate(self, input_ids, attention_mask=None, max_new_tokens: int = 512, stopping_criteria=None,
+                 streamer=None, pad_token_id: int | None = None, past_key_values=None, **kwargs):
+        batch = input_ids.shape[0]
+        cached = past_key_values.get_seq_length() if past_key_values is not None else 0
+        if attention_mask is not None:
+            prompt_tokens = int(attention_mask[:, cached:].sum())
+        else:
+            prompt_tokens = input_ids[:, cached:].numel()
+        time.sleep(self.prefill_ms_per_1k * prompt_tokens / 1e6)
+        if streamer is not None:
+            streamer.put(input_ids)
+        ids = input_ids
+        running = torch.ones(batch, dtype=torch.bool)
+        pad = pad_token_id if pad_token_id is not None else self.config.eos_token_id
+        for _ in range(min(max_new_tokens, self.tokens)):
+            time.sleep(self.decode_ms / 1000)
+            # Ordinary vocabulary tokens, so the text decodes to words
+            step = torch.randint(1000, 100000, (batch, 1), generator=self._generator)
+            step[~running] = pad
+            ids = torch.cat([ids, step], dim=1)
+            if streamer is not None:
+                streamer.put(step)
+            if stopping_criteria:
+                running &= ~stopping_criteria(ids, None)
+                if not running.any():
+                    break
+        if streamer is not None:
+            streamer.end()
+        if past_key_values is not None:
+            self._extend(past_key_values, batch, ids.shape[1] - cached)
+        return ids
+
+def load_timing_stub(with_model: bool = True, config: ModelConfig | None = None):
+    """Loader returning the real processor and a TimingStubModel.
+
+    Pages are sized as for the real model (the processor's own pixel bounds,
+    or OCR_MIN_PIXELS / OCR_MAX_PIXELS). OCR_STUB_PREFILL_MS_PER_1K,
+    OCR_STUB_DECODE_MS and OCR_STUB_TOKENS set the simulated speed.
+    """
+    config = config or ModelConfig.from_env()
+    device = torch.device("cpu")
+    processor = _standin_processor(config)
+    if not with_model:
+        return None, processor, device
+    model = TimingStubModel(
+        standin_config(len(processor.tokenizer)),
+        prefill_ms_per_1k=float(os.environ.get("OCR_STUB_PREFILL_MS_PER_1K", "50")),
+        decode_ms=float(os.environ.get("OCR_STUB_DECODE_MS", "20")),
+        tokens=int(os.environ.get("OCR_STUB_TOKENS", "100")),
+    )
+    log.info("Timing stub model (%s ms per 1k prompt tokens, %s ms per step, %d tokens per page)",
+             model.prefill_ms_per_1k, model.decode_ms, model.tokens)
+    return model, processor, device
@@ -0,0 +1,141 @@
+# synthetic_corpus.py - generated test documents for benchmark.py
+#
+# Scanned-looking pages (text drawn into an image, no text layer) at a chosen
+# paper size, DPI and text density, saved as multi-page PDFs or single
+# images. Generation is seeded, so the same spec always gives the same file
+# and benchmark runs on different commits see identical input.
+import os, random
+
+from PIL import Image, ImageDraw, ImageFont
+
+# Paper sizes in inches
+PAGE_SIZES = {
+    "letter": (8.5, 11.0),
+    "a4": (8.27, 11.69),
+    "a5": (5.83, 8.27),
+    "slide": (13.33, 7.5),
+}
+
+# Fraction of the page's lines that carry text, and the font size in points
+DENSITIES = {
+    "blank": (0.0, 11),
+    "sparse": (0.2, 12),
+    "normal": (0.7, 11),
+    "dense": (1.0, 8),
+}
+
+class DocumentSpec:
+    """One synthetic document: ``kind`` is "pdf" or "png" (a single page)."""
+
+    def __init__(self, kind: str = "pdf", pages: int = 1, size: str = "letter", dpi: int = 150,
+                 density: str = "normal"):
+        if kind not in ("pdf", "png"):
+            raise ValueError(f"Unknown document kind '{kind}'. Available: pdf, png")
+        if size not in PAGE_SIZES:
+            raise ValueError(f"Unknown page size '{size}'. Available: {', '.join(PAGE_SIZES)}")
+        if density not in DENSITIES:
+            raise ValueError(f"Unknown text density '{density}'. Available: {', '.join(DENSITIES)}")
+        self.kind = kind
+        self.pages = 1 if kind == "png" else max(1, pages)
+        self.size = size
+        self.dpi = dpi
+        self.density = density
+
+    @classmethod
+    def parse(cls, spec: str) -> "DocumentSpec":
+        """``"pages=4,size=a4,dpi=200,density=dense"`` -> DocumentSpec (kind defaults to pdf)."""
+        kwargs = {}
+        for item in filter(None, (part.strip() for part in spec.split(","))):
+            key, sep, value = item.partition("=")
+            if not sep or key not in ("kind", "pages", "size", "dpi", "density"):
+                raise ValueError(f"Bad document spec item '{item}'. Keys: kind, pages, size, dpi, density")
+            kwargs[key] = int(value) if key in ("pages", "dpi") else value
+        return cls(**kwargs)
+
+    @property
+    def name(self) -> str:
+        return f"{self.kind}-{self.pages}p-{self.size}-{self.dpi}dpi-{self.density}"
+
+    def describe(self) -> dict:
+        return {"name": self.name, "kind": self.kind, "pages": self.pages, "size": self.size,
+                "dpi": self.dpi, "density": self.density}
+
+CORPORA = {
+    # A quick check that every path works
+    "smoke": [
+        DocumentSpec("pdf", 2, "letter", 150, "normal"),
+        DocumentSpec("png", 1, "a4", 200, "dense"),
+    ],
+    # Page counts, sizes, resolutions and densities seen in practice
+    "standard": [
+        DocumentSpec("pdf", 1, "letter", 150, "sparse"),
+        DocumentSpec("pdf", 4, "letter", 150, "normal"),
+        DocumentSpec("pdf", 4, "a4", 300, "dense"),
+        DocumentSpec("pdf", 12, "letter", 200, "normal"),
+        DocumentSpec("pdf", 3, "slide", 96, "sparse"),
+        DocumentSpec("pdf", 2, "a5", 150, "blank"),
+        DocumentSpec("png", 1, "letter", 300, "dense"),
+        DocumentSpec("png", 1, "a4", 150, "normal"),
+    ],
+}
+
+def _font(pixels: int):
+    try:
+        return ImageFont.load_default(size=pixels)
+    except TypeError:  # Pillow < 10.1 only has the fixed-size bitmap font
+        return ImageFont.load_default()
+
+def _words(rng: random.Random, count: int) -> list[str]:
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(rng.choice(letters) for _ in range(rng.randint(2, 10))) for _ in range(count)]
+
+def render_synthetic_page(spec: DocumentSpec, rng: random.Random) -> Image.Image:
+    """A white page with lines of random words, like a scanned text page."""
+    width_in, height_in = PAGE_SIZES[spec.size]
+    width, height = round(width_in * spec.dpi), round(height_in * spec.dpi)
+    img = Image.new("L", (width, height), 255)
+    fill, points = DENSITIES[spec.density]
+    if not fill:
+        return img
+
+    draw = ImageDraw.Draw(img)
+    font = _font(max(6, round(points / 72 * spec.dpi)))
+    line_height = round(points / 72 * spec.dpi * 1.4)
+    margin = spec.dpi  # one inch
+    y = margin
+    while y + line_height < height - margin:
+        if rng.random() < fill:
+            line, x = [], margin
+            for word in _words(rng, 40):
+                x += draw.textlength(word + " ", font=font)
+                if x > width - margin:
+                    break
+                line.append(word)
+            draw.text((margin, y), " ".join(line), fill=0, font=font)
+        y += line_height
+    return img
+
+def _path(spec: DocumentSpec, directory: str, seed: int) -> str:
+    return os.path.join(directory, f"{spec.name}-seed{seed}.{spec.kind}")
+
+def write_document(spec: DocumentSpec, directory: str, seed: int = 0) -> str:
+    """Write the document into ``directory`` and return its path."""
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(f"{seed}:{spec.name}")
+    path = _path(spec, directory, seed)
+    pages = [render_synthetic_page(spec, rng) for _ in range(spec.pages)]
+    if spec.kind == "png":
+        pages[0].save(path, format="PNG")
+    else:
+        pages[0].save(path, format="PDF", save_all=True, append_images=pages[1:], resolution=spec.dpi)
+    return path
+
+def build_corpus(specs: list[DocumentSpec], directory: str, seed: int = 0) -> list[tuple[DocumentSpec, str]]:
+    """Write every document not already in ``directory``; returns (spec, path) pairs."""
+    documents = []
+    for spec in specs:
+        path = _path(spec, directory, seed)
+        if not os.path.exists(path):
+            path = write_document(spec, directory, seed)
+        documents.append((spec, path))
+    return documents
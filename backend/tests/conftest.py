@@ -0,0 +1,35 @@
+import importlib, os
+
+import pytest
+
+from model_loader import ModelConfig
+from standin_model import load_standin
+from synthetic_corpus import DocumentSpec, write_document
+
+@pytest.fixture(scope="session")
+def standin():
+    """The tiny random stand-in model (standin_model.py): (model, processor, device)."""
+    return load_standin(config=ModelConfig())
+
+@pytest.fixture(scope="session")
+def server(tmp_path_factory):
+    """The server module, with its job queue, previews and caches in a temp dir.
+
+    ocr_olm and server read their settings when imported, so tests import
+    them only through this fixture.
+    """
+    root = tmp_path_factory.mktemp("server")
+    os.environ.update(OCR_JOBS_PATH=str(root / "jobs.sqlite3"), OCR_JOBS_DIR=str(root / "jobs"),
+                      OCR_PREVIEW_DIR=str(root / "previews"), OCR_CACHE="0", ANALYSIS_CACHE="0",
+                      OCR_MODEL_WORKERS="0", OCR_WARMUP="0", OCR_MODEL_LOADER="standin_model:load_standin")
+    return importlib.import_module("server")
+
+@pytest.fixture(scope="session")
+def make_pdf(tmp_path_factory):
+    """``make_pdf(pages, size="letter", dpi=72, density="normal")`` -> path of a generated text PDF."""
+    directory = str(tmp_path_factory.mktemp("pdfs"))
+
+    def make(pages: int, size: str = "letter", dpi: int = 72, density: str = "normal") -> str:
+        return write_document(DocumentSpec(pages=pages, size=size, dpi=dpi, density=density), directory)
+
+    return make
@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from analysis_cache import AnalysisCache, document_digest
+from scheduler import GenerationJob, InferenceScheduler
+
+DOCUMENT = "\n\n---\n\n".join(
+    f"Page {page} (report.pdf):\nQuarterly report, section {page}. Revenue grew in every region "
+    f"and the board approved the budget for the next year on March {page}."
+    for page in range(1, 5))
+
+@pytest.fixture
+def scheduler(server, standin, monkeypatch):
+    scheduler = InferenceScheduler(*standin, max_batch_size=8, max_wait_ms=50)
+    monkeypatch.setattr(server, "SCHEDULER", scheduler)
+    yield scheduler
+    scheduler.stop()
+
+def test_analyses_share_the_document_prefix(server, scheduler):
+    kinds = ["summary", "key_points", "entities"]
+    results = asyncio.run(server._run_analyses(DOCUMENT, "report.pdf", kinds))
+    assert list(results) == kinds
+    assert all(result["prefix_tokens"] > 0 for result in results.values())
+    stats = scheduler.stats()
+    assert stats["batches"] == 1
+    assert stats["prefix_cache"]["enabled"]
+    assert stats["prefix_cache"]["prefill_tokens_saved"] > 0
+
+def _text_jobs():
+    return [GenerationJob([{"role": "user", "content": [{"type": "text", "text": f"Content: {DOCUMENT}\n\n{ask}"}]}],
+                          gen_kwargs={"do_sample": False}, max_new_tokens=12, cache_prefix=True)
+            for ask in ("Summarize it.", "List the dates mentioned in it, one per line.")]
+
+def test_text_prefix_gives_the_same_output_as_a_full_prefill(standin):
+    texts = []
+    for entries in (4, 0):
+        scheduler = InferenceScheduler(*standin, max_batch_size=4, max_wait_ms=50, prefix_cache_entries=entries)
+        try:
+            texts.append([future.result(timeout=300).text for future in scheduler.submit_many(_text_jobs())])
+        finally:
+            scheduler.stop()
+    assert texts[0] == texts[1]
+
+@pytest.fixture
+def cache(tmp_path):
+    return AnalysisCache(str(tmp_path / "analysis.sqlite3"), max_entries=3)
+
+def test_document_digest():
+    assert document_digest("text", "a.pdf") == document_digest("text", "a.pdf")
+    assert document_digest("text", "a.pdf") != document_digest("text", "b.pdf")
+    assert document_digest("text") != document_digest("other")
+
+def test_cached_analyses_are_hits(cache):
+    document = document_digest(DOCUMENT, "report.pdf")
+    assert cache.get_many(document, ["summary", "dates"], "v1") == {}
+    cache.put(document, "summary", "v1", "A summary.", 1)
+    assert cache.get_many(document, ["summary", "dates"], "v1") == {"summary": {"analysis": "A summary.",
+                                                                                 "sections": 1}}
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 3, 1)
+
+def test_a_new_model_version_misses(cache):
+    document = document_digest(DOCUMENT, "report.pdf")
+    cache.put(document, "summary", "v1", "A summary.", 1)
+    assert cache.get_many(document, ["summary"], "v2") == {}
+    assert cache.get_many(document_digest(DOCUMENT, "other.pdf"), ["summary"], "v1") == {}
+
+def test_least_recently_used_are_evicted(cache, monkeypatch):
+    import analysis_cache
+    ticks = iter(range(1000, 2000))
+    monkeypatch.setattr(analysis_cache.time, "time", lambda: float(next(ticks)))
+    for kind in ("summary", "key_points", "entities"):
+        cache.put("doc", kind, "v1", kind, 1)
+    cache.get_many("doc", ["summary"], "v1")
+    cache.put("doc", "dates", "v1", "dates", 1)
+    assert set(cache.get_many("doc", ["summary", "key_points", "entities", "dates"], "v1")) == {
+        "summary", "entities", "dates"}
+    assert cache.stats()["evictions"] == 1
@@ -0,0 +1,146 @@
+import asyncio
+
+import pytest
+import torch
+from transformers import DynamicCache
+
+import chat_sessions
+from chat_sessions import ChatSession, ChatSessionStore
+from prefix_cache import ConversationCache, cache_layers, trim_cache
+from scheduler import GenerationJob, InferenceScheduler
+
+DOCUMENT = ("Invoice 42 from Acme Corporation, dated 3 March. Payment of 1,200 euros is due within "
+            "thirty days. Late payment adds two percent interest per month.")
+
+def _text(role, content):
+    return {"role": role, "content": [{"type": "text", "text": content}]}
+
+@pytest.fixture
+def scheduler(standin):
+    scheduler = InferenceScheduler(*standin, max_batch_size=4, max_wait_ms=10)
+    yield scheduler
+    scheduler.stop()
+
+def _generate(scheduler, messages, state=None):
+    return scheduler.submit(GenerationJob(messages, gen_kwargs={"do_sample": False}, max_new_tokens=8,
+                                          session_state=state)).result(timeout=300)
+
+def _prompt_ids(standin, messages) -> list[int]:
+    _, processor, _ = standin
+    text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    return processor(text=[text], return_tensors="pt")["input_ids"][0].tolist()
+
+def test_next_turn_reuses_the_session_cache(standin, scheduler):
+    state = ConversationCache()
+    first = [_text("system", f"Document: {DOCUMENT}"), _text("user", "Who sent the invoice?")]
+    reply = _generate(scheduler, first, state)
+    assert reply.prefix_tokens == 0
+    assert state.ids == _prompt_ids(standin, first)
+
+    second = first + [_text("assistant", reply.text), _text("user", "When is payment due?")]
+    second_ids = _prompt_ids(standin, second)
+    reusable = state.reusable(second_ids)
+    assert 0 < reusable < len(second_ids)
+    turn = _generate(scheduler, second, state)
+    assert turn.prefix_tokens == reusable
+    # The same prompt prefilled in full gives the same reply
+    assert turn.text == _generate(scheduler, second).text
+
+    # The cache holds exactly the prompt, with the keys a full prefill computes
+    assert state.ids == second_ids
+    assert state.cache.get_seq_length() == len(second_ids)
+    model = standin[0]
+    with torch.no_grad():
+        full = model(input_ids=torch.tensor([second_ids]), use_cache=True).past_key_values
+    for (keys, values), (full_keys, full_values) in zip(cache_layers(state.cache), cache_layers(full)):
+        assert torch.allclose(keys, full_keys, atol=1e-5)
+        assert torch.allclose(values, full_values, atol=1e-5)
+
+def test_reusable():
+    state = ConversationCache()
+    assert state.reusable([1, 2, 3]) == 0  # nothing cached yet
+    state.cache, state.ids = DynamicCache(), [1, 2, 3, 4]
+    assert state.reusable([1, 2, 3, 4, 5, 6]) == 4
+    assert state.reusable([1, 2, 9, 4, 5]) == 2
+    assert state.reusable([1, 2, 3, 4]) == 3  # at least one token is left to run
+    state.drop()
+    assert state.reusable([1, 2, 3, 4, 5]) == 0
+
+def test_trim_cache_keeps_the_leading_tokens():
+    cache = DynamicCache()
+    keys = torch.arange(10.0).view(1, 1, 10, 1)
+    cache.update(keys, -keys, 0)
+    trim_cache(cache, 12)
+    assert cache.get_seq_length() == 10
+    trim_cache(cache, 6)
+    assert cache.get_seq_length() == 6
+    (trimmed, values), = cache_layers(cache)
+    assert trimmed.flatten().tolist() == [0, 1, 2, 3, 4, 5]
+    assert values.flatten().tolist() == [0, -1, -2, -3, -4, -5]
+    trim_cache(cache, 6)
+    assert cache.get_seq_length() == 6
+
+def _session(nbytes: int = 0) -> ChatSession:
+    session = ChatSession("doc.pdf", DOCUMENT, context_chars=1000)
+    if nbytes:
+        session.cache.cache, session.cache.ids, session.cache.nbytes = DynamicCache(), [1], nbytes
+    return session
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(chat_sessions.time, "time", lambda: now[0])
+    return now
+
+def test_sessions_beyond_the_limit_or_idle_are_evicted(clock):
+    store = ChatSessionStore(max_sessions=2, ttl=60)
+    sessions = [store.add(_session(nbytes=10)) for _ in range(3)]
+    assert store.get(sessions[0].id) is None
+    assert sessions[0].cache.cache is None  # its cache is freed
+    assert store.get(sessions[1].id) is sessions[1]
+    clock[0] += 61
+    assert store.get(sessions[2].id) is None
+    assert store.stats()["sessions"] == 0 and store.evicted == 3
+
+def test_caches_are_dropped_under_the_memory_cap(clock):
+    store = ChatSessionStore(max_cache_bytes=150)
+    oldest, middle, newest = (store.add(_session(nbytes=100)) for _ in range(3))
+    assert (oldest.cache.nbytes, middle.cache.nbytes, newest.cache.nbytes) == (0, 0, 100)
+    assert store.caches_dropped == 2
+    # The sessions stay usable and prefill in full next time
+    assert store.get(oldest.id) is oldest
+
+def test_a_cache_in_use_is_not_dropped(clock):
+    store = ChatSessionStore(max_cache_bytes=150)
+    busy = store.add(_session(nbytes=100))
+    busy.cache.lock.acquire()
+    try:
+        idle = store.add(_session(nbytes=100))
+        newest = store.add(_session(nbytes=100))
+    finally:
+        busy.cache.lock.release()
+    assert (busy.cache.nbytes, idle.cache.nbytes, newest.cache.nbytes) == (100, 0, 100)
+
+def test_deleting_a_session(server, standin, monkeypatch):
+    scheduler = InferenceScheduler(*standin, max_batch_size=1, max_wait_ms=0)
+    monkeypatch.setattr(server, "SCHEDULER", scheduler)
+
+    async def run():
+        created = await server.create_chat_session(extracted_text=DOCUMENT, document_name="doc.pdf")
+        session = server.CHAT_SESSIONS.get(created["session_id"])
+        for _ in range(500):  # the document context is prefilled in the background
+            if session.cache.nbytes:
+                break
+            await asyncio.sleep(0.01)
+        assert session.cache.nbytes
+        assert (await server.delete_chat_session(session.id)) == {"success": True}
+        assert session.cache.cache is None
+        assert server.CHAT_SESSIONS.get(session.id) is None
+        assert (await server.delete_chat_session(session.id)).status_code == 404
+        missing = await server.chat_session_message(session.id, message="Hello?")
+        assert missing.status_code == 404
+
+    try:
+        asyncio.run(run())
+    finally:
+        scheduler.stop()
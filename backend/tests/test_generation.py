@@ -0,0 +1,57 @@
+import pytest
+import torch
+
+from generation import (GENERATION_PROFILES, MIN_TOKEN_BUDGET, RepetitionStoppingCriteria,
+                        TokenBudgetStoppingCriteria, get_profile, token_budget)
+
+PAD, EOS = 0, 1
+
+def test_get_profile():
+    assert get_profile("fast") == ("fast", GENERATION_PROFILES["fast"])
+    name, _ = get_profile(None)
+    assert name in GENERATION_PROFILES
+    with pytest.raises(ValueError):
+        get_profile("nope")
+
+def test_token_budget():
+    profile = GENERATION_PROFILES["accurate"]
+    assert token_budget(profile, None) == profile["max_new_tokens"]
+    assert token_budget(profile, 10) == MIN_TOKEN_BUDGET
+    assert token_budget(profile, 10**6) == profile["max_new_tokens"]
+    budget = token_budget(profile, 1000)
+    assert budget % 256 == 0 and MIN_TOKEN_BUDGET <= budget <= profile["max_new_tokens"]
+
+def test_token_budget_stops_each_row_at_its_own_budget():
+    criterion = TokenBudgetStoppingCriteria([2, 4], prompt_length=3)
+    assert criterion(torch.zeros(2, 4, dtype=torch.long), None).tolist() == [False, False]
+    assert criterion(torch.zeros(2, 5, dtype=torch.long), None).tolist() == [True, False]
+    assert criterion(torch.zeros(2, 7, dtype=torch.long), None).tolist() == [True, True]
+
+def _rows(*rows):
+    return torch.tensor(rows, dtype=torch.long)
+
+def _criterion(rows, **kwargs):
+    return RepetitionStoppingCriteria(prompt_length=2, enabled=[True] * rows, window=8,
+                                      max_period=3, check_every=1, **kwargs)
+
+def test_repetition_stops_a_looping_row():
+    criterion = _criterion(2)
+    looping = [9, 9] + [5, 6] * 4
+    varied = [9, 9] + list(range(10, 18))
+    assert criterion(_rows(looping, varied), None).tolist() == [True, False]
+    assert criterion.stopped == [True, False]
+
+def test_repetition_only_checks_enabled_rows():
+    criterion = RepetitionStoppingCriteria(prompt_length=2, enabled=[False], window=8, check_every=1)
+    assert criterion(_rows([9, 9] + [5] * 8), None).tolist() == [False]
+
+def test_repetition_skips_rows_that_finished():
+    # A row that hit EOS is padded while the batch runs on; the padding is not a loop
+    criterion = _criterion(2, end_ids=[PAD, EOS])
+    finished = [9, 9, EOS] + [PAD] * 8
+    looping = [9, 9, 7] + [5, 6] * 4
+    assert criterion(_rows(finished, looping), None).tolist() == [False, True]
+    assert criterion.finished == [True, False]
+    assert criterion.stopped == [False, True]
+    # Without end ids the padding looks like a loop
+    assert _criterion(1)(_rows(finished), None).tolist() == [True]
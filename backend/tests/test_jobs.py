@@ -0,0 +1,139 @@
+import asyncio, os
+
+import pytest
+
+from jobs import JobRunner, JobStore
+from preview_store import PreviewStore
+
+@pytest.fixture
+def paths(tmp_path):
+    return str(tmp_path / "jobs.sqlite3"), str(tmp_path / "files")
+
+def _create(store: JobStore, options: dict | None = None) -> tuple[str, str]:
+    job_id, path = store.new_file_path("scan.pdf")
+    with open(path, "wb") as fh:
+        fh.write(b"%PDF")
+    store.create(job_id, "scan.pdf", path, options or {"previews": False})
+    return job_id, path
+
+def test_create_claim_and_finish(paths):
+    store = JobStore(*paths)
+    job_id, path = _create(store)
+    job = store.get(job_id)
+    assert (job["status"], job["total_pages"], job["completed_pages"]) == ("queued", None, 0)
+    assert job["file_path"] == path and path.endswith(".pdf")
+    assert store.claim()["id"] == job_id
+    assert store.claim() is None
+    store.finish(job_id, "done", summary={"total_pages": 0})
+    job = store.get(job_id)
+    assert (job["status"], job["summary"]) == ("done", {"total_pages": 0})
+    assert not os.path.exists(path)  # the input is dropped once finished
+
+def test_pages_are_paginated_in_page_order(paths):
+    store = JobStore(*paths)
+    job_id, _ = _create(store)
+    for page in (3, 1, 5, 2, 4):
+        store.add_page(job_id, {"page": page, "text": f"page {page}"})
+    assert [page["page"] for page in store.pages(job_id, 1, 2)] == [1, 2]
+    assert [page["page"] for page in store.pages(job_id, 3, 2)] == [3, 4]
+    assert [page["page"] for page in store.pages(job_id, 5, 2)] == [5]
+    assert store.pages(job_id, 6, 2) == []
+    assert store.done_pages(job_id) == {1, 2, 3, 4, 5}
+    assert store.get(job_id)["completed_pages"] == 5
+
+def test_prune_drops_only_old_finished_jobs(paths):
+    store = JobStore(*paths)
+    done, _ = _create(store)
+    queued, _ = _create(store)
+    store.finish(done, "done")
+    assert store.prune(3600) == []
+    assert store.prune(-1) == [done]
+    assert store.get(done) is None and store.get(queued) is not None
+
+class Stream:
+    """A stand-in for stream_ocr_file over a ``total``-page document that
+    blocks after ``stop_after`` pages (until the runner is cancelled)."""
+
+    def __init__(self, total: int, stop_after: int | None = None):
+        self.total = total
+        self.stop_after = stop_after
+        self.calls = []
+
+    async def __call__(self, job_id, path, options, skip_pages):
+        self.calls.append(set(skip_pages))
+        for page in range(1, self.total + 1):
+            if page == self.stop_after:
+                await asyncio.Event().wait()
+            if page in skip_pages:
+                continue
+            yield {"type": "page_start", "page": page, "total_pages": self.total}
+            yield {"type": "page_complete", "page": page, "total_pages": self.total, "text": f"page {page}"}
+        yield {"type": "processing_complete", "status": "done", "total_pages": self.total}
+
+async def _until(predicate, timeout: float = 5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.01)
+
+def test_interrupted_job_resumes_after_its_stored_pages(paths):
+    async def run():
+        store = JobStore(*paths)
+        job_id, _ = _create(store)
+        first = Stream(total=4, stop_after=3)
+        runner = JobRunner(store, first, poll_interval=0.01)
+        await runner.start()
+        await _until(lambda: store.get(job_id)["completed_pages"] == 2)
+        await runner.stop()  # the process goes away mid-job
+        assert store.get(job_id)["status"] == "running"
+
+        store = JobStore(*paths)  # restart
+        resumed = Stream(total=4)
+        runner = JobRunner(store, resumed, poll_interval=0.01)
+        await runner.start()
+        await _until(lambda: store.get(job_id)["status"] == "done")
+        await runner.stop()
+        assert resumed.calls == [{1, 2}]
+        assert [page["page"] for page in store.pages(job_id)] == [1, 2, 3, 4]
+        assert store.get(job_id)["total_pages"] == 4
+
+    asyncio.run(run())
+
+def test_failed_stream_fails_the_job(paths):
+    async def broken(job_id, path, options, skip_pages):
+        yield {"type": "page_start", "page": 1, "total_pages": 1}
+        raise RuntimeError("renderer crashed")
+
+    async def run():
+        store = JobStore(*paths)
+        job_id, _ = _create(store)
+        runner = JobRunner(store, broken, poll_interval=0.01)
+        await runner.start()
+        await _until(lambda: store.get(job_id)["status"] == "failed")
+        await runner.stop()
+        assert store.get(job_id)["error"] == "renderer crashed"
+
+    asyncio.run(run())
+
+def test_job_previews_last_as_long_as_the_job(paths, tmp_path):
+    previews = PreviewStore(str(tmp_path / "previews"), ttl=0)
+
+    async def stream(job_id, path, options, skip_pages):
+        yield {"type": "page_complete", "page": 1, "total_pages": 1,
+               "preview": previews.put(job_id, 1, b"jpeg")}
+        yield {"type": "processing_complete", "total_pages": 1}
+
+    async def run():
+        store = JobStore(*paths)
+        job_id, _ = _create(store, {"previews": True})
+        runner = JobRunner(store, stream, poll_interval=0.01, retention=3600, previews=previews)
+        await runner.start()
+        await _until(lambda: store.get(job_id)["status"] == "done")
+        previews.new_job()  # runs the TTL cleanup
+        assert previews.get(job_id, 1) is not None
+        runner.retention, runner._last_prune = -1, None
+        await _until(lambda: store.get(job_id) is None)
+        await runner.stop()
+        assert previews.get(job_id, 1) is None
+
+    asyncio.run(run())
@@ -0,0 +1,27 @@
+# load_olmocr against the stand-in model saved as a checkpoint directory
+import pytest
+import torch
+
+from model_loader import ModelConfig, load_olmocr
+
+pytest.importorskip("accelerate")  # from_pretrained needs it for device_map
+
+@pytest.fixture(scope="module")
+def checkpoint(standin, tmp_path_factory):
+    model, processor, _ = standin
+    path = tmp_path_factory.mktemp("checkpoint")
+    model.save_pretrained(path / "model")
+    processor.save_pretrained(path / "processor")
+    return path
+
+@pytest.mark.parametrize("mmap", [False, True])
+@pytest.mark.parametrize("dtype", ["float32", "bfloat16", "auto"])
+def test_load_olmocr_reads_the_saved_weights(standin, checkpoint, mmap, dtype):
+    config = ModelConfig(model_path=str(checkpoint / "model"), processor_path=str(checkpoint / "processor"),
+                         device="cpu", dtype=dtype, mmap=mmap)
+    model, processor, device = load_olmocr(config=config)
+    expected = torch.bfloat16 if dtype == "bfloat16" else torch.float32
+    assert device.type == "cpu"
+    for (name, loaded), original in zip(model.named_parameters(), standin[0].parameters()):
+        assert loaded.dtype == expected, name
+        assert torch.equal(loaded, original.to(expected)), name
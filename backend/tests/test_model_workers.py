@@ -0,0 +1,65 @@
+# ModelWorkerPool with the timing stub (standin_model.py) in spawned worker
+# processes: generation sleeps, so a job can be caught mid-run
+import os, signal, threading, time
+
+import pytest
+
+from model_workers import ModelWorkerPool
+from scheduler import GenerationJob
+
+@pytest.fixture
+def pool(monkeypatch):
+    # Read by the worker processes' loader: 60 tokens at 50 ms each
+    monkeypatch.setenv("OCR_STUB_TOKENS", "60")
+    monkeypatch.setenv("OCR_STUB_DECODE_MS", "50")
+    pool = ModelWorkerPool(1, "standin_model:load_timing_stub", {"max_batch_size": 4, "max_wait_ms": 10},
+                           startup_timeout=120)
+    pool.start()
+    yield pool
+    pool.stop()
+
+def _wait_for(condition, timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+def test_job_of_a_killed_worker_is_requeued_once_and_completes(pool):
+    chunks, streaming = [], threading.Event()
+
+    def on_text(chunk):
+        chunks.append(chunk)
+        streaming.set()
+
+    job = GenerationJob([{"role": "user", "content": [{"type": "text", "text": "page text"}]}],
+                        gen_kwargs={"do_sample": False}, max_new_tokens=60, on_text=on_text)
+    future = pool.submit(job)
+    assert streaming.wait(120), "the job never started"
+
+    worker = pool.stats()["workers"][0]
+    assert worker["inflight"] == 1
+    os.kill(worker["pid"], signal.SIGKILL)
+
+    output = future.result(timeout=180)
+    stats = pool.stats()
+    assert stats["requeued_jobs"] == 1
+    assert stats["failed_jobs"] == 0
+    assert stats["workers"][0]["restarts"] == 1
+    assert stats["workers"][0]["pid"] != worker["pid"]
+    assert output.tokens == 60
+    # The retry streams the same tokens again; only the unseen part is passed on
+    _wait_for(lambda: len("".join(chunks)) >= len(output.text), 5)
+    assert "".join(chunks) == output.text
+
+def test_a_job_is_failed_once_out_of_retries(pool):
+    pool.max_retries = 0
+    streaming = threading.Event()
+    job = GenerationJob([{"role": "user", "content": [{"type": "text", "text": "page text"}]}],
+                        gen_kwargs={"do_sample": False}, max_new_tokens=60,
+                        on_text=lambda chunk: streaming.set())
+    future = pool.submit(job)
+    assert streaming.wait(120), "the job never started"
+    os.kill(pool.stats()["workers"][0]["pid"], signal.SIGKILL)
+    with pytest.raises(RuntimeError, match="Model worker died"):
+        future.result(timeout=60)
+    assert pool.stats()["failed_jobs"] == 1
@@ -0,0 +1,55 @@
+import itertools
+
+import pytest
+
+import ocr_cache
+from ocr_cache import OCRCache, file_digest, path_digest, settings_digest
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Distinct access times, so the LRU order does not depend on the clock's resolution
+    ticks = itertools.count(1000)
+    monkeypatch.setattr(ocr_cache.time, "time", lambda: float(next(ticks)))
+
+def test_digests(tmp_path):
+    path = tmp_path / "doc.pdf"
+    path.write_bytes(b"%PDF-1.4 content")
+    assert path_digest(str(path), chunk_size=4) == file_digest(b"%PDF-1.4 content")
+    assert settings_digest(a=1, b="x") == settings_digest(b="x", a=1)
+    assert settings_digest(a=1) != settings_digest(a=2)
+
+def test_put_and_lookup(tmp_path):
+    cache = OCRCache(str(tmp_path / "cache.sqlite3"), max_bytes=1 << 20)
+    assert cache.get("img1", "s") is None
+    cache.put("file1", 1, "img1", "s", "page one", b"jpg")
+    cache.put("file1", 2, "img2", "s", "page two", None)
+    assert cache.get("img1", "s") == {"text": "page one", "thumbnail": b"jpg"}
+    assert cache.get("img1", "other settings") is None
+    assert cache.lookup_file("file1", "s") == {1: {"text": "page one", "thumbnail": b"jpg"},
+                                               2: {"text": "page two", "thumbnail": None}}
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (3, 2, 2)
+    assert stats["size_bytes"] == len("page one") + 3 + len("page two")
+
+def test_replacing_an_entry_keeps_the_size_right(tmp_path):
+    cache = OCRCache(str(tmp_path / "cache.sqlite3"), max_bytes=1 << 20)
+    cache.put(None, 1, "img", "s", "aaaa", None)
+    cache.put(None, 1, "img", "s", "aa", None)
+    assert cache.stats()["size_bytes"] == 2
+
+def test_eviction_drops_least_recently_used(tmp_path, clock):
+    cache = OCRCache(str(tmp_path / "cache.sqlite3"), max_bytes=35)
+    for page in range(1, 4):
+        cache.put("file", page, f"img{page}", "s", "x" * 10, None)
+    cache.get("img1", "s")  # img2 is now the least recently used
+    cache.put("file", 4, "img4", "s", "x" * 10, None)
+    assert cache.get("img2", "s") is None
+    assert all(cache.get(f"img{page}", "s") for page in (1, 3, 4))
+    assert set(cache.lookup_file("file", "s")) == {1, 3, 4}
+    stats = cache.stats()
+    assert stats["evictions"] == 1 and stats["size_bytes"] <= 35 * 0.9
+
+def test_size_survives_reopening(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    OCRCache(path, max_bytes=1 << 20).put(None, 1, "img", "s", "text", b"jpg")
+    assert OCRCache(path, max_bytes=1 << 20).stats()["size_bytes"] == 7
@@ -0,0 +1,27 @@
+import asyncio
+
+def test_stream_loads_the_processor_off_the_event_loop(server, make_pdf, monkeypatch):
+    import ocr_olm
+    calls = []
+    real = ocr_olm.MODEL_REGISTRY.processor
+
+    def processor():
+        try:
+            asyncio.get_running_loop()
+            calls.append("event loop")
+        except RuntimeError:
+            calls.append("executor")
+        return real()
+
+    monkeypatch.setattr(ocr_olm.MODEL_REGISTRY, "processor", processor)
+    ocr_olm._resolution_policy.cache_clear()
+
+    async def run():
+        # Every page already done: the stream only sets up and finishes
+        return [event async for event in ocr_olm.stream_ocr_file(make_pdf(2), previews=False,
+                                                                   skip_pages={1, 2})]
+
+    events = asyncio.run(run())
+    assert events[-1]["type"] == "processing_complete"
+    assert events[-1]["total_pages"] == 2
+    assert calls and set(calls) == {"executor"}
@@ -0,0 +1,198 @@
+import asyncio, json
+
+import msgpack
+import pytest
+from fastapi.testclient import TestClient
+
+from outbound import MessageSender, decode_message, negotiate_encoding
+
+class FakeSocket:
+    """Records the frames a MessageSender writes; sends wait while ``gate`` is clear."""
+
+    def __init__(self, fail: Exception | None = None):
+        self.frames = []
+        self.fail = fail
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def send_text(self, text: str):
+        await self._send(("text", text))
+
+    async def send_bytes(self, data: bytes):
+        await self._send(("bytes", data))
+
+    async def _send(self, frame):
+        await self.gate.wait()
+        if self.fail is not None:
+            raise self.fail
+        self.frames.append(frame)
+
+    def events(self) -> list[dict]:
+        return [json.loads(data) if kind == "text" else msgpack.unpackb(data, raw=False)
+                for kind, data in self.frames]
+
+def test_events_go_out_in_order():
+    async def run():
+        socket = FakeSocket()
+        sender = MessageSender(socket, max_queue=4)
+        sender.start()
+        for i in range(50):
+            await sender.send({"type": "page", "page": i})
+        await sender.close()
+        return socket, sender
+
+    socket, sender = asyncio.run(run())
+    assert [event["page"] for event in socket.events()] == list(range(50))
+    assert sender.sent == 50
+    assert all(kind == "text" for kind, _ in socket.frames)
+
+def test_send_waits_while_the_queue_is_full():
+    async def run():
+        socket = FakeSocket()
+        socket.gate.clear()
+        sender = MessageSender(socket, max_queue=2)
+        sender.start()
+        await sender.send({"type": "page", "page": 0})  # taken by the writer, which then blocks
+        await asyncio.sleep(0)
+        await sender.send({"type": "page", "page": 1})
+        await sender.send({"type": "page", "page": 2})
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(sender.send({"type": "page", "page": 3}), 0.1)
+        socket.gate.set()
+        await sender.send({"type": "page", "page": 3})
+        await sender.close()
+        return socket
+
+    assert [event["page"] for event in asyncio.run(run()).events()] == [0, 1, 2, 3]
+
+def test_close_sends_what_is_still_queued():
+    async def run():
+        socket = FakeSocket()
+        socket.gate.clear()
+        sender = MessageSender(socket, coalesce=False)
+        sender.start()
+        for i in range(5):
+            await sender.send({"type": "page", "page": i})
+        asyncio.get_running_loop().call_later(0.05, socket.gate.set)
+        await sender.close()
+        return socket
+
+    assert [event["page"] for event in asyncio.run(run()).events()] == [0, 1, 2, 3, 4]
+
+def test_close_without_flush_drops_what_is_queued():
+    async def run():
+        socket = FakeSocket()
+        socket.gate.clear()
+        sender = MessageSender(socket)
+        sender.start()
+        for i in range(5):
+            await sender.send({"type": "page", "page": i})
+        await asyncio.wait_for(sender.close(flush=False), 1)
+        socket.gate.set()
+        await asyncio.sleep(0.01)
+        with pytest.raises(RuntimeError, match="closed"):
+            await sender.send({"type": "page", "page": 5})
+        return socket
+
+    assert asyncio.run(run()).frames == []
+
+def test_queued_deltas_of_a_page_are_merged():
+    events = [
+        {"type": "page_start", "page": 1},
+        {"type": "page_delta", "page": 1, "text": "a"},
+        {"type": "page_delta", "page": 1, "text": "b"},
+        {"type": "page_delta", "page": 2, "text": "c"},
+        {"type": "page_delta", "page": 2, "text": "d"},
+        {"type": "processing_complete"},
+    ]
+
+    async def run(coalesce: bool):
+        socket = FakeSocket()
+        socket.gate.clear()
+        sender = MessageSender(socket, coalesce=coalesce)
+        sender.start()
+        for event in events:
+            await sender.send(event)
+        socket.gate.set()
+        await sender.close()
+        return socket.events(), sender.coalesced
+
+    merged, coalesced = asyncio.run(run(True))
+    assert [(event["type"], event.get("text")) for event in merged] == [
+        ("page_start", None), ("page_delta", "ab"), ("page_delta", "cd"), ("processing_complete", None)]
+    assert coalesced == 2
+    assert asyncio.run(run(False)) == (events, 0)
+
+def test_a_failed_send_is_raised_to_the_producer():
+    async def run():
+        socket = FakeSocket(fail=ConnectionError("gone"))
+        socket.gate.clear()
+        sender = MessageSender(socket, max_queue=1)
+        sender.start()
+        await sender.send({"type": "page", "page": 0})
+        await asyncio.sleep(0)
+        await sender.send({"type": "page", "page": 1})
+        # Blocked on the full queue when the connection fails
+        blocked = asyncio.ensure_future(sender.send({"type": "page", "page": 2}))
+        await asyncio.sleep(0.01)
+        socket.gate.set()
+        with pytest.raises(ConnectionError, match="gone"):
+            await asyncio.wait_for(blocked, 1)
+        with pytest.raises(ConnectionError, match="gone"):
+            await sender.send({"type": "page", "page": 3})
+        await sender.close()
+
+    asyncio.run(run())
+
+def test_msgpack_events_are_binary_frames():
+    event = {"type": "page", "page": 1, "text": "héllo", "thumbnail": b"\xff\xd8"}
+
+    async def run():
+        socket = FakeSocket()
+        sender = MessageSender(socket, "msgpack")
+        sender.start()
+        await sender.send(event)
+        await sender.close()
+        return socket
+
+    socket = asyncio.run(run())
+    assert [kind for kind, _ in socket.frames] == ["bytes"]
+    assert socket.events() == [event]
+    assert decode_message({"bytes": socket.frames[0][1]}, "msgpack") == event
+    with pytest.raises(ValueError):
+        decode_message({"bytes": socket.frames[0][1]}, "json")
+
+class FakeScope:
+    def __init__(self, subprotocols):
+        self.scope = {"subprotocols": subprotocols}
+
+def test_negotiate_encoding():
+    assert negotiate_encoding(FakeScope(["ocr.json", "ocr.msgpack"])) == ("ocr.msgpack", "msgpack")
+    assert negotiate_encoding(FakeScope(["ocr.json"])) == ("ocr.json", "json")
+    assert negotiate_encoding(FakeScope(["other"])) == (None, "json")
+    assert negotiate_encoding(FakeScope([])) == (None, "json")
+
+def test_upload_socket_speaks_msgpack_when_asked(server):
+    client = TestClient(server.app)
+    with client.websocket_connect("/ws/upload/", subprotocols=["ocr.msgpack"]) as ws:
+        assert ws.accepted_subprotocol == "ocr.msgpack"
+        ws.send_bytes(msgpack.packb({"filename": "a.pdf", "size": 10}))
+        assert msgpack.unpackb(ws.receive_bytes())["type"] == "upload_ready"
+        ws.send_text("not file data")
+        error = msgpack.unpackb(ws.receive_bytes())
+        assert error == {"type": "error", "error": "Expected a binary frame with file data"}
+
+def test_a_rejected_request_is_answered_in_msgpack_too(server):
+    client = TestClient(server.app)
+    with client.websocket_connect("/ws/upload/", subprotocols=["ocr.msgpack"]) as ws:
+        ws.send_bytes(msgpack.packb({"filename": "a.pdf", "size": 10, "profile": "nonexistent"}))
+        error = msgpack.unpackb(ws.receive_bytes())
+        assert error["type"] == "error" and "nonexistent" in error["error"]
+
+def test_upload_socket_defaults_to_json(server):
+    client = TestClient(server.app)
+    with client.websocket_connect("/ws/upload/") as ws:
+        assert ws.accepted_subprotocol is None
+        ws.send_text(json.dumps({"filename": "a.pdf", "size": 0}))
+        error = ws.receive_json()
+        assert error["type"] == "error" and "Upload size" in error["error"]
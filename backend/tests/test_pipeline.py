@@ -0,0 +1,182 @@
+import asyncio, os, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from PIL import Image, ImageDraw
+
+import pipeline
+from local_proc.renderpdf import PdfDocument, close_pdf
+from pipeline import PagePipeline, ResolutionPolicy, render_page, render_stage, vision_tokens
+
+@pytest.fixture
+def executor():
+    executor = ThreadPoolExecutor(4)
+    yield executor
+    executor.shutdown()
+
+class FakeRender:
+    """Stands in for render_stage: records which pages were submitted, and
+    finishes later pages first so the pipeline has to put them back in order."""
+
+    def __init__(self, total: int, fail: set[int] = frozenset()):
+        self.total = total
+        self.fail = fail
+        self.started = []
+        self.lock = threading.Lock()
+
+    def __call__(self, path, page_num, max_pixels=None, text_layer=False, thumbnail=True, policy=None):
+        with self.lock:
+            self.started.append(page_num)
+        time.sleep(0.01 * (self.total - page_num + 1))
+        if page_num in self.fail:
+            raise ValueError(f"page {page_num} is broken")
+        return {"route": "vision", "text": None, "text_layer": None, "thumbnail": None, "image": None,
+                "image_hash": str(page_num), "estimated_chars": 0, "resolution": None, "timings": {}}
+
+async def _drain(pipe: PagePipeline) -> list[dict]:
+    pages = []
+    while (page := await pipe.next_page()) is not None:
+        pages.append(page)
+        pipe.release()
+    return pages
+
+def test_pages_come_out_in_order(make_pdf, executor, monkeypatch):
+    monkeypatch.setattr(pipeline, "render_stage", FakeRender(6))
+
+    async def run():
+        pipe = PagePipeline(make_pdf(6), 4, executor)
+        assert await pipe.start() == 6
+        try:
+            return await _drain(pipe)
+        finally:
+            await pipe.close()
+
+    pages = asyncio.run(run())
+    assert [page["page"] for page in pages] == [1, 2, 3, 4, 5, 6]
+    assert [page["image_hash"] for page in pages] == ["1", "2", "3", "4", "5", "6"]
+    assert all(page["timings"]["queue_wait_ms"] >= 0 for page in pages)
+
+def test_no_more_than_depth_pages_are_in_flight(make_pdf, executor, monkeypatch):
+    render = FakeRender(5)
+    monkeypatch.setattr(pipeline, "render_stage", render)
+
+    async def run():
+        pipe = PagePipeline(make_pdf(5), 2, executor)
+        await pipe.start()
+        try:
+            await asyncio.sleep(0.2)
+            assert sorted(render.started) == [1, 2]
+            # Handing a page out does not free its slot; releasing it does
+            assert (await pipe.next_page())["page"] == 1
+            await asyncio.sleep(0.2)
+            assert sorted(render.started) == [1, 2]
+            pipe.release()
+            await asyncio.sleep(0.2)
+            assert sorted(render.started) == [1, 2, 3]
+            assert [page["page"] for page in await _drain(pipe)] == [2, 3, 4, 5]
+        finally:
+            await pipe.close()
+
+    asyncio.run(run())
+
+def test_a_failed_render_is_reported_on_its_page(make_pdf, executor, monkeypatch):
+    monkeypatch.setattr(pipeline, "render_stage", FakeRender(3, fail={2}))
+
+    async def run():
+        pipe = PagePipeline(make_pdf(3), 2, executor)
+        await pipe.start()
+        try:
+            return await _drain(pipe)
+        finally:
+            await pipe.close()
+
+    first, broken, last = asyncio.run(run())
+    assert first["error"] is None and last["error"] is None
+    assert broken["page"] == 2
+    assert broken["error"] == "page 2 is broken"
+    assert broken["route"] is None and broken["image"] is None
+
+def test_skipped_pages_are_not_rendered(make_pdf, executor, monkeypatch):
+    render = FakeRender(4)
+    monkeypatch.setattr(pipeline, "render_stage", render)
+
+    async def run():
+        pipe = PagePipeline(make_pdf(4), 4, executor, skip_pages={1, 3})
+        await pipe.start()
+        try:
+            return await _drain(pipe)
+        finally:
+            await pipe.close()
+
+    pages = asyncio.run(run())
+    assert [page["route"] for page in pages] == ["cache", "vision", "cache", "vision"]
+    assert sorted(render.started) == [2, 4]
+
+def test_close_removes_the_spooled_copy_only(make_pdf, executor):
+    path = make_pdf(2)
+
+    async def run(source):
+        pipe = PagePipeline(source, 2, executor)
+        await pipe.start()
+        spooled = pipe._path
+        assert os.path.exists(spooled)
+        await pipe.close()
+        return spooled
+
+    with open(path, "rb") as fh:
+        spooled = asyncio.run(run(fh.read()))
+    assert spooled != path and not os.path.exists(spooled)
+    assert asyncio.run(run(path)) == path and os.path.exists(path)
+
+def test_render_stage_renders_a_page_within_the_pixel_cap(make_pdf):
+    path = make_pdf(2)
+    stage = render_stage(path, 2, max_pixels=200_000)
+    close_pdf(path)
+    width, height = stage["image"].size
+    assert stage["route"] == "vision"
+    assert 0.9 * 200_000 <= width * height <= 1.05 * 200_000
+    assert stage["resolution"]["reason"] == "fixed"
+    assert stage["thumbnail"].startswith(b"\xff\xd8")  # JPEG
+    assert stage["image_hash"] and stage["estimated_chars"] > 0
+
+def test_render_stage_raises_for_a_missing_page(make_pdf):
+    path = make_pdf(1)
+    with pytest.raises(ValueError, match="out of range"):
+        render_stage(path, 2)
+    close_pdf(path)
+
+def _lines(size: tuple[int, int], line: int, gap: int, count: int | None = None) -> Image.Image:
+    """A white image with ``count`` (default: as many as fit) black bands ``line`` px high."""
+    img = Image.new("L", size, 255)
+    draw = ImageDraw.Draw(img)
+    y, drawn = gap, 0
+    while y + line < size[1] and (count is None or drawn < count):
+        draw.rectangle((10, y, size[0] - 10, y + line - 1), fill=0)
+        y, drawn = y + line + gap, drawn + 1
+    return img
+
+def test_policy_gives_a_blank_page_the_base_budget():
+    assert ResolutionPolicy().assess(Image.new("L", (800, 1000), 255)) == (2000, "base")
+
+def test_policy_gives_a_dense_page_more():
+    assert ResolutionPolicy().assess(_lines((800, 1000), 30, 30)) == (3000, "dense")
+
+def test_policy_scales_small_text_up_to_the_minimum_line_height():
+    policy = ResolutionPolicy(max_tokens=100_000)
+    tokens, reason = policy.assess(_lines((800, 1000), 8, 40, count=5))
+    assert reason == "small_text"
+    # Lines of 8px need 2x the linear scale, so 4x the pixels, to reach 16px
+    assert tokens == int(800 * 1000 * 4 / policy.token_pixels)
+
+def test_policy_caps_small_text_at_max_tokens():
+    assert ResolutionPolicy().assess(_lines((800, 1000), 4, 40, count=5)) == (5000, "small_text")
+
+def test_policy_render_stays_within_the_budget_and_the_cap(make_pdf):
+    policy = ResolutionPolicy(base_tokens=300, dense_tokens=600, max_tokens=800)
+    with PdfDocument(make_pdf(1, dpi=150, density="blank")) as doc:
+        img, resolution = render_page(doc, 1, policy=policy)
+        assert resolution["reason"] == "base"
+        assert resolution["tokens"] == vision_tokens(img)
+        assert abs(resolution["tokens"] - 300) / 300 < 0.1
+        img, resolution = render_page(doc, 1, max_pixels=100 * policy.token_pixels, policy=policy)
+        assert resolution["tokens"] <= 105
@@ -0,0 +1,33 @@
+from PIL import Image
+
+from scheduler import GenerationJob, InferenceScheduler
+
+PROMPT = ("Below is the image of one page of a document. Just return the plain text representation "
+          "of this document as if you were reading it naturally.")
+
+def _page_jobs():
+    # Pages of different sizes, so the rows are left-padded differently
+    return [GenerationJob([{"role": "user", "content": [{"type": "text", "text": PROMPT}, {"type": "image"}]}],
+                          images=[Image.new("RGB", (224 + 28 * i, 224), color)],
+                          gen_kwargs={"do_sample": False}, max_new_tokens=12, cache_prefix=True)
+            for i, color in enumerate(("white", "gray", "black"))]
+
+def _run(standin, prefix_cache_entries: int, rounds: int = 2):
+    scheduler = InferenceScheduler(*standin, max_batch_size=4, max_wait_ms=50,
+                                   prefix_cache_entries=prefix_cache_entries)
+    try:
+        for _ in range(rounds):
+            outputs = [future.result(timeout=300) for future in scheduler.submit_many(_page_jobs())]
+        return outputs, scheduler.stats()["prefix_cache"]
+    finally:
+        scheduler.stop()
+
+def test_cached_prefix_gives_the_same_output_as_a_full_prefill(standin):
+    cached, stats = _run(standin, prefix_cache_entries=4)
+    full, _ = _run(standin, prefix_cache_entries=0)
+    assert [output.text for output in cached] == [output.text for output in full]
+    assert stats["enabled"]
+    assert (stats["misses"], stats["hits"]) == (1, 1)
+    assert stats["prefill_tokens_saved"] > 0
+    assert all(output.prefix_tokens > 0 for output in cached)
+    assert all(output.prefix_tokens == 0 for output in full)
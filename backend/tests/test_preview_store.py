@@ -0,0 +1,81 @@
+import os, time
+
+from fastapi.testclient import TestClient
+
+from preview_store import PreviewStore
+
+def test_put_and_get(tmp_path):
+    store = PreviewStore(str(tmp_path), ttl=60)
+    job = store.new_job()
+    assert store.put(job, 3, b"jpeg bytes") == f"/preview/{job}/3"
+    data, etag = store.get(job, 3)
+    assert data == b"jpeg bytes"
+    assert store.get(job, 3)[1] == etag
+    assert store.writes == 1
+
+def test_etag_changes_when_a_thumbnail_is_rewritten(tmp_path):
+    store = PreviewStore(str(tmp_path), ttl=60)
+    job = store.new_job()
+    store.put(job, 1, b"first")
+    _, etag = store.get(job, 1)
+    store.put(job, 1, b"second version")
+    assert store.get(job, 1)[0] == b"second version"
+    assert store.get(job, 1)[1] != etag
+
+def test_unknown_previews_are_not_found(tmp_path):
+    store = PreviewStore(str(tmp_path), ttl=60)
+    job = store.new_job()
+    store.put(job, 1, b"jpeg")
+    assert store.get(job, 2) is None
+    assert store.get(store.new_job(), 1) is None
+    assert store.get("../" + job, 1) is None
+
+def _age(store: PreviewStore, job: str, seconds: float):
+    then = time.time() - seconds
+    os.utime(os.path.join(store.root, job), (then, then))
+
+def test_expired_jobs_are_removed_unless_kept(tmp_path):
+    store = PreviewStore(str(tmp_path), ttl=60)
+    old, fresh, kept = store.new_job(), store.new_job(), store.new_job()
+    for job in (old, fresh, kept):
+        store.put(job, 1, b"jpeg")
+    store.keep(kept)
+    _age(store, old, 120)
+    _age(store, kept, 120)
+
+    store._last_cleanup = 0.0  # due for a cleanup
+    store.new_job()
+    assert store.get(old, 1) is None
+    assert store.get(fresh, 1) is not None
+    assert store.get(kept, 1) is not None
+
+    store.remove(kept)
+    assert store.get(kept, 1) is None
+
+def test_cleanup_runs_at_most_once_per_ttl(tmp_path):
+    store = PreviewStore(str(tmp_path), ttl=60)
+    store.new_job()  # the first call cleans up
+    job = store.new_job()
+    store.put(job, 1, b"jpeg")
+    _age(store, job, 120)
+    store.new_job()
+    assert store.get(job, 1) is not None
+
+def test_preview_endpoint_answers_a_matching_etag_with_304(server):
+    client = TestClient(server.app)
+    job = server.PREVIEW_STORE.new_job()
+    url = server.PREVIEW_STORE.put(job, 1, b"\xff\xd8 jpeg")
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.content == b"\xff\xd8 jpeg"
+    assert response.headers["content-type"] == "image/jpeg"
+    etag = response.headers["etag"]
+
+    cached = client.get(url, headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.content == b""
+    assert cached.headers["etag"] == etag
+
+    assert client.get(url, headers={"If-None-Match": '"stale"'}).status_code == 200
+    assert client.get(f"/preview/{job}/2").status_code == 404
@@ -0,0 +1,89 @@
+import os, shutil
+
+import pytest
+
+from local_proc import renderpdf
+from local_proc.renderpdf import PdfDocument, close_pdf, dpi_for_pixels, open_pdf
+
+def test_dpi_for_pixels():
+    letter = (612, 792)  # points
+    assert dpi_for_pixels(*letter, 612 * 792) == pytest.approx(72)
+    # Four times the pixels is twice the linear resolution
+    assert dpi_for_pixels(*letter, 4 * 612 * 792) == pytest.approx(144)
+    assert dpi_for_pixels(*letter, 8.5 * 300 * 11 * 300) == pytest.approx(300)
+    # A degenerate page counts as one square point rather than dividing by zero
+    assert dpi_for_pixels(0, 0, 72 * 72) == pytest.approx(72 * 72)
+
+def test_render_picks_the_dpi_for_max_pixels(make_pdf):
+    with PdfDocument(make_pdf(1)) as doc:
+        assert doc.page_size(1) == pytest.approx((612, 792))
+        width, height = doc.render(1, dpi=None, max_pixels=4 * 612 * 792).size
+        assert (width, height) == (pytest.approx(1224, abs=1), pytest.approx(1584, abs=1))
+        # dpi is an upper bound when both are given
+        assert doc.render(1, dpi=36, max_pixels=4 * 612 * 792).size == (306, 396)
+        with pytest.raises(ValueError, match="out of range"):
+            doc.render(2)
+
+@pytest.fixture
+def pdfs(make_pdf, tmp_path):
+    """Copies of a PDF at distinct paths, and an empty open-document cache around the test."""
+    source = make_pdf(1)
+    paths = []
+    for i in range(renderpdf._MAX_OPEN_DOCUMENTS + 2):
+        paths.append(str(tmp_path / f"doc{i}.pdf"))
+        shutil.copy(source, paths[-1])
+    yield paths
+    for path in list(renderpdf._OPEN_DOCUMENTS):
+        close_pdf(path)
+
+def _is_open(doc: PdfDocument) -> bool:
+    return doc._pdf is not None
+
+def test_open_pdf_reuses_the_parsed_document(pdfs):
+    with open_pdf(pdfs[0]) as first:
+        pass
+    with open_pdf(pdfs[0]) as again:
+        assert again is first and _is_open(again)
+
+def test_least_recently_used_document_is_evicted_and_closed(pdfs):
+    docs = []
+    for path in pdfs[:renderpdf._MAX_OPEN_DOCUMENTS]:
+        with open_pdf(path) as doc:
+            docs.append(doc)
+    with open_pdf(pdfs[0]):  # now the most recently used
+        pass
+    with open_pdf(pdfs[renderpdf._MAX_OPEN_DOCUMENTS]):
+        pass
+    assert pdfs[1] not in renderpdf._OPEN_DOCUMENTS and not _is_open(docs[1])
+    assert pdfs[0] in renderpdf._OPEN_DOCUMENTS and _is_open(docs[0])
+    assert len(renderpdf._OPEN_DOCUMENTS) == renderpdf._MAX_OPEN_DOCUMENTS
+
+def test_evicted_document_stays_open_until_its_user_is_done(pdfs):
+    with open_pdf(pdfs[0]) as busy:
+        for path in pdfs[1:]:
+            with open_pdf(path):
+                pass
+        assert pdfs[0] not in renderpdf._OPEN_DOCUMENTS
+        assert _is_open(busy)
+        assert busy.render(1, dpi=36).size == (306, 396)
+    assert not _is_open(busy)
+
+def test_close_pdf(pdfs):
+    with open_pdf(pdfs[0]) as doc:
+        pass
+    close_pdf(pdfs[0])
+    assert pdfs[0] not in renderpdf._OPEN_DOCUMENTS and not _is_open(doc)
+    close_pdf(pdfs[0])  # already closed: nothing to do
+
+    with open_pdf(pdfs[1]) as doc:
+        close_pdf(pdfs[1])
+        assert _is_open(doc)
+    assert not _is_open(doc)
+
+def test_deleted_files_are_dropped_on_the_next_open(pdfs):
+    with open_pdf(pdfs[0]) as deleted:
+        pass
+    os.remove(pdfs[0])
+    with open_pdf(pdfs[1]):
+        pass
+    assert pdfs[0] not in renderpdf._OPEN_DOCUMENTS and not _is_open(deleted)
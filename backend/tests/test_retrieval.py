@@ -0,0 +1,58 @@
+from retrieval import (BM25Index, IndexCache, chunk_document, format_chunks, group_chunks, page_span,
+                       select_context, split_pages)
+
+DOCUMENT = "\n\n---\n\n".join([
+    "Page 1 (scan.pdf):\nInvoice number 42 from Acme Corporation.",
+    "Page 2 (scan.pdf):\nPayment is due within thirty days.\n\nLate payment adds interest.",
+    "Page 3 (scan.pdf):\nShipping address: 1 Harbour Road.",
+])
+
+def test_split_pages():
+    pages = split_pages(DOCUMENT)
+    assert [page for page, _ in pages] == [1, 2, 3]
+    assert pages[0][1] == "Invoice number 42 from Acme Corporation."
+    assert split_pages("no markers here") == [(None, "no markers here")]
+
+def test_chunks_never_span_pages():
+    chunks = chunk_document(DOCUMENT, chunk_chars=40)
+    assert [chunk.index for chunk in chunks] == list(range(len(chunks)))
+    assert {chunk.page for chunk in chunks} == {1, 2, 3}
+    assert all(len(chunk.text) <= 40 for chunk in chunks)
+    # Page 2 is split at its paragraph break
+    assert [chunk.text for chunk in chunks if chunk.page == 2] == [
+        "Payment is due within thirty days.", "Late payment adds interest."]
+
+def test_long_words_are_cut():
+    chunks = chunk_document("x" * 25, chunk_chars=10)
+    assert [len(chunk.text) for chunk in chunks] == [10, 10, 5]
+
+def test_search_ranks_matching_chunks():
+    index = BM25Index(chunk_document(DOCUMENT, chunk_chars=40))
+    results = index.search("when is payment due", k=2)
+    assert results[0][1].text == "Payment is due within thirty days."
+    assert all(score > 0 for score, _ in results)
+    assert index.search("zebra") == []
+
+def test_select_context_fits_and_keeps_document_order():
+    index = BM25Index(chunk_document(DOCUMENT, chunk_chars=40))
+    chosen = select_context(index, "payment address", max_chars=70)
+    assert sum(len(chunk.text) for chunk in chosen) <= 70
+    assert [chunk.index for chunk in chosen] == sorted(chunk.index for chunk in chosen)
+    # Nothing matches: the opening chunks are used
+    assert select_context(index, "summarize", max_chars=1000)[0].page == 1
+
+def test_formatting_helpers():
+    chunks = chunk_document(DOCUMENT, chunk_chars=40)
+    assert format_chunks(chunks[:1]) == "[Page 1]\nInvoice number 42 from Acme Corporation."
+    assert page_span(chunks) == "pages 1-3"
+    assert page_span(chunks[:1]) == "page 1"
+    groups = group_chunks(chunks, max_chars=80)
+    assert [chunk for group in groups for chunk in group] == chunks
+    assert all(sum(len(c.text) for c in group) <= 80 for group in groups if len(group) > 1)
+
+def test_index_cache_reuses_and_evicts():
+    cache = IndexCache(max_entries=1, chunk_chars=40)
+    index = cache.get(DOCUMENT)
+    assert cache.get(DOCUMENT) is index
+    cache.get("another document")
+    assert cache.get(DOCUMENT) is not index
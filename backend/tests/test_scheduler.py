@@ -0,0 +1,70 @@
+# The scheduler on the tiny random stand-in model (standin_model.py): its
+# output is gibberish, but batching, budgets and stop reasons are real.
+import pytest
+import torch
+
+from scheduler import GenerationJob, InferenceScheduler
+
+@pytest.fixture
+def scheduler(standin):
+    scheduler = InferenceScheduler(*standin, max_batch_size=4, max_wait_ms=50, prefix_cache_entries=0)
+    yield scheduler
+    scheduler.stop()
+
+def _job(text: str, budget: int, gen_kwargs: dict | None = None, stop_on_repetition: bool = True):
+    return GenerationJob([{"role": "user", "content": [{"type": "text", "text": text}]}],
+                         gen_kwargs=gen_kwargs or {"do_sample": False}, max_new_tokens=budget,
+                         stop_on_repetition=stop_on_repetition)
+
+def _outputs(scheduler, jobs):
+    return [future.result(timeout=300) for future in scheduler.submit_many(jobs)]
+
+def test_compatible_jobs_share_a_batch(scheduler):
+    outputs = _outputs(scheduler, [_job(f"prompt {i}", 8) for i in range(4)])
+    stats = scheduler.stats()
+    assert (stats["batches"], stats["jobs"], stats["max_batch_size_seen"]) == (1, 4, 4)
+    assert all(output.queue_seconds >= 0 for output in outputs)
+
+def test_jobs_with_other_settings_run_apart(scheduler):
+    _outputs(scheduler, [_job("a", 8), _job("b", 8, {"do_sample": False, "repetition_penalty": 1.1})])
+    assert scheduler.stats()["batches"] == 2
+
+def test_each_row_stops_at_its_own_budget(scheduler):
+    budgets = [16, 300, 200, 150]
+    outputs = _outputs(scheduler, [_job(f"page {i} text", budget) for i, budget in enumerate(budgets)])
+    assert scheduler.stats()["batches"] == 1
+    for output, budget in zip(outputs, budgets):
+        assert output.budget == budget
+        assert output.tokens <= budget
+        assert output.stop_reason in ("budget", "eos")
+        assert (output.stop_reason == "budget") == (output.tokens == budget)
+
+def test_rows_finished_early_are_not_reported_as_repetition(scheduler):
+    # The short row is padded for ~280 steps while the long one runs; that is
+    # not a repetition loop
+    short, long = _outputs(scheduler, [_job("short", 16), _job("long", 300)])
+    assert short.stop_reason != "repetition"
+    assert long.stop_reason != "repetition"
+
+def _first_tokens(standin, text: str, count: int) -> list[int]:
+    model, processor, device = standin
+    prompt = processor.apply_chat_template([{"role": "user", "content": [{"type": "text", "text": text}]}],
+                                           tokenize=False, add_generation_prompt=True)
+    inputs = processor(text=[prompt], return_tensors="pt").to(device)
+    with torch.no_grad():
+        out = model.generate(**inputs, do_sample=False, max_new_tokens=count)
+    return out[0, inputs["input_ids"].shape[1]:].tolist()
+
+def test_row_that_hits_eos_is_reported_as_eos(standin, scheduler):
+    # Make the 4th token the greedy continuation produces an end of sequence
+    tokens = _first_tokens(standin, "hello there", 4)
+    config = standin[0].generation_config
+    original = config.eos_token_id
+    config.eos_token_id = [tokens[3]]
+    try:
+        ended, other = _outputs(scheduler, [_job("hello there", 200), _job("something else entirely", 200)])
+    finally:
+        config.eos_token_id = original
+    assert ended.stop_reason == "eos"
+    assert ended.tokens <= 4
+    assert other.stop_reason != "repetition"
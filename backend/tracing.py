@@ -0,0 +1,84 @@
+# tracing.py - per-request traces in the Chrome trace event format
+#
+# A request asks for a trace (the ``trace`` option of /upload/ and the
+# WebSocket) and gets back its id; GET /traces/{id} returns the trace as JSON
+# that chrome://tracing or https://ui.perfetto.dev open directly, with one
+# track per stage: pages rendering, the model, postprocessing and delivery.
+# The trace in effect is a context variable, so the OCR code records spans
+# without it being passed through every call.
+import contextvars, threading, time, uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+class Trace:
+    """Spans of one request, timed with ``time.perf_counter()``."""
+
+    def __init__(self, name: str):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.created = time.time()
+        self.origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._spans: list[tuple[str, str, float, float, dict]] = []
+
+    def span(self, name: str, track: str, start: float, end: float, **args):
+        """Record ``name`` on ``track`` from ``start`` to ``end`` (perf_counter seconds)."""
+        with self._lock:
+            self._spans.append((name, track, start, max(start, end), args))
+
+    @contextmanager
+    def timed(self, name: str, track: str, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.span(name, track, start, time.perf_counter(), **args)
+
+    def to_chrome(self) -> dict:
+        """The trace as a Chrome trace event document (complete "X" events, microseconds)."""
+        with self._lock:
+            spans = sorted(self._spans, key=lambda span: span[2])
+        tracks = {}
+        events = []
+        for name, track, start, end, args in spans:
+            tid = tracks.setdefault(track, len(tracks) + 1)
+            events.append({"name": name, "cat": track, "ph": "X", "pid": 1, "tid": tid,
+                           "ts": round(1e6 * (start - self.origin), 1),
+                           "dur": round(1e6 * (end - start), 1), "args": args})
+        metadata = [{"name": "process_name", "ph": "M", "pid": 1, "args": {"name": self.name}}]
+        metadata += [{"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": track}}
+                     for track, tid in tracks.items()]
+        return {"traceEvents": metadata + events, "displayTimeUnit": "ms",
+                "otherData": {"trace_id": self.id, "created": self.created}}
+
+_CURRENT: contextvars.ContextVar[Trace | None] = contextvars.ContextVar("trace", default=None)
+
+def current() -> Trace | None:
+    """The trace of the request being handled, if it asked for one."""
+    return _CURRENT.get()
+
+def start(trace: Trace) -> Trace:
+    """Make ``trace`` current for the rest of this context (task or request)."""
+    _CURRENT.set(trace)
+    return trace
+
+class TraceStore:
+    """The last ``max_traces`` traces, kept in memory for GET /traces/{id}."""
+
+    def __init__(self, max_traces: int = 32):
+        self.max_traces = max(1, max_traces)
+        self._lock = threading.Lock()
+        self._traces: OrderedDict[str, Trace] = OrderedDict()
+
+    def new(self, name: str) -> Trace:
+        """A new trace, stored right away and made current."""
+        trace = Trace(name)
+        with self._lock:
+            self._traces[trace.id] = trace
+            while len(self._traces) > self.max_traces:
+                self._traces.popitem(last=False)
+        return start(trace)
+
+    def get(self, trace_id: str) -> Trace | None:
+        with self._lock:
+            return self._traces.get(trace_id)
@@ -10,11 +10,24 @@ import {
 } from 'lucide-react';
 import './ChatInterface.css';
 
+// Drop the server-side chat session held in sessionRef, if there is one
+const endSession = (sessionRef) => {
+  const { id } = sessionRef.current;
+  sessionRef.current = { text: null, id: null };
+  if (id) {
+    fetch(`http://localhost:8000/chat/sessions/${id}`, { method: 'DELETE' })
+      .catch(error => console.error('Session cleanup failed:', error));
+  }
+};
+
 const ChatInterface = ({ extractedText, isVisible, onClose, documentName = "" }) => {
   const [messages, setMessages] = useState([]);
   const [input, setInput] = useState('');
   const [isLoading, setIsLoading] = useState(false);
   const messagesEndRef = useRef(null);
+  // Server-side chat session for the current document text: the text is
+  // uploaded once and the backend keeps the conversation
+  const sessionRef = useRef({ text: null, id: null });
 
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
@@ -24,6 +37,9 @@ const ChatInterface = ({ extractedText, isVisible, onClose, documentName = "" })
     scrollToBottom();
   }, [messages]);
 
+  // A session holds one document's text: end it when the text changes or the chat unmounts
+  useEffect(() => () => endSession(sessionRef), [extractedText]);
+
   // Auto-analysis when document is loaded
   const performAutoAnalysis = useCallback(async () => {
     if (!extractedText) return;
@@ -74,6 +90,66 @@ const ChatInterface = ({ extractedText, isVisible, onClose, documentName = "" })
     }
   }, [isVisible, extractedText, messages.length, performAutoAnalysis]);
 
+  const getSession = async (text) => {
+    if (sessionRef.current.id && sessionRef.current.text === text) {
+      return sessionRef.current.id;
+    }
+    endSession(sessionRef);
+    const formData = new FormData();
+    formData.append('extracted_text', text);
+    formData.append('document_name', documentName);
+    const response = await fetch('http://localhost:8000/chat/sessions/', {
+      method: 'POST',
+      body: formData
+    });
+    const result = await response.json();
+    if (!result.success) {
+      throw new Error(result.error || 'Could not start chat session');
+    }
+    sessionRef.current = { text, id: result.session_id };
+    return result.session_id;
+  };
+
+  const sendSessionMessage = async (message, text) => {
+    for (let attempt = 0; attempt < 2; attempt++) {
+      const sessionId = await getSession(text);
+      const formData = new FormData();
+      formData.append('message', message);
+      const response = await fetch(`http://localhost:8000/chat/sessions/${sessionId}/messages`, {
+        method: 'POST',
+        body: formData
+      });
+      if (response.status === 404) {
+        // Expired on the server: start a new session and send again
+        sessionRef.current = { text: null, id: null };
+        continue;
+      }
+      return response.json();
+    }
+    throw new Error('Chat session expired');
+  };
+
+  const sendStatelessMessage = async (message, text) => {
+    const formData = new FormData();
+    formData.append('message', message);
+    formData.append('extracted_text', text);
+    formData.append('document_name', documentName);
+
+    // Convert messages to the format expected by backend
+    const conversationHistory = messages.map(msg => ({
+      role: msg.sender === 'user' ? 'user' : 'assistant',
+      content: msg.text
+    }));
+    formData.append('conversation_history', JSON.stringify(conversationHistory));
+
+    const response = await fetch('http://localhost:8000/chat/', {
+      method: 'POST',
+      body: formData
+    });
+    console.log('[Chat] Response status:', response.status);
+    return response.json();
+  };
+
   // Updated sendMessage function that connects to your backend
   const sendMessage = async (message, extractedTextContent = null) => {
     if (!message.trim()) return;
@@ -90,25 +166,15 @@ const ChatInterface = ({ extractedText, isVisible, onClose, documentName = "" })
 
     try {
       console.log('[Chat] Sending message to backend:', message);
-      const formData = new FormData();
-      formData.append('message', message);
-      formData.append('extracted_text', extractedTextContent || extractedText || '');
-      formData.append('document_name', documentName);
-      
-      // Convert messages to the format expected by backend
-      const conversationHistory = messages.map(msg => ({
-        role: msg.sender === 'user' ? 'user' : 'assistant',
-        content: msg.text
-      }));
-      formData.append('conversation_history', JSON.stringify(conversationHistory));
-
-      const response = await fetch('http://localhost:8000/chat/', {
-        method: 'POST',
-        body: formData
-      });
-
-      console.log('[Chat] Response status:', response.status);
-      const result = await response.json();
+      const text = extractedTextContent || extractedText || '';
+      let result;
+      try {
+        result = await sendSessionMessage(message, text);
+      } catch (sessionError) {
+        // Backends without chat sessions get the whole context every turn
+        console.warn('[Chat] Session unavailable, using stateless chat:', sessionError);
+        result = await sendStatelessMessage(message, text);
+      }
       console.log('[Chat] Response result:', result);
       
       if (result.success) {
@@ -160,6 +226,7 @@ const ChatInterface = ({ extractedText, isVisible, onClose, documentName = "" })
 
   const clearChat = () => {
     setMessages([]);
+    endSession(sessionRef);
     // Reinitialize with welcome message
     if (extractedText) {
       setMessages([{
@@ -44,6 +44,9 @@ const FileUpload = ({ onOCRComplete }) => {
   const apiUrl = process.env.REACT_APP_OCR_API_URL || "http://localhost:8000/upload/";
   const wsUrl = process.env.REACT_APP_OCR_WS_URL || "ws://localhost:8000/ws/upload/";
   const { processFile } = useOCRService(apiUrl);
+
+  // Page previews come back as paths on the OCR server (/preview/{job}/{page})
+  const resolvePreview = (preview) => (preview ? new URL(preview, apiUrl).href : null);
   const { processFileStream, isProcessing: wsProcessing } = useWebSocketOCR(wsUrl);
 
   const [showChat, setShowChat] = useState(false);
@@ -130,7 +133,7 @@ const FileUpload = ({ onOCRComplete }) => {
                   error: pageResult.error || null,
                   processingTime: Date.now(),
                   confidence: pageResult.confidence || null,
-                  preview: pageResult.preview || null
+                  preview: resolvePreview(pageResult.preview)
                 };
                 
                 console.log(`[FileUpload] IMMEDIATE streaming page ${pageResult.pageNumber} for ${file.name}`);
@@ -187,7 +190,7 @@ const FileUpload = ({ onOCRComplete }) => {
         error: pageData.error || null,
         processingTime: Date.now(),
         confidence: pageData.confidence || null,
-        preview: pageData.preview || null
+        preview: resolvePreview(pageData.preview)
       }));
 
       setPageResults(prev => [...prev, ...processedResults]);
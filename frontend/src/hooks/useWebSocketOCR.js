@@ -12,23 +12,33 @@ export const useWebSocketOCR = (wsUrl) => {
       let totalPages = 0;
       let processedPages = 0;
 
+      ws.binaryType = 'arraybuffer';
+
+      // Stream the file as binary frames once the server is ready for it,
+      // instead of one base64 JSON message holding the whole file
+      const sendFileChunks = async (chunkSize) => {
+        for (let offset = 0; offset < file.size; offset += chunkSize) {
+          // Keep only a few chunks queued in the browser at a time
+          while (ws.bufferedAmount > 4 * chunkSize) {
+            await new Promise((r) => setTimeout(r, 10));
+          }
+          const chunk = await file.slice(offset, offset + chunkSize).arrayBuffer();
+          ws.send(chunk);
+        }
+        console.log(`[WebSocketOCR] Sent ${file.size} bytes of ${file.name}`);
+      };
+
       ws.onopen = () => {
         console.log('[WebSocketOCR] Connected for real-time streaming');
         
-        // Convert file to base64
-        const reader = new FileReader();
-        reader.onload = () => {
-          const base64Data = reader.result.split(',')[1];
-          const request = {
-            file_data: base64Data,
-            filename: file.name,
-            lang: 'eng'
-          };
-          
-          console.log(`[WebSocketOCR] Sending ${file.name} for page-by-page processing`);
-          ws.send(JSON.stringify(request));
+        const request = {
+          filename: file.name,
+          lang: 'eng',
+          size: file.size
         };
-        reader.readAsDataURL(file);
+        
+        console.log(`[WebSocketOCR] Sending ${file.name} for page-by-page processing`);
+        ws.send(JSON.stringify(request));
       };
 
       ws.onmessage = (event) => {
@@ -36,7 +46,15 @@ export const useWebSocketOCR = (wsUrl) => {
           const result = JSON.parse(event.data);
           console.log(`[WebSocketOCR] IMMEDIATE receive: ${result.type} - Page ${result.page || 'N/A'}`);
           
-          if (result.type === 'page_start') {
+          if (result.type === 'upload_ready') {
+            sendFileChunks(result.chunk_size).catch((error) => {
+              console.error('[WebSocketOCR] Upload error:', error);
+              ws.close();
+              reject(error);
+            });
+          } else if (result.type === 'upload_complete') {
+            console.log(`[WebSocketOCR] Upload of ${file.name} complete, waiting for pages`);
+          } else if (result.type === 'page_start') {
             totalPages = result.total_pages;
             console.log(`[WebSocketOCR] Started processing page ${result.page}/${totalPages}`);
             onProgress({